@@ -0,0 +1,297 @@
+##alignment.py
+
+##functions to put signals recorded at different rates (ephys, BP, physio, stim)
+##onto a shared timebase. Each file's true start time and sample interval are
+##read from its TDMS metadata (wf_start_time/wf_increment), rather than assuming
+##that every signal starts at 0 and spans the same total duration. Signals are
+##then interpolated onto a common sample grid, a chunk at a time, so whole
+##experiments can be aligned straight from the converted data files.
+
+import numpy as np
+import os
+import datetime
+import tdms_files
+import output_backends
+
+##corrections to the saved wf_increment for each type of file. LabView saves the
+##physio (serial) data with a wf_increment of 1 instead of 0.1 (see physio_files.load_physio)
+increment_correction = {
+    'highspeed':1.0,
+    'lowspeed':1.0,
+    'physio':0.1
+}
+
+##default number of output samples to compute at once
+chunk_size = 2**20
+
+##converted data files and the type of TDMS file each one comes from
+data_sources = [
+    ('ephys_data','highspeed'),
+    ('bp_data','lowspeed'),
+    ('physio_data','physio'),
+    ('stim_data','highspeed')
+]
+
+##signals that are on/off records stored as interval tables (see stim_files.densify)
+interval_signals = ['z']
+
+def get_start_time(channel_object):
+    """
+    Returns the start time of a channel's data, in seconds since the epoch.
+    Args:
+        -channel_object: nptdms channel object
+    Returns:
+        -t0: start time in seconds, or None if the channel has no wf_start_time
+    """
+    props = channel_object.properties
+    if not 'wf_start_time' in props:
+        return None
+    t = props['wf_start_time']
+    if isinstance(t,np.datetime64):
+        t0 = (t-np.datetime64('1970-01-01T00:00:00'))/np.timedelta64(1,'us')/1e6
+    else:
+        t0 = (t-datetime.datetime(1970,1,1,tzinfo=t.tzinfo)).total_seconds()
+    return t0+props.get('wf_start_offset',0.0)
+
+def file_timing(path,kind='highspeed'):
+    """
+    Reads the timing of a TDMS file from its metadata (the data itself isn't loaded).
+    Args:
+        -path: full path to the tdms file
+        -kind: type of file, as in tdms_files.sort_tdms ('highspeed','lowspeed' or 'physio'),
+            used to look up the wf_increment correction
+    Returns:
+        -t0: start time in seconds since the epoch (None if not saved in the file)
+        -dt: sample interval in seconds
+        -n: number of samples
+    """
+    tdms_file = tdms_files.read_tdms_metadata(path)
+    for g in tdms_file.groups():
+        for c in tdms_file.group_channels(g):
+            if 'wf_increment' in c.properties:
+                dt = c.properties['wf_increment']*increment_correction.get(kind,1.0)
+                return get_start_time(c),dt,len(c)
+    raise ValueError("No waveform channels found in "+path)
+
+def get_segments(files,kind='highspeed',n_total=None):
+    """
+    Builds the timing table for a signal that was concatenated from a list of files.
+    Files without a saved start time are assumed to follow on directly from the
+    previous file.
+    Args:
+        -files: list of TDMS file paths making up the signal
+        -kind: type of file (see file_timing)
+        -n_total: number of samples in the converted signal. If this is less than
+            the number of samples in the files, the signal is assumed to have been
+            resampled (see tdms_files.downsample) and the table is adjusted to match.
+    Returns:
+        -segments: dictionary of arrays with one entry per file:
+            -t0: start time of the file in seconds since the epoch
+            -dt: sample interval in seconds
+            -n: number of samples
+            -offset: index of the file's first sample in the concatenated signal
+    """
+    files = tdms_files.order_files(files)
+    timing = [file_timing(f,kind) for f in files]
+    t0 = np.zeros(len(files))
+    dt = np.array([x[1] for x in timing])
+    n = np.array([x[2] for x in timing])
+    for i,x in enumerate(timing):
+        if x[0] != None:
+            t0[i] = x[0]
+        elif i > 0:
+            t0[i] = t0[i-1]+n[i-1]*dt[i-1]
+    if n_total != None and n_total != n.sum():
+        factor = int(np.round(n.sum()/float(n_total)))
+        n = np.array([tdms_files.resampled_length(x,1.0,1.0/factor) for x in n])
+        dt = dt*factor
+        assert n.sum() == n_total, "Signal length doesn't match the files it came from"
+    offset = np.concatenate([[0],np.cumsum(n)[:-1]])
+    return {'t0':t0,'dt':dt,'n':n,'offset':offset}
+
+def sample_positions(segments,times):
+    """
+    Converts times into (fractional) sample indices of a concatenated signal.
+    Times that fall before the signal starts, after it ends, or in a gap
+    between files are returned as NaN.
+    Args:
+        -segments: timing table from get_segments
+        -times: array of times in seconds since the epoch
+    Returns:
+        -pos: array of sample indices
+    """
+    seg = np.searchsorted(segments['t0'],times,side='right')-1
+    valid = seg >= 0
+    seg[~valid] = 0
+    pos = (times-segments['t0'][seg])/segments['dt'][seg]
+    ##positions up to one sample past the end of a file interpolate into the next file
+    valid &= pos < segments['n'][seg]
+    pos = pos+segments['offset'][seg]
+    valid &= pos <= segments['n'].sum()-1
+    pos[~valid] = np.nan
+    return pos
+
+def resample_signal(data,segments,times,method='linear',chunk=chunk_size):
+    """
+    Interpolates a signal at a given set of times. Only the part of the data
+    covering each chunk of times is read, so data can be an h5py/zarr dataset.
+    Args:
+        -data: 1-D data array or dataset. Datasets with 'scale' and 'offset'
+            attributes (see tdms_files.set_scaling_attrs) are scaled as they are read.
+            For the 'intervals' method, an n x 2 interval table (see stim_files.get_intervals).
+        -segments: timing table from get_segments
+        -times: array of times in seconds since the epoch
+        -method: 'linear', 'nearest', or 'intervals' for on/off records stored as intervals.
+            For 'linear', if the times are spaced further apart than the samples, the data
+            is smoothed with a moving average as wide as the output spacing first (so that
+            it isn't aliased).
+        -chunk: maximum number of output samples to compute, and of source samples to
+            read, at once
+    Returns:
+        -result: float64 array with the signal value at each time (NaN where
+            there is no data)
+    """
+    if method == 'intervals':
+        data = np.asarray(data)
+    attrs = getattr(data,'attrs',{})
+    scaling = (attrs['scale'],attrs['offset']) if 'scale' in attrs else None
+    ##half-width of the anti-aliasing filter, in source samples
+    half = 0
+    if method == 'linear' and times.size > 1:
+        step = (times[-1]-times[0])/float(times.size-1)
+        half = int(np.floor(step/np.median(segments['dt'])))//2
+    result = np.full(times.size,np.nan)
+    for c in range(0,times.size,chunk):
+        pos = sample_positions(segments,times[c:c+chunk])
+        ok = np.where(~np.isnan(pos))[0]
+        if ok.size == 0:
+            continue
+        pos = pos[ok]
+        if method == 'intervals':
+            import stim_files
+            result[c+ok] = stim_files.in_intervals(data,np.round(pos).astype(np.int64))
+            continue
+        ##split the chunk so that no read covers more than 'chunk' source samples
+        block = np.floor((pos-pos.min())/chunk).astype(np.int64)
+        for b in np.unique(block):
+            sel = np.flatnonzero(block==b)
+            p = pos[sel]
+            if method == 'nearest':
+                idx = np.round(p).astype(np.int64)
+                lo = idx.min()
+                buf = tdms_files.apply_scaling(data[lo:idx.max()+1],scaling,np.float64)
+                result[c+ok[sel]] = buf[idx-lo]
+                continue
+            idx = np.floor(p).astype(np.int64)
+            frac = p-idx
+            lo = max(idx.min()-half,0)
+            buf = tdms_files.apply_scaling(data[lo:min(idx.max()+2+half,len(data))],scaling,np.float64)
+            if half > 0:
+                buf = _moving_average(buf,half)
+            i0 = idx-lo
+            i1 = np.minimum(i0+1,buf.size-1)
+            result[c+ok[sel]] = buf[i0]+frac*(buf[i1]-buf[i0])
+    return result
+
+def _moving_average(x,half):
+    """
+    Returns the mean of x over a window of 2*half+1 samples centered on each sample
+    (ignoring NaNs; the window is cut short at the ends of x)
+    """
+    valid = ~np.isnan(x)
+    total = np.hstack([[0.0],np.cumsum(np.where(valid,x,0.0))])
+    count = np.hstack([[0],np.cumsum(valid)])
+    k = np.arange(x.size)
+    a = np.clip(k-half,0,x.size)
+    b = np.clip(k+half+1,0,x.size)
+    n = count[b]-count[a]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.where(n>0,(total[b]-total[a])/n,np.nan)
+
+def align(signals,fs,start=None,stop=None,t_ref=None,chunk=chunk_size):
+    """
+    Resamples a set of signals onto a common timebase.
+    Args:
+        -signals: dictionary of name:(data,segments) pairs, where segments is the
+            timing table from get_segments. The stim record ('z') is given as its
+            interval table.
+        -fs: sample rate of the common timebase, in Hz
+        -start: start of the window, in seconds relative to t_ref (default is
+            the earliest start of any signal)
+        -stop: end of the window, in seconds relative to t_ref (default is
+            the latest end of any signal)
+        -t_ref: time zero, in seconds since the epoch (default is the earliest start of any signal)
+        -chunk: number of output samples to compute at once
+    Returns:
+        -table: dictionary with 'time' (in seconds relative to t_ref) and one
+            array per signal, all the same length
+    """
+    starts = [s['t0'][0] for d,s in signals.values()]
+    ends = [(s['t0']+s['n']*s['dt']).max() for d,s in signals.values()]
+    if t_ref == None:
+        t_ref = min(starts)
+    if start == None:
+        start = min(starts)-t_ref
+    if stop == None:
+        stop = max(ends)-t_ref
+    time = start+np.arange(int(np.floor((stop-start)*fs)))/float(fs)
+    table = {'time':time}
+    for name,(data,segments) in signals.items():
+        method = 'intervals' if name in interval_signals else 'linear'
+        table[name] = resample_signal(data,segments,time+t_ref,method,chunk)
+    return table
+
+def align_experiment(path,fs,start=None,stop=None,names=None,backend='hdf5',chunk=chunk_size):
+    """
+    Aligns the converted data from an experiment folder (see save_data.save_exp)
+    onto a common timebase. Time zero is the start of the first high-speed file,
+    which is also time zero for the stim times in stim_data.
+    Args:
+        -path: experiment folder
+        -fs: sample rate of the common timebase, in Hz
+        -start: start of the window, in seconds (default is the start of the recording)
+        -stop: end of the window, in seconds (default is the end of the recording)
+        -names: list of signal names to include (default is all of them)
+        -backend: format of the converted ephys/bp data ('hdf5' or 'zarr')
+        -chunk: number of output samples to compute at once
+    Returns:
+        -table: dictionary with 'time' and one array per signal (see align)
+    """
+    file_dict = tdms_files.sort_tdms(path)
+    if len(file_dict['lowspeed']) == 0:
+        file_dict['lowspeed'] = file_dict['highspeed']
+    t_ref = file_timing(tdms_files.order_files(file_dict['highspeed'])[0])[0]
+    signals = {}
+    handles = []
+    ##timing tables, by (kind,number of samples); every channel from the same files shares one
+    segments = {}
+    def timing(kind,n):
+        if not (kind,n) in segments:
+            segments[(kind,n)] = get_segments(file_dict[kind],kind,n)
+        return segments[(kind,n)]
+    for name,kind in data_sources:
+        if name in ['ephys_data','bp_data']:
+            fname = output_backends.output_path(path,name,backend)
+        else:
+            fname = output_backends.output_path(path,name)
+        if not os.path.exists(fname) or len(file_dict[kind]) == 0:
+            continue
+        f = output_backends.open_data(fname)
+        handles.append(f)
+        for chan in f:
+            if chan == 'intervals':
+                ##the stim on/off record
+                if names == None or 'z' in names:
+                    signals['z'] = (f[chan][:],timing(kind,int(f[chan].attrs['n_samples'])))
+                continue
+            if chan in ['time','start','stop','qc','beats'] or (names != None and not chan in names):
+                continue
+            if len(f[chan].shape) != 1:
+                continue
+            signals[chan] = (f[chan],timing(kind,f[chan].shape[0]))
+    try:
+        table = align(signals,fs,start,stop,t_ref,chunk)
+    finally:
+        for f in handles:
+            output_backends.close(f)
+    return table
@@ -15,7 +15,10 @@ def get_stim_window(data,start,stop,pad_min=10.0,fix_outliers=[0.25,5]):
     function to get data around the time of a stim block.
     Args:
         -data: dictionary of data arrays, including the time value. Can have different
-            sample rates as long as they were recorded synchronously. 
+            sample rates as long as they were recorded synchronously. Raw (compact) arrays
+            are scaled using data['scaling'] (see the process_* functions). Can also be an
+            experiment.Experiment (or a dictionary of its Signals), in which case only
+            the samples in the window are read.
         -start: start time, in ms, of stim block
         -stop: stop time, in ms, of stim block
         -pad_min = time, in min, before and after stim to pad the data windows
@@ -26,23 +29,78 @@ def get_stim_window(data,start,stop,pad_min=10.0,fix_outliers=[0.25,5]):
         -data: array of data that only includes the data windows requested, and also 
             has elements corresponding to the start, stop times (in ms) of the stim window.
     """
-    time = data['time']*1000.0 ##total time of recording, in ms
+    data = dict(data)
     pad = pad_min*60.0*1000.0 ##everything will be in ms for 
-    var = [x for x in list(data) if x !='time']
+    var = tf.data_chans(data)
+    ##raw (compact) channels are converted to real units before the outliers are removed
+    scalings = data.pop('scaling',{})
     for v in var:
         y = data[v]
-        if fix_outliers:
-            y = remove_outliers(y,max_perc_change=fix_outliers[0],max_sigma=fix_outliers[1])
-        tbase = np.linspace(0,time,y.size) ##the timebase/sample times for this data array
-        ##replace the data array in the dictionary with just the requested window
-        start_idx = np.where(tbase>start-pad)[0][0]
-        end_idx = np.where(tbase<stop+pad)[0][-1]
-        data[v] = y[start_idx:end_idx]
+        if scalings.get(v) != None and isinstance(y,np.ndarray):
+            y = tf.apply_scaling(y,scalings[v])
+        ##total time of recording, in ms (lazy signals know their own duration)
+        time = getattr(y,'duration',None) or data['time']
+        time = time*1000.0
+        start_idx,end_idx = window_indices(len(y),time,start-pad,stop+pad)
+        if isinstance(y,np.ndarray):
+            if fix_outliers:
+                y = remove_outliers(y,max_perc_change=fix_outliers[0],max_sigma=fix_outliers[1])
+            ##replace the data array in the dictionary with just the requested window
+            data[v] = y[start_idx:end_idx]
+        else:
+            ##lazy signal; only read the window
+            y = np.asarray(y[start_idx:end_idx],dtype=np.float64)
+            if fix_outliers:
+                y = remove_outliers(y,max_perc_change=fix_outliers[0],max_sigma=fix_outliers[1])
+            data[v] = y
     data['start'] = 0
     data['stop'] = stop-start
     data['pad'] = pad 
     return data
 
+def window_indices(n,time,t0,t1):
+    """
+    Finds the samples of a data array that fall inside a time window, in the same way
+    as get_stim_window. The timebase/sample times of the array are linspace(0,time,n);
+    the window is found without building the whole thing.
+    Args:
+        -n: number of samples in the array
+        -time: total time of the recording, in ms
+        -t0,t1: start and end of the window, in ms
+    Returns:
+        -start_idx,end_idx: the window is array[start_idx:end_idx]. The window is clipped
+            to the recording, so sample i is at time i*time/(n-1) (not always t0).
+    """
+    start_idx = max(int(np.floor(t0*(n-1)/time))+1,0)
+    end_idx = min(int(np.ceil(t1*(n-1)/time))-1,n-1)
+    return start_idx,end_idx
+
+def get_aligned_window(path,start,stop,fs,pad_min=10.0,names=None):
+    """
+    Like get_stim_window, but loads the data around a stim block from the converted
+    data files in an experiment folder, aligned onto a common timebase using the
+    start times and sample rates saved in the TDMS files (see alignment).
+    Args:
+        -path: experiment folder
+        -start: start time, in ms, of stim block
+        -stop: stop time, in ms, of stim block
+        -fs: sample rate of the common timebase, in Hz
+        -pad_min = time, in min, before and after stim to pad the data windows
+        -names: list of signal names to include (default is all of them)
+    Returns:
+        -data: dictionary of data arrays (all with the same timebase) that only includes
+            the data window requested, and also has elements corresponding to the start,
+            stop times (in ms) of the stim window.
+    """
+    import alignment
+    pad = pad_min*60.0*1000.0
+    data = alignment.align_experiment(path,fs,(start-pad)/1000.0,(stop+pad)/1000.0,names)
+    data['time'] = data['time']*1000.0-start
+    data['start'] = 0
+    data['stop'] = stop-start
+    data['pad'] = pad
+    return data
+
 def get_stim_info(path):
     """
     A function that looks at a experiment folder path, finds the
@@ -50,13 +108,18 @@ def get_stim_info(path):
     the clean stim information, including the binary stim on/off record,
     and the stim pulse onset/offset times.
     Args:
-        -path: folder path containing the experiment data
+        -path: folder path containing the experiment data, or an experiment.Experiment
+            (the converted stim data is used if it has any)
     Returns:
         data: dictionary with the following elements:
             -start: stim pulse onset times
             -stop: stim pulse offset times 
-            -z: binary stim on/off array spanning the fill recording time
+            -intervals: table of stim on/off sample intervals spanning the full
+                recording time (see stim_files.densify for the binary array)
     """
+    if getattr(path,'stim',None) != None:
+        return path.stim
+    path = getattr(path,'path',path)
     files = tf.search_files(path) ##dictionary of valid tdms files
     data = sf.process_stim(files['highspeed']) ##assume that the stim mon channel is always in the highspeed data set
     return data
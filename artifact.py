@@ -0,0 +1,168 @@
+##artifact.py
+
+##functions to remove stim artifacts from converted ephys data. A window around
+##every stim pulse onset (from the stim detector) is blanked or linearly
+##interpolated on all of the amp_N channels at once. The recording is processed
+##in chunks, with the chunk edges moved so that no blanking window is split
+##between two chunks, and the cleaned channels are written to a separate file
+##(ephys_clean) that can be used in place of ephys_data (ie for spike detection).
+
+import numpy as np
+import os
+import output_backends
+from tdms_files import apply_scaling
+
+##default number of samples to process at once
+chunk_size = 2**20
+
+##ways to fill the blanked windows
+methods = ['interp','zero']
+
+def blank_intervals(onsets,n_pre,n_post,n_samples):
+    """
+    Builds the table of windows to blank around each pulse, merging any that overlap.
+    Args:
+        -onsets: array of pulse onset samples
+        -n_pre: number of samples before each onset to blank
+        -n_post: number of samples after each onset to blank
+        -n_samples: length of the recording
+    Returns:
+        -intervals: n x 2 array of (first, one past last) samples of each window
+    """
+    onsets = np.sort(np.asarray(onsets,dtype=np.int64))
+    lo = np.clip(onsets-n_pre,0,n_samples)
+    hi = np.clip(onsets+n_post,0,n_samples)
+    ok = hi > lo
+    lo,hi = lo[ok],hi[ok]
+    if lo.size == 0:
+        return np.zeros((0,2),dtype=np.int64)
+    ##a window starts a new group unless it overlaps one of the windows before it
+    reach = np.maximum.accumulate(hi)
+    keep = np.hstack([[True],lo[1:]>reach[:-1]])
+    group = np.cumsum(keep)-1
+    ends = np.zeros(keep.sum(),dtype=np.int64)
+    np.maximum.at(ends,group,hi)
+    return np.stack([lo[keep],ends],axis=1)
+
+def chunk_bounds(intervals,n_samples,chunk=chunk_size):
+    """
+    Returns the sample boundaries of the chunks to process, with any boundary that
+    falls inside a blanking window moved to the end of that window.
+    """
+    bounds = np.arange(0,n_samples,chunk,dtype=np.int64)
+    if len(intervals) > 0:
+        idx = np.searchsorted(intervals[:,0],bounds,side='right')-1
+        inside = (idx>=0)&(bounds<intervals[np.maximum(idx,0),1])
+        bounds[inside] = intervals[idx[inside],1]
+    return np.unique(np.hstack([bounds,[n_samples]]))
+
+def blank_chunk(x,intervals,method='interp'):
+    """
+    Blanks windows in a chunk of data, in place, on all channels at once.
+    Args:
+        -x: channels x samples array
+        -intervals: n x 2 array of windows to blank, in samples from the start of x
+            (windows must not run past the end of x)
+        -method: 'interp' to draw a straight line between the samples on either side of
+            each window, or 'zero' to set the window to 0
+    """
+    assert method in methods, "Unknown blanking method: "+str(method)
+    if len(intervals) == 0:
+        return
+    lo,hi = intervals[:,0],intervals[:,1]
+    lengths = hi-lo
+    ##sample indices of every window, and the window each one belongs to
+    owner = np.repeat(np.arange(lo.size),lengths)
+    idx = lo[owner]+np.arange(owner.size)-np.repeat(np.cumsum(lengths)-lengths,lengths)
+    if method == 'zero':
+        x[:,idx] = 0
+        return
+    size = x.shape[1]
+    ##use the sample on the other side if a window touches the edge of the chunk
+    left = np.where(lo>0,lo-1,np.minimum(hi,size-1))
+    right = np.where(hi<size,hi,left)
+    span = (right-left).astype(np.float64)
+    frac = np.where(span[owner]>0,(idx-left[owner])/np.maximum(span[owner],1.0),0.0)
+    x0 = x[:,left[owner]]
+    x[:,idx] = x0+frac*(x[:,right[owner]]-x0)
+    ##nothing to interpolate from if a window covers the whole chunk
+    empty = (lo==0)&(hi>=size)
+    if empty.any():
+        x[:,idx[empty[owner]]] = 0
+
+def save_clean(ephys_path,onsets=None,path_out=None,pre=0.5,post=2.0,method='interp',
+    chunk=chunk_size):
+    """
+    Blanks the stim artifacts in a converted ephys data file, and saves the cleaned
+    channels (plus 'time' and the 'blanked' windows) to ephys_clean.
+    Args:
+        -ephys_path: full path to the ephys_data.hdf5 (or .zarr) file
+        -onsets: array of pulse onset times in seconds. If None, every pulse onset is
+            found from the stim channel of the high-speed TDMS files (see get_onsets).
+            Note that the stim_data 'start' times are train onsets, not pulses.
+        -path_out: optional alternative folder to save the cleaned data to
+        -pre: time, in ms, before each pulse onset to blank
+        -post: time, in ms, after each pulse onset to blank
+        -method: 'interp' or 'zero' (see blank_chunk)
+        -chunk: number of samples to process at once
+    Returns:
+        -path_out: full path of the cleaned data file
+    """
+    folder = os.path.dirname(ephys_path)
+    if path_out == None:
+        path_out = folder
+    backend = 'zarr' if ephys_path.endswith('.zarr') else 'hdf5'
+    path_out = output_backends.output_path(path_out,'ephys_clean',backend)
+    if onsets is None:
+        onsets = get_onsets(folder)
+    f_in = output_backends.open_data(ephys_path)
+    chans = [x for x in list(f_in) if x.startswith('amp_')]
+    n = f_in[chans[0]].shape[0]
+    fs = n/float(f_in['time'][()])
+    scalings = {}
+    for c in chans:
+        attrs = f_in[c].attrs
+        scalings[c] = (attrs['scale'],attrs['offset']) if 'scale' in attrs else None
+    intervals = blank_intervals(np.round(np.asarray(onsets)*fs),int(np.round(pre*fs/1000.0)),
+        int(np.round(post*fs/1000.0)),n)
+    f_out = output_backends.open_output(path_out,backend,'w')
+    for c in chans:
+        dtype = f_in[c].dtype if scalings[c] == None and f_in[c].dtype.kind == 'f' else 'float32'
+        output_backends.create_channel(f_out,c,n,dtype)
+    bounds = chunk_bounds(intervals,n,chunk)
+    for c0,c1 in zip(bounds[:-1],bounds[1:]):
+        ##read one extra sample on each side to interpolate from
+        r0,r1 = max(c0-1,0),min(c1+1,n)
+        x = np.vstack([apply_scaling(f_in[c][r0:r1],scalings[c],np.float64) for c in chans])
+        first,last = np.searchsorted(intervals[:,0],[c0,c1])
+        blank_chunk(x,intervals[first:last]-r0,method)
+        for i,c in enumerate(chans):
+            f_out[c][c0:c1] = x[i,c0-r0:c1-r0]
+    f_out.create_dataset("time",data=np.asarray(f_in['time'][()]))
+    dset = f_out.create_dataset("blanked",data=intervals)
+    dset.attrs['pre'] = pre
+    dset.attrs['post'] = post
+    dset.attrs['method'] = method
+    output_backends.close(f_out)
+    output_backends.close(f_in)
+    return path_out
+
+def get_onsets(folder):
+    """
+    Returns the onset time, in seconds, of every individual stim pulse in an experiment
+    folder (see stim_files.find_pulses), read from the stim channel of the high-speed
+    TDMS files one file at a time
+    """
+    import stim_files
+    from tdms_files import search_files, order_files, prefetch, open_tdms
+    onsets = []
+    offset = 0
+    for f in prefetch(order_files(search_files(folder)['highspeed'])):
+        channel_object = stim_files.get_stim_channel(open_tdms(f))
+        stim = channel_object.data
+        fs = 1.0/channel_object.properties['wf_increment']
+        onsets.append((stim_files.find_pulses(stim)+offset)/fs)
+        offset += stim.size
+    if len(onsets) == 0:
+        return np.zeros(0)
+    return np.hstack(onsets)
@@ -0,0 +1,128 @@
+##beats.py
+
+##beat-by-beat analysis of the BP pulse waveform (pulse_wf). Beats are found
+##with a slope sum function (the sum of the rising slope over a short window,
+##which peaks on each systolic upstroke), and each beat runs from the foot of
+##one upstroke to the foot of the next. The detector works a chunk at a time
+##and carries its state (threshold, the unfinished beat) from one chunk to the
+##next, so a whole recording can be processed at full rate one file at a time.
+
+import numpy as np
+
+##shortest and longest beat intervals to accept, in seconds
+min_ibi = 0.1
+max_ibi = 2.0
+
+##width of the slope sum window, in seconds
+ssf_window = 0.128
+
+##how far before each upstroke to look for its foot, in seconds
+foot_window = 0.1
+
+##detection threshold, as a fraction of the upstroke size in each chunk
+thresh_frac = 0.5
+
+##fields of the beat table
+beat_dtype = [('time','f8'),('systolic','f4'),('diastolic','f4'),('mean','f4'),('ibi','f4')]
+
+def new_detector(fs):
+    """
+    Returns a beat detector for a pulse waveform sampled at fs Hz
+    """
+    return {'fs':fs,'buf':np.zeros(0),'gap':np.zeros(0,dtype=bool),'buf_start':0,'next':0,
+        'thresh':None,'last_cross':-np.inf,'last_foot':None,
+        'w':max(int(np.round(ssf_window*fs)),1),
+        'min_ibi':int(np.round(min_ibi*fs)),
+        'max_ibi':int(np.round(max_ibi*fs)),
+        'foot':max(int(np.round(foot_window*fs)),1)}
+
+def update(det,y):
+    """
+    Runs the beat detector on the next chunk of the waveform.
+    Args:
+        -det: detector from new_detector
+        -y: next chunk of the pulse waveform (in mmHg)
+    Returns:
+        -table: structured array (see beat_dtype) of the beats completed in this chunk:
+            -time: time of the start (foot) of the beat, in seconds from the start of the recording
+            -systolic: peak pressure of the beat
+            -diastolic: pressure at the foot of the beat
+            -mean: mean pressure over the beat
+            -ibi: time to the next beat, in seconds
+    """
+    if len(y) == 0:
+        return np.zeros(0,dtype=beat_dtype)
+    start = det['buf_start']
+    y = np.array(y,dtype=np.float64)
+    ##fill dropouts (NaNs) with the last good value, and keep track of where they were
+    nan = np.isnan(y)
+    if nan.any():
+        last = np.maximum.accumulate(np.where(nan,-1,np.arange(y.size)))
+        prev = det['buf'][-1] if det['buf'].size > 0 else np.nan
+        y = np.where(last>=0,y[np.maximum(last,0)],prev)
+        y[np.isnan(y)] = 0.0
+    x = np.hstack([det['buf'],y])
+    gap = np.hstack([det['gap'],nan])
+    end = start+x.size
+    new = det['next']-start
+    ##slope sum function
+    c = np.cumsum(np.clip(np.diff(x,prepend=x[:1]),0,None))
+    ssf = c.copy()
+    ssf[det['w']:] -= c[:-det['w']]
+    ##update the threshold from the good samples in this chunk
+    good = ssf[new:][~gap[new:]]
+    if good.size > 0:
+        thresh = thresh_frac*np.nanpercentile(good,99)
+        if np.isfinite(thresh) and thresh > 0:
+            if det['thresh'] != None:
+                thresh = 0.5*(det['thresh']+thresh)
+            det['thresh'] = thresh
+    thresh = det['thresh']
+    if thresh == None:
+        cross = np.zeros(0,dtype=np.int64)
+    else:
+        cross = np.flatnonzero((ssf[1:]>=thresh)&(ssf[:-1]<thresh))+1
+        cross = cross[cross>=max(new,1)]
+    ##apply the refractory period, and find the foot before each upstroke
+    feet = []
+    for i in cross:
+        if i+start-det['last_cross'] < det['min_ibi']:
+            continue
+        det['last_cross'] = i+start
+        lo = max(i-det['foot'],0)
+        feet.append(lo+int(np.argmin(x[lo:i+1])))
+    if det['last_foot'] != None:
+        feet = [det['last_foot']-start]+feet
+    feet = np.array(feet,dtype=np.int64)
+    ##a foot found at or before the previous one (ie a double upstroke) doesn't start a new beat
+    if feet.size > 1:
+        feet = feet[np.hstack([[True],feet[1:]>np.maximum.accumulate(feet)[:-1]])]
+    table = np.zeros(0,dtype=beat_dtype)
+    if feet.size > 1:
+        seg = x[:feet[-1]]
+        lengths = np.diff(feet)
+        table = np.zeros(lengths.size,dtype=beat_dtype)
+        table['time'] = (feet[:-1]+start)/float(det['fs'])
+        table['systolic'] = np.maximum.reduceat(seg,feet[:-1])
+        table['diastolic'] = x[feet[:-1]]
+        table['mean'] = np.add.reduceat(seg,feet[:-1])/lengths
+        table['ibi'] = lengths/float(det['fs'])
+        ##drop beats that run through a dropout
+        dropout = np.logical_or.reduceat(gap[:feet[-1]],feet[:-1])
+        table = table[(lengths>=det['min_ibi'])&(lengths<=det['max_ibi'])&~dropout]
+    if feet.size > 0:
+        det['last_foot'] = feet[-1]+start
+    ##give up on a beat that hasn't ended (ie during a dropout)
+    if det['last_foot'] != None and end-det['last_foot'] > det['max_ibi']:
+        det['last_foot'] = None
+    ##keep enough of the waveform for the next chunk's slope sum and foot search,
+    ##plus the unfinished beat
+    keep = end-max(det['w'],det['foot'])-1
+    if det['last_foot'] != None:
+        keep = min(keep,det['last_foot'])
+    keep = max(keep,start)
+    det['buf'] = x[keep-start:]
+    det['gap'] = gap[keep-start:]
+    det['buf_start'] = keep
+    det['next'] = end
+    return table
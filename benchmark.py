@@ -0,0 +1,263 @@
+##benchmark.py
+
+##benchmark harness for the conversion/analysis functions. Writes synthetic
+##data sets for each rig layout (see synth_tdms), times each processing step
+##in a fresh process, and appends the results to a JSON history file so that
+##changes in performance can be caught.
+
+##usage: python benchmark.py [--layouts rig1_2.1 rig2_3.0] [--n-files 4] [--file-seconds 60]
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing as mp
+from queue import Empty
+import synth_tdms
+
+##default location of the results history
+history_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),'bench_history.json')
+
+##longest a single case may run before it is stopped, in seconds
+case_timeout = 3600.0
+
+def get_cases(file_dict,info,out_dir):
+    """
+    Returns the list of benchmark cases that apply to one data set.
+    Args:
+        -file_dict: dictionary of sorted data files (from tdms_files.sort_tdms)
+        -info: data set info returned by synth_tdms.make_dataset
+        -out_dir: folder to write the converted data to
+    Returns:
+        -cases: list of (case name, input files, args) tuples
+    """
+    if len(file_dict['lowspeed']) > 0:
+        bp_files = file_dict['lowspeed']
+    else:
+        bp_files = file_dict['highspeed']
+    has_stim = 'rig2_2.0' not in info['layout'] ##this build doesn't record the stim monitor
+    cases = [
+        ('save_ephys',file_dict['highspeed'],(file_dict['highspeed'],out_dir)),
+        ('save_bp',bp_files,(bp_files,out_dir)),
+        ('save_physio',file_dict['physio'],(file_dict['physio'],out_dir))
+    ]
+    if has_stim:
+        cases += [
+            ('save_stim',file_dict['highspeed'],(file_dict['highspeed'],out_dir)),
+            ('get_period',file_dict['highspeed'],(file_dict['highspeed'],)),
+        ]
+    cases.append(('get_stim_window',bp_files,
+        (bp_files,info['stim_start']*1000.0,info['stim_stop']*1000.0)))
+    return cases
+
+def run_case(name,args,queue):
+    """
+    Runs a single benchmark case (in a child process), and puts the wall time
+    and peak memory use into the queue.
+    Args:
+        -name: case name (see get_cases)
+        -args: arguments for the case
+        -queue: multiprocessing queue for the results
+    """
+    ##always time the real processing, not a cached result
+    import cache
+    cache.enabled = False
+    if name == 'save_ephys':
+        from ephys_files import save_ephys
+        t0 = time.perf_counter()
+        save_ephys(args[0],path_out=args[1])
+    elif name == 'save_bp':
+        from bp_files import save_bp
+        t0 = time.perf_counter()
+        save_bp(args[0],path_out=args[1])
+    elif name == 'save_physio':
+        from physio_files import save_physio
+        t0 = time.perf_counter()
+        save_physio(args[0],path_out=args[1])
+    elif name == 'save_stim':
+        from stim_files import save_stim
+        t0 = time.perf_counter()
+        save_stim(args[0],path_out=args[1])
+    elif name == 'get_period':
+        from stim_period import get_period
+        t0 = time.perf_counter()
+        get_period(args[0])
+    elif name == 'get_stim_window':
+        ##the loading is timed too, so the MB/s (of the bp input files) is comparable
+        ##with the other cases
+        from bp_files import process_bp
+        from analysis import get_stim_window
+        t0 = time.perf_counter()
+        data = process_bp(args[0],resample=100)
+        get_stim_window(data,args[1],args[2],pad_min=0.1)
+    wall = time.perf_counter()-t0
+    queue.put({'wall_s':wall,'peak_rss_mb':max(_maxrss_mb(resource.RUSAGE_SELF),
+        _maxrss_mb(resource.RUSAGE_CHILDREN))})
+
+def _maxrss_mb(who):
+    """
+    Peak resident memory, in MB, of this process (or its children)
+    """
+    rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss/1e6 ##bytes on mac
+    return rss/1e3 ##kB on linux
+
+def run_benchmarks(layouts=None,n_files=4,file_seconds=60.0,data_dir=None):
+    """
+    Generates the synthetic data sets and runs each benchmark case in a separate process
+    (so that the peak memory numbers aren't polluted by earlier cases).
+    Args:
+        -layouts: list of layout names to benchmark (default is all of them)
+        -n_files: number of files per recording
+        -file_seconds: duration of each file, in seconds
+        -data_dir: folder to write the synthetic data to. If None, a temporary folder
+            is used and deleted afterwards.
+    Returns:
+        -results: list of result dictionaries
+    """
+    from tdms_files import sort_tdms
+    if layouts == None:
+        layouts = sorted(synth_tdms.layouts)
+    cleanup = data_dir == None
+    if cleanup:
+        data_dir = tempfile.mkdtemp(prefix='bench_')
+    results = []
+    try:
+        for layout in layouts:
+            d = os.path.join(data_dir,layout.replace('.','_'))
+            print("Generating {} data set...".format(layout))
+            info = synth_tdms.make_dataset(layout,d,n_files=n_files,file_seconds=file_seconds)
+            out_dir = os.path.join(d,'out')
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            file_dict = sort_tdms(d)
+            for name,files,args in get_cases(file_dict,info,out_dir):
+                input_mb = sum([os.path.getsize(x) for x in files])/1e6
+                queue = mp.Queue()
+                p = mp.Process(target=run_case,args=(name,args,queue))
+                p.start()
+                result = _wait_result(name,p,queue)
+                result.update({'layout':layout,'case':name,'input_mb':input_mb,
+                    'mb_per_s':input_mb/result['wall_s']})
+                print("{layout:>10} {case:>16}: {wall_s:8.2f} s {mb_per_s:8.1f} MB/s {peak_rss_mb:8.0f} MB peak".format(**result))
+                results.append(result)
+    finally:
+        if cleanup:
+            shutil.rmtree(data_dir)
+    return results
+
+def _wait_result(name,p,queue,timeout=None):
+    """
+    Waits for the result of a benchmark case from its process, checking that the
+    process is still running. Raises a RuntimeError if the process exits without
+    sending a result (ie it crashed or was killed for running out of memory) or
+    takes longer than timeout seconds (default is case_timeout).
+    """
+    if timeout == None:
+        timeout = case_timeout
+    t0 = time.time()
+    while True:
+        try:
+            result = queue.get(timeout=1.0)
+            break
+        except Empty:
+            pass
+        if not p.is_alive():
+            ##the result may have arrived just before the process exited
+            try:
+                result = queue.get(timeout=1.0)
+                break
+            except Empty:
+                raise RuntimeError("Benchmark case {} exited without a result (exit code {})".format(
+                    name,p.exitcode))
+        if time.time()-t0 > timeout:
+            p.terminate()
+            p.join()
+            raise RuntimeError("Benchmark case {} timed out after {} s".format(name,timeout))
+    p.join()
+    return result
+
+def save_history(results,params,path=None):
+    """
+    Appends a benchmark run to the JSON history file.
+    Args:
+        -results: list of result dictionaries from run_benchmarks
+        -params: dictionary of the parameters used for the run
+        -path: history file to append to
+    Returns:
+        -history: the full list of runs, including this one
+    """
+    if path == None:
+        path = history_file
+    if os.path.exists(path):
+        with open(path) as f:
+            history = json.load(f)
+    else:
+        history = []
+    try:
+        commit = subprocess.check_output(['git','rev-parse','--short','HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError,OSError):
+        commit = None
+    history.append({
+        'timestamp':time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit':commit,
+        'host':socket.gethostname(),
+        'python':platform.python_version(),
+        'params':params,
+        'results':results
+    })
+    with open(path,'w') as f:
+        json.dump(history,f,indent=2)
+    return history
+
+def check_regressions(history,tolerance=0.2):
+    """
+    Compares the latest run in the history against the most recent earlier run
+    with the same parameters on the same host.
+    Args:
+        -history: list of runs (see save_history)
+        -tolerance: fractional slow-down (or memory increase) to flag
+    Returns:
+        -regressions: list of (layout, case, metric, old value, new value) tuples
+    """
+    latest = history[-1]
+    previous = [x for x in history[:-1] if x['params'] == latest['params'] and x['host'] == latest['host']]
+    regressions = []
+    if len(previous) == 0:
+        return regressions
+    old = {(x['layout'],x['case']):x for x in previous[-1]['results']}
+    for r in latest['results']:
+        key = (r['layout'],r['case'])
+        if not key in old:
+            continue
+        for metric in ['wall_s','peak_rss_mb']:
+            if r[metric] > old[key][metric]*(1+tolerance):
+                regressions.append((r['layout'],r['case'],metric,old[key][metric],r[metric]))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the TDMS conversion functions on synthetic data")
+    parser.add_argument('--layouts',nargs='+',default=None,choices=sorted(synth_tdms.layouts))
+    parser.add_argument('--n-files',type=int,default=4)
+    parser.add_argument('--file-seconds',type=float,default=60.0)
+    parser.add_argument('--data-dir',default=None,help="keep the synthetic data in this folder")
+    parser.add_argument('--history',default=None,help="JSON history file (default: bench_history.json)")
+    parser.add_argument('--tolerance',type=float,default=0.2)
+    args = parser.parse_args()
+    params = {'layouts':args.layouts,'n_files':args.n_files,'file_seconds':args.file_seconds}
+    results = run_benchmarks(args.layouts,args.n_files,args.file_seconds,args.data_dir)
+    history = save_history(results,params,args.history)
+    regressions = check_regressions(history,args.tolerance)
+    for layout,case,metric,old,new in regressions:
+        print("REGRESSION: {} {} {} {:.2f} -> {:.2f}".format(layout,case,metric,old,new))
+    sys.exit(1 if len(regressions) > 0 else 0)
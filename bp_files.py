@@ -6,15 +6,22 @@
 
 import numpy as np
 import h5py
-import nptdms
 import os
-from tdms_files import downsample, get_duration_seconds, order_files
+from tdms_files import downsample, downsample_array, get_duration_seconds, order_files, get_n_samples, resampled_length
+from tdms_files import open_tdms, load_channel, load_channels, map_channels, file_lengths, concat_files, apply_scaling, stack_channel, set_scaling_attrs, prefetch
 import multiprocessing as mp
+import tdms_files
+import profiling
+import output_backends
+import pipeline
+import cache
+import qc_stats
+import beats
 
 ##list of channel names in blood pressure data
 bp_chans = ['mean_bp','systolic_bp','diastolic_bp','pulse_wf']
 
-def save_bp(files,path_out=None,resample=False,load_time=True):
+def save_bp(files,path_out=None,resample=False,load_time=True,backend='hdf5',pipelined=False,compact=False):
     """
     Function to create hdf5 file from bp monitor data.
     Args:
@@ -23,6 +30,12 @@ def save_bp(files,path_out=None,resample=False,load_time=True):
             not specified, file is saved in same location as input files.
         -resample: if a number, resamples to 'resample' Hz
         -load_time: if True, loads the duration of the recording in seconds
+        -backend: 'hdf5', or 'zarr' to save to a zarr directory store, with
+            each file written directly by the pool worker that loads it
+        -pipelined: if True, reading, resampling and writing are overlapped
+            (see save_bp_pipelined)
+        -compact: if True, saves the raw integer samples with 'scale' and 'offset'
+            attributes where the files have them, and float32 otherwise
     Returns:
         None; data saved in specified location
     """
@@ -32,16 +45,208 @@ def save_bp(files,path_out=None,resample=False,load_time=True):
     ##create the output data file
     if path_out == None:
         path_out = os.path.dirname(files[0])
+    if pipelined:
+        save_bp_pipelined(files,output_backends.output_path(path_out,'bp_data',backend),
+            resample,load_time,backend,compact)
+        return
+    if backend != 'hdf5':
+        save_bp_parallel(files,output_backends.output_path(path_out,'bp_data',backend),
+            resample,load_time,backend,compact)
+        return
     path_out = os.path.join(path_out,'bp_data.hdf5')
     f_out = h5py.File(path_out,'w')
-    dsets = load_bp_mp(files,resample,load_time)
+    dsets = load_bp_mp(files,resample,load_time,compact,qc=True)
+    qc = [x.pop('qc') for x in dsets]
     for chan in bp_chans:
-        f_out.create_dataset(chan,data=np.hstack([x[chan] for x in dsets]))
+        with profiling.span('hstack') as rec:
+            chan_data,scaling = stack_channel(dsets,chan)
+            rec['samples'] = chan_data.size
+        with profiling.span('hdf5_write',path_out) as rec:
+            dset = f_out.create_dataset(chan,data=chan_data)
+            set_scaling_attrs(dset,scaling)
+            rec['bytes_written'] = chan_data.nbytes
     if load_time:
         times = [x['time'] for x in dsets]
         f_out.create_dataset("time",data=np.asarray(np.sum(times)))
+    qc_stats.write_qc(f_out,qc,files)
     f_out.close()
 
+def save_bp_parallel(files,path_out,resample=False,load_time=True,backend='zarr',compact=False):
+    """
+    Function to save bp data with a backend that supports parallel writes. The
+    arrays are sized up front from the file headers, and each pool worker writes
+    its file's data into its own region of the arrays.
+    Args:
+        -files: ordered list of bp file paths
+        -path_out: full path of the output data file
+        -resample: if a number, resamples to 'resample' Hz
+        -load_time: if True, saves the duration of the recording in seconds
+        -backend: output backend (see output_backends)
+        -compact: if True, the data is saved as float32
+    Returns:
+        None; data saved in specified location
+    """
+    global bp_chans
+    lengths = []
+    for f in files:
+        n_samples,fs = get_n_samples(f)
+        lengths.append(resampled_length(n_samples[bp_chans[0]],fs[bp_chans[0]],resample))
+    offsets = np.hstack([0,np.cumsum(lengths)])
+    f_out = output_backends.open_output(path_out,backend,'w')
+    for chan in bp_chans:
+        output_backends.create_channel(f_out,chan,offsets[-1],
+            'float32' if compact else 'float64')
+    args = []
+    for i,p in enumerate(files):
+        args.append((p,path_out,offsets[i],resample,load_time,i,compact))
+    with mp.Pool(tdms_files.n_procs) as p:
+        result = p.starmap(write_bp,args)
+    if load_time:
+        f_out.create_dataset("time",data=np.asarray(np.sum([x[0] for x in result])))
+    qc_stats.write_qc(f_out,[x[1] for x in result],files)
+    output_backends.close(f_out)
+    output_backends.remove_sync(path_out)
+
+def save_bp_pipelined(files,path_out,resample=False,load_time=True,backend='hdf5',compact=False):
+    """
+    Function to save bp data using the pipelined engine: files are decoded
+    by reader processes, resampled by worker processes and appended to the
+    output file in order by this process, all at the same time.
+    Args:
+        -files: ordered list of bp file paths
+        -path_out: full path of the output data file
+        -resample: if a number, resamples to 'resample' Hz
+        -load_time: if True, saves the duration of the recording in seconds
+        -backend: output backend (see output_backends)
+        -compact: if True, the data is saved as float32
+    Returns:
+        None; data saved in specified location
+    """
+    global bp_chans
+    f_out = output_backends.open_output(path_out,backend,'w')
+    times = []
+    qc = []
+    def write(index,result):
+        data,file_qc = result
+        for chan in bp_chans:
+            output_backends.append_channel(f_out,chan,data[chan])
+        times.append(data['time'])
+        qc.append(file_qc)
+    pipeline.run_pipeline(files,read_bp,compute_bp,write,compute_args=(resample,compact))
+    if load_time:
+        f_out.create_dataset("time",data=np.asarray(np.sum(times)))
+    qc_stats.write_qc(f_out,qc,files)
+    output_backends.close(f_out)
+
+def save_beats(files,path_out=None,backend='hdf5',chunk_size=10.0):
+    """
+    Runs beat-by-beat detection on the full-rate pulse waveform and saves the
+    beat table to the 'beats' dataset of the bp data file (see beats.update for the fields).
+    The files are read one at a time, and the detector state is carried across files.
+    Args:
+        -files: iterable of bp monitor file paths from one experiment (TDMS files)
+        -path_out: optional alternative folder of the bp data file. If
+            not specified, the file is in the same location as the input files.
+        -backend: format of the bp data file ('hdf5' or 'zarr'); it is created if it doesn't exist
+        -chunk_size: amount of waveform to process at once, in seconds
+    Returns:
+        -table: the beat table
+    """
+    files = order_files(files)
+    if path_out == None:
+        path_out = os.path.dirname(files[0])
+    path_out = output_backends.output_path(path_out,'bp_data',backend)
+    det = None
+    tables = [np.zeros(0,dtype=beats.beat_dtype)]
+    for f in prefetch(files):
+        with profiling.span('beats',f) as rec:
+            channel_object = open_tdms(f).object('Group Name','pulse_wf')
+            if det == None:
+                det = beats.new_detector(1.0/channel_object.properties['wf_increment'])
+            y = channel_object.data
+            n = max(int(chunk_size*det['fs']),1)
+            for c in range(0,y.size,n):
+                ##convert to mmHg
+                tables.append(beats.update(det,y[c:c+n]*100.0))
+            rec['samples'] = y.size
+    table = np.concatenate(tables)
+    f_out = output_backends.open_output(path_out,backend,'a')
+    if 'beats' in f_out:
+        del f_out['beats']
+    dset = f_out.create_dataset('beats',data=table)
+    dset.attrs['fs'] = det['fs'] if det != None else 0.0
+    dset.attrs['min_ibi'] = beats.min_ibi
+    dset.attrs['max_ibi'] = beats.max_ibi
+    output_backends.close(f_out)
+    return table
+
+def read_bp(path):
+    """
+    Reader stage for save_bp_pipelined: decodes the bp channels in a file.
+    Args:
+        -path: full path to the datafile
+    Returns:
+        -data: dictionary of raw data arrays
+        -fs: sample rate of the data
+    """
+    global bp_chans
+    tdms_file = open_tdms(path)
+    data = {}
+    for chan in bp_chans:
+        channel_object = tdms_file.object('Group Name',chan)
+        data[chan] = channel_object.data
+    return data, 1.0/channel_object.properties['wf_increment']
+
+def compute_bp(item,resample=False,compact=False):
+    """
+    Compute stage for save_bp_pipelined: resamples the data from read_bp.
+    Args:
+        -item: (data,fs) tuple from read_bp
+        -resample: if a number, resamples to 'resample' Hz
+        -compact: if True, converts the data to float32
+    Returns:
+        -data: dictionary of data arrays, plus the duration in seconds ('time')
+        -qc: QC statistics for each channel (see qc_stats.file_qc)
+    """
+    data,fs = item
+    ##QC is computed on the samples as recorded, before they are resampled
+    chans = list(data)
+    qc = qc_stats.file_qc(dict(data,time=data[chans[0]].size/fs),'bp')
+    result = {}
+    def resample_chan(chan):
+        y = data[chan]
+        if resample:
+            y = downsample_array(y,fs,resample)
+        if compact:
+            y = y.astype(np.float32)
+        return y
+    ##resample the channels in parallel
+    for chan,y in zip(chans,map_channels(resample_chan,chans)):
+        result[chan] = y
+    result['time'] = data[chan].size/fs
+    return result, qc
+
+def write_bp(path,path_out,offset,resample=False,load_time=True,index=0,compact=False):
+    """
+    Pool worker for save_bp_parallel: loads one bp file and
+    writes it into the output arrays, starting at 'offset'.
+    Returns:
+        -time: duration of this file in seconds (or 0 if load_time is False)
+        -qc: QC statistics for each channel (see qc_stats.file_qc)
+    """
+    global bp_chans
+    data,index = load_bp(path,resample,load_time,index,compact,qc=True)
+    qc = data.pop('qc')
+    if compact:
+        ##the output arrays are float32, so raw samples need to be scaled first
+        regions = dict([(chan,apply_scaling(data[chan],data['scaling'][chan])) for chan in bp_chans])
+    else:
+        regions = dict([(chan,data[chan]) for chan in bp_chans])
+    with profiling.span('zarr_write',path) as rec:
+        output_backends.write_region(path_out,regions,offset)
+        rec['bytes_written'],rec['samples'] = profiling.nbytes(regions)
+    return data.get('time',0), qc
+
 def save_bp2(files, path_out=None, resample=False, load_time=True):
     """
     Function to create hdf5 file from bp monitor data.
@@ -77,7 +282,8 @@ def save_bp2(files, path_out=None, resample=False, load_time=True):
 
 
 
-def process_bp(files,resample=False,load_time=True):
+@cache.cached
+def process_bp(files,resample=False,load_time=True,compact=False,mmap=None):
     """
     A function to load the contents of all bp monitor
     files from one experiment folder into memory
@@ -85,22 +291,37 @@ def process_bp(files,resample=False,load_time=True):
         -files: list of files to load/concatinate
         -resample: if a number, resamples to 'resample' Hz
         -load_time: if True, loads the duration of the recording in seconds
+        -compact: if True, keeps raw integer samples where the files have them
+            (and float32 otherwise). The (scale,offset) of each raw channel, already
+            including the conversion to mmHg, is returned in dsets['scaling'].
+        -mmap: optional folder; if given, the data arrays are np.memmap files in it
     Returns:
         -dsets: full concatinated data sets
     """
     global bp_chans
     files = order_files(files)
-    tdms = []
-    dsets = {}
-    tdms = load_bp_mp(files,resample,load_time)
+    scalings = {}
+    ##size the output from the file headers, and fill it as each file is loaded
+    lengths = file_lengths(files,bp_chans[0],resample)
+    with profiling.span('fill') as rec:
+        tdms,file_scalings = concat_files(iter_bp_mp(files,resample,load_time,compact),lengths,mmap)
+        rec['samples'] = profiling.nbytes(tdms)[1]
+    dsets = dict([(chan,tdms[chan]) for chan in bp_chans])
     for chan in bp_chans:
-        dsets[chan] = np.hstack([x[chan] for x in tdms])*100.0 ##convert to mmHg
+        ##convert to mmHg; in place, or through the scaling for raw samples
+        scaling = file_scalings[chan]
+        if scaling == None:
+            dsets[chan] *= 100.0
+            scalings[chan] = None
+        else:
+            scalings[chan] = (scaling[0]*100.0,scaling[1]*100.0)
+    if compact:
+        dsets['scaling'] = scalings
     if load_time:
-        times = [x['time'] for x in tdms]
-        dsets['time'] = np.sum(times)
+        dsets['time'] = tdms['time']
     return dsets
 
-def load_bp(path,resample=False,load_time=True,index=0):
+def load_bp(path,resample=False,load_time=True,index=0,compact=False,qc=False):
     """
     A function to load data from blood pressure monitors, and
     resample them to a lower rate if necessary
@@ -109,25 +330,37 @@ def load_bp(path,resample=False,load_time=True,index=0):
         -resample: if False, loads the full dataset. If a number is given,
             it will resample the data to roughly that sample rate (in Hz)
         -load_time: if True, loads the duration of the recording in seconds
+        -compact: if True, loads raw integer samples (or float32) instead of
+            float64; see tdms_files.load_channel. The scaling of each channel
+            is returned in data['scaling'].
+        -qc: if True, the QC statistics of each channel (see qc_stats.tdms_qc), computed
+            at the full sample rate, are returned in data['qc']
     Returns:
         -data: dictionary with labeled data arrays
     """
     global bp_chans
     ##load the file
-    tdms_file = nptdms.TdmsFile(path)
+    with profiling.span('tdms_decode',path) as rec:
+        tdms_file = open_tdms(path)
+        rec['bytes_read'] = os.path.getsize(path)
     data = {}
-    for chan in bp_chans:
-        channel_object = tdms_file.object('Group Name',chan)
-        if resample:
-            chan_data = downsample(channel_object,resample)
-        else:
-            chan_data = channel_object.data
-        data[chan] = chan_data
+    scalings = {}
+    channel_objects = [tdms_file.object('Group Name',chan) for chan in bp_chans]
+    channel_object = channel_objects[-1]
+    ##resample the channels in parallel
+    for chan,(y,scaling) in zip(bp_chans,load_channels(channel_objects,resample,compact)):
+        data[chan],scalings[chan] = y,scaling
+    if qc:
+        with profiling.span('qc_stats',path):
+            data['qc'] = qc_stats.tdms_qc(channel_objects,bp_chans,'bp',
+                get_duration_seconds(channel_object))
+    if compact:
+        data['scaling'] = scalings
     if load_time:
         data['time'] = get_duration_seconds(channel_object)
     return data, index
 
-def load_bp_mp(paths,resample=False,load_time=True):
+def load_bp_mp(paths,resample=False,load_time=True,compact=False,qc=False):
     """
     Function to distribute the loading of multiple files
     across multiple cores.
@@ -135,19 +368,46 @@ def load_bp_mp(paths,resample=False,load_time=True):
         -paths: ordered list of file paths where data is stored
         -resample: if a number, resamples the data to 'resample' Hz
         -load_time: if True, includes the duration of the recording in seconds
+        -compact: if True, loads raw integer samples (or float32); see load_bp
+        -qc: if True, includes the full-rate QC statistics; see load_bp
     Returns:
         -dsets: ordered list of data dictionaries containing the files
     """
     ##create the argument lists for each version of the function
     args = []
     for i,p in enumerate(paths):
-        args.append((p,resample,load_time,i))
+        args.append((p,resample,load_time,i,compact,qc))
     ##now apply the pool to the function
-    with mp.Pool(3) as p:
-        result = p.starmap(load_bp,args)
+    with profiling.span('load_pool') as rec:
+        if mp.current_process().daemon:
+            ##already in a pool worker (ie cohort.cohort_windows), which can't start its own pool
+            result = [load_bp(*a) for a in args]
+        else:
+            with mp.Pool(tdms_files.n_procs) as p:
+                result = p.starmap(load_bp,args)
+        ##the size of the data that had to be pickled back from the workers
+        rec['bytes_transferred'],rec['samples'] = profiling.nbytes([y for x in result for y in x[0].values()])
     ##make sure results are all in the same order that they were passed
     ##to the pool
     index = [x[1] for x in result]
     sort_idx = np.argsort(index)
     data = [result[i][0] for i in sort_idx]
     return data
+
+def iter_bp_mp(paths,resample=False,load_time=True,compact=False):
+    """
+    Like load_bp_mp, but yields each file's data dictionary (in order) as soon as
+    it's loaded, so files can be copied into the output one at a time.
+    """
+    args = [(p,resample,load_time,i,compact) for i,p in enumerate(paths)]
+    if mp.current_process().daemon:
+        ##already in a pool worker (ie cohort.cohort_windows), which can't start its own pool
+        for a in args:
+            yield load_bp(*a)[0]
+        return
+    with mp.Pool(tdms_files.n_procs) as p:
+        for data,index in p.imap(_load_bp,args):
+            yield data
+
+def _load_bp(args):
+    return load_bp(*args)
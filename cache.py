@@ -0,0 +1,189 @@
+##cache.py
+
+##an on-disk cache for the results of the process_* functions. Results are keyed
+##by the identity of the source files (path, size and modification time) plus the
+##processing parameters, so a cached result is only used if nothing it was built
+##from has changed. Arrays are saved as .npy files and loaded back as memory maps,
+##so loading a cached experiment only reads the parts of it that are used. The
+##total size of the cache is capped, with the least recently used results removed first.
+
+import numpy as np
+import os
+import json
+import time
+import shutil
+import hashlib
+import functools
+import inspect
+
+##default location of the cache
+cache_dir = os.path.join(os.path.expanduser('~'),'.data_checkout','cache')
+
+##maximum total size of the cache, in bytes
+max_bytes = 20e9
+
+##set to False to turn off caching (ie when timing the processing functions)
+enabled = True
+
+##version of the cached results; it's part of every key, so bump it whenever a cached
+##function changes what it returns, and results from the older code won't be used
+version = 2
+
+def cached(fn):
+    """
+    Decorator that caches the results of a function that takes a list of files as its
+    first argument and returns a dictionary of arrays (plus any JSON-able values).
+    The other arguments are included in the cache key. Calls that ask for the result
+    to be memory mapped into a folder of their own (an 'mmap' argument) bypass the
+    cache, since a cached result would be mapped from the cache folder instead.
+    """
+    sig = inspect.signature(fn)
+    @functools.wraps(fn)
+    def wrapper(*args,**kwargs):
+        if not enabled:
+            return fn(*args,**kwargs)
+        bound = sig.bind(*args,**kwargs)
+        bound.apply_defaults()
+        params = dict(bound.arguments)
+        if params.get('mmap'):
+            return fn(*args,**kwargs)
+        files = params.pop('files')
+        key = make_key(fn.__module__+'.'+fn.__name__,files,params)
+        data = get(key)
+        if data == None:
+            data = fn(*args,**kwargs)
+            put(key,data)
+        return data
+    return wrapper
+
+def make_key(name,files,params={}):
+    """
+    Creates the cache key for a result (which includes the module's version).
+    Args:
+        -name: name of the function/type of result
+        -files: list of source file paths
+        -params: dictionary of the processing parameters
+    Returns:
+        -key: hex digest identifying the result
+    """
+    ids = []
+    for f in files:
+        st = os.stat(f)
+        ids.append([os.path.abspath(f),st.st_size,st.st_mtime])
+    text = json.dumps([name,version,ids,params],sort_keys=True,default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def get(key):
+    """
+    Loads a result from the cache.
+    Args:
+        -key: cache key from make_key
+    Returns:
+        -data: dictionary of arrays (copy-on-write memory maps; writing to them changes the
+            copy in memory, not the cache) and other values, or None if the result isn't cached
+    """
+    path = os.path.join(cache_dir,key)
+    meta_file = os.path.join(path,'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+    ##the entry can be removed by another process (see put and evict) while it's being
+    ##loaded, so any error loading it is treated as a cache miss
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        data = meta['values']
+        for name in meta['arrays']:
+            fname = os.path.join(path,name+'.npy')
+            try:
+                data[name] = np.load(fname,mmap_mode='c')
+            except ValueError:
+                ##empty arrays can't be memory mapped
+                data[name] = np.load(fname)
+        ##mark as recently used
+        os.utime(meta_file,None)
+    except Exception:
+        return None
+    return data
+
+def put(key,data):
+    """
+    Saves a result to the cache, then trims the cache to its maximum size.
+    Results bigger than the whole cache (max_bytes) aren't saved.
+    Args:
+        -key: cache key from make_key
+        -data: dictionary of arrays and JSON-able values
+    """
+    nbytes = sum([x.nbytes for x in data.values() if isinstance(x,np.ndarray)])
+    if nbytes > max_bytes:
+        return
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir,key)
+    ##write to a temporary folder first, so a half-written result is never loaded
+    tmp = path+'.tmp{}'.format(os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    meta = {'arrays':[],'values':{},'created':time.time()}
+    for name,val in data.items():
+        if isinstance(val,np.ndarray):
+            np.save(os.path.join(tmp,name+'.npy'),val)
+            meta['arrays'].append(name)
+        else:
+            meta['values'][name] = val
+    with open(os.path.join(tmp,'meta.json'),'w') as f:
+        json.dump(meta,f,default=float)
+    if os.path.exists(path):
+        shutil.rmtree(path,ignore_errors=True)
+    try:
+        os.rename(tmp,path)
+    except OSError:
+        ##another process saved the same result first
+        shutil.rmtree(tmp,ignore_errors=True)
+    evict()
+
+def evict(limit=None):
+    """
+    Removes the least recently used results until the cache is under its size limit.
+    Args:
+        -limit: size limit in bytes (default is max_bytes)
+    """
+    if limit == None:
+        limit = max_bytes
+    entries = []
+    for key,size,used in list_entries():
+        entries.append((used,size,key))
+    total = sum([x[1] for x in entries])
+    for used,size,key in sorted(entries):
+        if total <= limit:
+            break
+        shutil.rmtree(os.path.join(cache_dir,key),ignore_errors=True)
+        total -= size
+
+def list_entries():
+    """
+    Returns a list of (key,size in bytes,last used time) for each cached result
+    """
+    if not os.path.exists(cache_dir):
+        return []
+    result = []
+    for entry in os.scandir(cache_dir):
+        ##'.tmp<pid>' folders are results still being written by put
+        if '.tmp' in entry.name:
+            continue
+        meta_file = os.path.join(entry.path,'meta.json')
+        if not entry.is_dir() or not os.path.exists(meta_file):
+            continue
+        try:
+            size = sum([x.stat().st_size for x in os.scandir(entry.path)])
+            result.append((entry.name,size,os.path.getmtime(meta_file)))
+        except OSError:
+            ##removed by another process in the meantime
+            continue
+    return result
+
+def clear():
+    """
+    Removes everything from the cache
+    """
+    shutil.rmtree(cache_dir,ignore_errors=True)
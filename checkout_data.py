@@ -5,16 +5,14 @@
 
 #Ryan Neely 6/10/19
 
+##matplotlib, scipy, h5py and the processing modules are imported inside
+##each function, so that the spawned plotting processes (and anything that
+##just imports this module) start up quickly.
+
 import numpy as np
 import sys
-import matplotlib.pyplot as plt
 import os
 from tdms_files import sort_tdms, search_files
-from bp_files import process_bp
-from physio_files import process_physio
-from ephys_files import process_ephys
-import matplotlib.pyplot as plt
-import filtering as filt
 import multiprocessing as mp
 mp.freeze_support()
 
@@ -28,6 +26,8 @@ def bp_sample(file_dict):
     Returns:
         -plot with data from the pulse wf
     """
+    import matplotlib.pyplot as plt
+    from bp_files import process_bp
     resample = 100 ##fixed resampling rate
     ##case where bp data is saved in it's own file
     if len(file_dict['lowspeed']) > 0:
@@ -54,6 +54,9 @@ def physio_sample(file_dict):
     Returns:
         -plot of several parameters
     """
+    import matplotlib.pyplot as plt
+    import filtering as filt
+    from physio_files import process_physio
     ##the wf_increment value in physio data is wrong, so this will resample to 1Hz
     resample = 0.1
     files = file_dict['physio']
@@ -77,6 +80,8 @@ def physio_sample(file_dict):
     plt.show()
 
 def ephys_sample(file_dict):
+    import matplotlib.pyplot as plt
+    from ephys_files import process_ephys
     resample = 5000
     files = file_dict['highspeed']
     data = process_ephys(files,resample=resample,load_time=True)
@@ -96,7 +101,13 @@ def ephys_sample(file_dict):
     fig.tight_layout()
     plt.show()
 
-def create_plots():
+def create_plots(path):
+    """
+    Loads the data in an experiment folder and opens quick-look plots of the
+    physio, BP and ephys data (each in its own process).
+    Args:
+        -path: experiment folder
+    """
     ##get the dictionary of files in this experiment folder
     file_dict = search_files(path)
     print("...")
@@ -111,6 +122,6 @@ def create_plots():
 
 if __name__ == "__main__": 
     path = sys.argv[1]
-    create_plots()
+    create_plots(path)
 
 
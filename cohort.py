@@ -0,0 +1,155 @@
+##cohort.py
+
+##functions to run the stim-window analysis (see analysis.get_stim_window)
+##over a whole cohort of experiments at once. Each experiment is processed
+##in its own pool worker, and its window is put on a time grid locked to the
+##stim onset, so the windows from every experiment can be stacked into one
+##(experiment x variable x time) array. Results are cached per experiment.
+
+import numpy as np
+import os
+import multiprocessing as mp
+import cache
+
+##variables to include by default
+default_variables = ['mean_bp','systolic_bp','diastolic_bp','percent_isoflurane',
+    'core_temp','sp02','heart_rate2','perfusion']
+
+def experiment_folder(path):
+    """
+    Returns the experiment folder for a path, which can be the folder itself or
+    its metadata file (ie from search_attrib.search)
+    """
+    if path.endswith('.xml'):
+        return os.path.dirname(os.path.abspath(path))
+    return path
+
+def experiment_window(path,variables=None,pad_min=10.0,fs=1.0,resample_bp=10.0,
+    fix_outliers=[0.25,5]):
+    """
+    Finds the stim block in one experiment and extracts the data around it,
+    on a time grid that starts pad_min before the stim onset.
+    Args:
+        -path: experiment folder
+        -variables: list of bp/physio variables to include (default is default_variables)
+        -pad_min: time, in min, before and after stim to include
+        -fs: sample rate of the time grid, in Hz
+        -resample_bp: rate to resample the bp data to when loading it (Hz)
+        -fix_outliers: see analysis.get_stim_window
+    Returns:
+        -result: dictionary with:
+            -data: dictionary of variable:array pairs on the time grid (variables the
+                experiment doesn't have are left out)
+            -duration: length of the stim block, in min
+    """
+    import analysis
+    from tdms_files import sort_tdms
+    from bp_files import process_bp
+    from physio_files import process_physio
+    if variables == None:
+        variables = default_variables
+    file_dict = sort_tdms(path)
+    params = {'variables':variables,'pad_min':pad_min,'fs':fs,'resample_bp':resample_bp,
+        'fix_outliers':fix_outliers}
+    ##(the version is bumped whenever the way windows are computed changes)
+    params['version'] = 2
+    key = cache.make_key('cohort.experiment_window',file_dict['highspeed']+
+        file_dict['lowspeed']+file_dict['physio'],params)
+    result = cache.get(key) if cache.enabled else None
+    if result != None:
+        return _unpack(result)
+    stim = analysis.get_stim_info(path)
+    start,stop = analysis.get_tstim(stim['start'],stim['stop'])
+    sources = []
+    bp_files = file_dict['lowspeed'] if len(file_dict['lowspeed']) > 0 else file_dict['highspeed']
+    sources.append(process_bp(bp_files,resample=resample_bp,load_time=True))
+    if len(file_dict['physio']) > 0:
+        sources.append(process_physio(file_dict['physio'],load_time=True))
+    duration = (stop-start)/1000.0/60.0
+    n = int(np.floor((2*pad_min+duration)*60.0*fs))+1
+    grid = -pad_min+np.arange(n)/(60.0*fs)
+    data = {}
+    for source in sources:
+        source = dict([(k,v) for k,v in source.items() if k in variables or k == 'time'])
+        if len(source) == 1:
+            continue
+        window = analysis.get_stim_window(source,start,stop,pad_min,fix_outliers)
+        pad = pad_min*60.0*1000.0
+        for v in variables:
+            if v in window:
+                y = window[v]
+                ##build the timebase from the samples actually used, since the window is
+                ##clipped if the stim starts or ends less than pad_min from the recording edge
+                n_v = len(source[v])
+                time = source['time']*1000.0
+                start_idx = analysis.window_indices(n_v,time,start-pad,stop+pad)[0]
+                tbase = ((start_idx+np.arange(y.size))*time/(n_v-1)-start)/60000.0
+                data[v] = np.interp(grid,tbase,y,left=np.nan,right=np.nan)
+    result = {'duration':duration}
+    for v in data:
+        result['data_'+v] = data[v]
+    if cache.enabled:
+        cache.put(key,result)
+    return _unpack(result)
+
+def cohort_windows(paths,variables=None,pad_min=10.0,fs=1.0,norm=False,n_procs=3,
+    resample_bp=10.0,fix_outliers=[0.25,5]):
+    """
+    Runs experiment_window for a list of experiments in parallel and stacks the results.
+    Args:
+        -paths: list of experiment folders or their metadata files (ie from search_attrib.search)
+        -variables: list of bp/physio variables to include (default is default_variables)
+        -pad_min: time, in min, before and after stim to include
+        -fs: sample rate of the common time grid, in Hz
+        -norm: if True, normalizes each variable to the mean of its pre-stim window
+            (as in plot.plot_stim_window)
+        -n_procs: number of worker processes
+        -resample_bp,fix_outliers: see experiment_window
+    Returns:
+        -result: dictionary with:
+            -data: experiment x variable x time array (NaN where an experiment has no data,
+                ie after the end of a shorter stim block)
+            -time: the time grid, in min relative to the stim onset
+            -variables: list of variable names
+            -experiments: list of experiment folders
+            -duration: length of each experiment's stim block, in min
+            -errors: dictionary of experiment folder:error message pairs for any
+                experiments that couldn't be processed (these are left out of the data)
+    """
+    if variables == None:
+        variables = default_variables
+    folders = [experiment_folder(p) for p in paths]
+    args = [(f,variables,pad_min,fs,resample_bp,fix_outliers) for f in folders]
+    with mp.Pool(n_procs) as p:
+        results = p.starmap(_try_window,args)
+    errors = dict([(f,r) for f,r in zip(folders,results) if isinstance(r,str)])
+    done = [(f,r) for f,r in zip(folders,results) if not isinstance(r,str)]
+    n = max([len(y) for f,r in done for y in r['data'].values()]+[0])
+    stacked = np.full((len(done),len(variables),n),np.nan)
+    for i,(f,r) in enumerate(done):
+        for j,v in enumerate(variables):
+            if v in r['data']:
+                y = r['data'][v]
+                if norm:
+                    y = y/np.nanmean(y[:int(pad_min*60.0*fs)])
+                stacked[i,j,:y.size] = y
+    return {'data':stacked,'time':-pad_min+np.arange(n)/(60.0*fs),'variables':variables,
+        'experiments':[x[0] for x in done],'duration':np.array([x[1]['duration'] for x in done]),
+        'errors':errors}
+
+def _try_window(path,*args):
+    """
+    Pool worker for cohort_windows; returns the error message instead of
+    raising, so one bad experiment doesn't stop the rest.
+    """
+    try:
+        return experiment_window(path,*args)
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__,e)
+
+def _unpack(result):
+    """
+    Converts a flat cached result back into the form returned by experiment_window
+    """
+    data = dict([(k[5:],np.asarray(v)) for k,v in result.items() if k.startswith('data_')])
+    return {'data':data,'duration':result['duration']}
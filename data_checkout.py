@@ -0,0 +1,124 @@
+##data_checkout.py
+
+##command line interface for the data_checkout functions.
+##Each subcommand only imports the modules it needs, so that quick
+##commands like 'list' don't pay for loading scipy/matplotlib/h5py.
+
+##usage:
+##  python data_checkout.py list <folder>
+##  python data_checkout.py convert <folder> [--resample-ephys 5000] [--check-meta]
+##  python data_checkout.py checkout <folder> [--headless --out <report folder>]
+##  python data_checkout.py stim-period <folder>
+##  python data_checkout.py search <xml files...> --where "Experiment ID=abc" "Weight (g)=250:350"
+
+import sys
+import argparse
+
+def cmd_list(args):
+    from tdms_files import search_files
+    for path in args.folders:
+        print(path)
+        search_files(path)
+
+def cmd_convert(args):
+    from save_data import save_exp
+    kwargs = {}
+    if args.resample_ephys:
+        kwargs['resample_ephys'] = args.resample_ephys
+    if args.resample_bp:
+        kwargs['resample_bp'] = args.resample_bp
+    if args.resample_physio:
+        kwargs['resample_physio'] = args.resample_physio
+    for path in args.folders:
+        save_exp(path,check_meta=args.check_meta,spikes=args.spikes,rc=args.rc,beats=args.beats,
+            blank_artifacts=args.blank_artifacts,profile=args.profile,backend=args.backend,
+            pipelined=args.pipelined,compact=args.compact,**kwargs)
+
+def cmd_checkout(args):
+    if args.headless:
+        from qc_report import batch_report
+        batch_report(args.folders,out_dir=args.out,n_procs=args.procs)
+        return
+    from checkout_data import create_plots
+    for path in args.folders:
+        create_plots(path)
+
+def cmd_stim_period(args):
+    from tdms_files import sort_tdms
+    from stim_period import get_period
+    for path in args.folders:
+        start,stop = get_period(sort_tdms(path)['highspeed'])
+        print("{}: start={}, stop={}".format(path,start,stop))
+
+def cmd_search(args):
+    from search_attrib import search
+    criteria = dict([parse_criterion(x) for x in args.where])
+    index = args.index if args.index != None else False
+    for f in search(args.files,criteria,index=index):
+        print(f)
+
+def parse_criterion(text):
+    """
+    Parses a search criterion given on the command line into the
+    key:value form used by search_attrib.search.
+        'key=lo:hi' -> range (lo,hi)
+        'key=a,b,c' -> list of allowed values
+        'key=value' -> exact value
+    """
+    key,val = text.split('=',1)
+    if ':' in val:
+        lo,hi = val.split(':',1)
+        return key,(float(lo),float(hi))
+    elif ',' in val:
+        return key,val.split(',')
+    return key,val
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='data_checkout',
+        description="Look at, convert and search TDMS experiment data")
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('list',help="list the TDMS files in experiment folders")
+    p.add_argument('folders',nargs='+')
+    p.set_defaults(fn=cmd_list)
+
+    p = sub.add_parser('convert',help="convert experiment folders to hdf5")
+    p.add_argument('folders',nargs='+')
+    p.add_argument('--resample-ephys',type=float,default=None)
+    p.add_argument('--resample-bp',type=float,default=None)
+    p.add_argument('--resample-physio',type=float,default=None)
+    p.add_argument('--check-meta',action='store_true')
+    p.add_argument('--spikes',action='store_true',help="also run spike detection")
+    p.add_argument('--blank-artifacts',action='store_true',help="blank stim artifacts in the ephys data (before spike detection)")
+    p.add_argument('--rc',action='store_true',help="also process recruitment curve files")
+    p.add_argument('--beats',action='store_true',help="also save a beat-by-beat table from the BP waveform")
+    p.add_argument('--profile',action='store_true',help="save a per-stage profiling report")
+    p.add_argument('--backend',default='hdf5',choices=['hdf5','zarr'],help="output format for ephys/bp data")
+    p.add_argument('--pipelined',action='store_true',help="overlap reading, processing and writing")
+    p.add_argument('--compact',action='store_true',help="store raw integer samples with scale/offset attributes")
+    p.set_defaults(fn=cmd_convert)
+
+    p = sub.add_parser('checkout',help="plot quick-look figures for experiment folders")
+    p.add_argument('folders',nargs='+')
+    p.add_argument('--headless',action='store_true',help="save the figures as PNG/HTML reports instead of showing them")
+    p.add_argument('--out',default=None,help="folder for the headless reports (default is <folder>/qc)")
+    p.add_argument('--procs',type=int,default=3,help="number of experiments to render at once")
+    p.set_defaults(fn=cmd_checkout)
+
+    p = sub.add_parser('stim-period',help="find the stim block in experiment folders")
+    p.add_argument('folders',nargs='+')
+    p.set_defaults(fn=cmd_stim_period)
+
+    p = sub.add_parser('search',help="search metadata files by attribute")
+    p.add_argument('files',nargs='+',help="XML metadata files")
+    p.add_argument('--where',nargs='+',default=[],help="criteria as key=value, key=lo:hi or key=a,b")
+    p.add_argument('--index',nargs='?',const=True,default=None,
+        help="search through the metadata index (optionally give the database path)")
+    p.set_defaults(fn=cmd_search)
+
+    args = parser.parse_args(argv)
+    args.fn(args)
+
+if __name__ == "__main__":
+    main()
@@ -6,11 +6,17 @@
 ##by Ryan Neely 6/10/19
 
 import numpy as np
-import nptdms
-from tdms_files import file_ids, downsample, get_duration_seconds, order_files
+from tdms_files import file_ids, downsample, downsample_array, get_duration_seconds, order_files, get_n_samples, resampled_length
+from tdms_files import open_tdms, load_channel, load_channels, map_channels, read_tdms_metadata, file_lengths, concat_files, apply_scaling, data_chans, stack_channel, set_scaling_attrs
 import os
 import h5py
 import multiprocessing as mp
+import tdms_files
+import profiling
+import output_backends
+import pipeline
+import cache
+import qc_stats
 
 def get_ephys_chans(tdms_file):
     """
@@ -32,7 +38,7 @@ def get_ephys_chans(tdms_file):
                 ephys_chans.append(chan)
     return ephys_chans
 
-def save_ephys(files,path_out=None,resample=False,load_time=True):
+def save_ephys(files,path_out=None,resample=False,load_time=True,backend='hdf5',pipelined=False,compact=False):
     """
     Function to create hdf5 file from ephys data.
     Args:
@@ -41,6 +47,12 @@ def save_ephys(files,path_out=None,resample=False,load_time=True):
             not specified, file is saved in same location as input files.
         -resample: if a number, resamples to 'resample' Hz
         -load_time: if True, loads the duration of the recording in seconds
+        -backend: 'hdf5', or 'zarr' to save to a zarr directory store, with
+            each file written directly by the pool worker that loads it
+        -pipelined: if True, reading, resampling and writing are overlapped
+            (see save_ephys_pipelined)
+        -compact: if True, saves the raw integer samples with 'scale' and 'offset'
+            attributes where the files have them, and float32 otherwise
     Returns:
         None; data saved in specified location
     """
@@ -49,19 +61,179 @@ def save_ephys(files,path_out=None,resample=False,load_time=True):
     ##create path
     if path_out == None:
         path_out = os.path.dirname(files[0])
+    if pipelined:
+        save_ephys_pipelined(files,output_backends.output_path(path_out,'ephys_data',backend),
+            resample,load_time,backend,compact)
+        return
+    if backend != 'hdf5':
+        save_ephys_parallel(files,output_backends.output_path(path_out,'ephys_data',backend),
+            resample,load_time,backend,compact)
+        return
     path_out = os.path.join(path_out,'ephys_data.hdf5')
     f_out = h5py.File(path_out,'w')
-    dsets = load_ephys_mp(files,resample,load_time)
+    dsets = load_ephys_mp(files,resample,load_time,compact,qc=True)
+    qc = [x.pop('qc') for x in dsets]
     ##standardize the channel names
-    ephys_chans = [x for x in list(dsets[0]) if x != 'time']
+    ephys_chans = data_chans(dsets[0])
     for i,chan in enumerate(ephys_chans):
-        f_out.create_dataset("amp_"+str(i),data=np.hstack([x[chan] for x in dsets]))
+        with profiling.span('hstack') as rec:
+            chan_data,scaling = stack_channel(dsets,chan)
+            rec['samples'] = chan_data.size
+        with profiling.span('hdf5_write',path_out) as rec:
+            dset = f_out.create_dataset("amp_"+str(i),data=chan_data)
+            set_scaling_attrs(dset,scaling)
+            rec['bytes_written'] = chan_data.nbytes
     if load_time:
         times = [x['time'] for x in dsets]
         f_out.create_dataset("time",data=np.asarray(np.sum(times)))
+    qc_stats.write_qc(f_out,qc,files,dict([(c,"amp_"+str(i)) for i,c in enumerate(ephys_chans)]))
     f_out.close()
 
-def process_ephys(files,resample=False,load_time=True):
+def save_ephys_parallel(files,path_out,resample=False,load_time=True,backend='zarr',compact=False):
+    """
+    Function to save ephys data with a backend that supports parallel writes. The
+    arrays are sized up front from the file headers, and each pool worker writes
+    its file's data into its own region of the arrays, so the data never has to
+    be sent back to the parent process.
+    Args:
+        -files: ordered list of ephys file paths
+        -path_out: full path of the output data file
+        -resample: if a number, resamples to 'resample' Hz
+        -load_time: if True, saves the duration of the recording in seconds
+        -backend: output backend (see output_backends)
+        -compact: if True, the data is saved as float32
+    Returns:
+        None; data saved in specified location
+    """
+    ##get the number of samples per file from the headers
+    lengths = []
+    for f in files:
+        n_samples,fs = get_n_samples(f)
+        ephys_chans = [x for x in list(n_samples) if "amp" in x]
+        lengths.append(resampled_length(n_samples[ephys_chans[0]],fs[ephys_chans[0]],resample))
+    offsets = np.hstack([0,np.cumsum(lengths)])
+    f_out = output_backends.open_output(path_out,backend,'w')
+    for i,chan in enumerate(ephys_chans):
+        output_backends.create_channel(f_out,"amp_"+str(i),offsets[-1],
+            'float32' if compact else 'float64')
+    args = []
+    for i,p in enumerate(files):
+        args.append((p,path_out,offsets[i],resample,load_time,i,compact))
+    with mp.Pool(tdms_files.n_procs) as p:
+        result = p.starmap(write_ephys,args)
+    if load_time:
+        f_out.create_dataset("time",data=np.asarray(np.sum([x[0] for x in result])))
+    qc_stats.write_qc(f_out,[x[1] for x in result],files)
+    output_backends.close(f_out)
+    output_backends.remove_sync(path_out)
+
+def save_ephys_pipelined(files,path_out,resample=False,load_time=True,backend='hdf5',compact=False):
+    """
+    Function to save ephys data using the pipelined engine: files are decoded
+    by reader processes, resampled by worker processes and appended to the
+    output file in order by this process, all at the same time.
+    Args:
+        -files: ordered list of ephys file paths
+        -path_out: full path of the output data file
+        -resample: if a number, resamples to 'resample' Hz
+        -load_time: if True, saves the duration of the recording in seconds
+        -backend: output backend (see output_backends)
+        -compact: if True, the data is saved as float32
+    Returns:
+        None; data saved in specified location
+    """
+    f_out = output_backends.open_output(path_out,backend,'w')
+    times = []
+    qc = []
+    names = {}
+    def write(index,result):
+        data,file_qc = result
+        ephys_chans = data_chans(data)
+        for i,chan in enumerate(ephys_chans):
+            output_backends.append_channel(f_out,"amp_"+str(i),data[chan])
+            names[chan] = "amp_"+str(i)
+        times.append(data['time'])
+        qc.append(file_qc)
+    pipeline.run_pipeline(files,read_ephys,compute_ephys,write,compute_args=(resample,compact))
+    if load_time:
+        f_out.create_dataset("time",data=np.asarray(np.sum(times)))
+    qc_stats.write_qc(f_out,qc,files,names)
+    output_backends.close(f_out)
+
+def read_ephys(path):
+    """
+    Reader stage for save_ephys_pipelined: decodes the ephys channels in a file.
+    Args:
+        -path: full path to the datafile
+    Returns:
+        -data: dictionary of raw data arrays
+        -fs: sample rate of the data
+    """
+    tdms_file = open_tdms(path)
+    data = {}
+    for chan in get_ephys_chans(tdms_file):
+        try:
+            channel_object = tdms_file.object('Group Name',chan)
+        except KeyError:
+            channel_object = tdms_file.object("ephys",chan)
+        data[chan] = channel_object.data
+    return data, 1.0/channel_object.properties['wf_increment']
+
+def compute_ephys(item,resample=False,compact=False):
+    """
+    Compute stage for save_ephys_pipelined: resamples the data from read_ephys.
+    Args:
+        -item: (data,fs) tuple from read_ephys
+        -resample: if a number, resamples to 'resample' Hz
+        -compact: if True, converts the data to float32
+    Returns:
+        -data: dictionary of data arrays, plus the duration in seconds ('time')
+        -qc: QC statistics for each channel (see qc_stats.file_qc)
+    """
+    data,fs = item
+    ##QC is computed on the samples as recorded, before they are resampled
+    chans = list(data)
+    qc = qc_stats.file_qc(dict(data,time=data[chans[0]].size/fs),'ephys')
+    result = {}
+    def resample_chan(chan):
+        y = data[chan]
+        if resample:
+            y = downsample_array(y,fs,resample)
+        if compact:
+            y = y.astype(np.float32)
+        return y
+    ##resample the channels in parallel
+    for chan,y in zip(chans,map_channels(resample_chan,chans)):
+        result[chan] = y
+    result['time'] = data[chan].size/fs
+    return result, qc
+
+def write_ephys(path,path_out,offset,resample=False,load_time=True,index=0,compact=False):
+    """
+    Pool worker for save_ephys_parallel: loads one ephys file and
+    writes it into the output arrays, starting at 'offset'.
+    Returns:
+        -time: duration of this file in seconds (or 0 if load_time is False)
+        -qc: QC statistics for each output channel (see qc_stats.file_qc)
+    """
+    data,index = load_ephys(path,resample,load_time,index,compact,qc=True)
+    ephys_chans = data_chans(data)
+    qc = data.pop('qc')
+    qc = dict([("amp_"+str(i),qc[chan]) for i,chan in enumerate(ephys_chans)])
+    regions = {}
+    for i,chan in enumerate(ephys_chans):
+        if compact:
+            ##the output arrays are float32, so raw samples need to be scaled first
+            regions["amp_"+str(i)] = apply_scaling(data[chan],data['scaling'][chan])
+        else:
+            regions["amp_"+str(i)] = data[chan]
+    with profiling.span('zarr_write',path) as rec:
+        output_backends.write_region(path_out,regions,offset)
+        rec['bytes_written'],rec['samples'] = profiling.nbytes(regions)
+    return data.get('time',0), qc
+
+@cache.cached
+def process_ephys(files,resample=False,load_time=True,compact=False,mmap=None):
     """
     A function to load the contents of all bp monitor
     files from one experiment folder into memory
@@ -69,22 +241,30 @@ def process_ephys(files,resample=False,load_time=True):
         -files: list of files to load/concatinate
         -resample: if a number, resamples to 'resample' Hz
         -load_time: if True, loads the duration of the recording in seconds
+        -compact: if True, keeps raw integer samples where the files have them
+            (and float32 otherwise). The (scale,offset) of each raw channel is
+            returned in dsets['scaling'].
+        -mmap: optional folder; if given, the data arrays are np.memmap files in it
     Returns:
         -dsets: full concatinated data sets
     """
     files = order_files(files)
     dsets = {}
-    tdms = load_ephys_mp(files,resample,load_time)
-    ##extract the channel names from the last dataset processed
-    ephys_chans = [x for x in list(tdms[0]) if x != 'time']
-    for i,chan in enumerate(ephys_chans):
-        dsets["amp_"+str(i)] = np.hstack([x[chan] for x in tdms])
+    scalings = {}
+    ##size the output from the file headers, and fill it as each file is loaded
+    lengths = ephys_lengths(files,resample)
+    with profiling.span('fill') as rec:
+        tdms,file_scalings = concat_files(iter_ephys_mp(files,resample,load_time,compact),lengths,mmap)
+        rec['samples'] = profiling.nbytes(tdms)[1]
+    for i,chan in enumerate(data_chans(tdms)):
+        dsets["amp_"+str(i)],scalings["amp_"+str(i)] = tdms[chan],file_scalings[chan]
+    if compact:
+        dsets['scaling'] = scalings
     if load_time:
-        times = [x['time'] for x in tdms]
-        dsets['time'] = np.sum(times)
+        dsets['time'] = tdms['time']
     return dsets
 
-def process_ephys2(files, resample=False, load_time=True, hd5_output_name=None):
+def process_ephys2(files, resample=False, load_time=True, hd5_output_name=None, mmap=None):
     """
     A function to load the contents of all bp monitor
     files from one experiment folder into memory
@@ -92,6 +272,7 @@ def process_ephys2(files, resample=False, load_time=True, hd5_output_name=None):
         -files: list of files to load/concatinate
         -resample: if a number, resamples to 'resample' Hz
         -load_time: if True, loads the duration of the recording in seconds
+        -mmap: optional folder; if given, the data arrays are np.memmap files in it
     Returns:
         -dsets: full concatinated data sets
 
@@ -100,28 +281,33 @@ def process_ephys2(files, resample=False, load_time=True, hd5_output_name=None):
     """
     files = order_files(files)
     dsets = {}
-    tdms = load_ephys_mp(files,resample,load_time)
-    ##extract the channel names from the last dataset processed
-    ephys_chans = [x for x in list(tdms[0]) if x != 'time']
+    tdms = concat_files(iter_ephys_mp(files,resample,load_time),ephys_lengths(files,resample),mmap)[0]
+    ephys_chans = data_chans(tdms)
     for i,chan in enumerate(ephys_chans):
-        dsets["amp_"+str(i)] = np.hstack([x[chan] for x in tdms])
+        dsets["amp_"+str(i)] = tdms[chan]
     if load_time:
-        times = [x['time'] for x in tdms]
-        dsets['time'] = np.sum(times)
+        dsets['time'] = tdms['time']
 
     if hd5_output_name is not None:
         f_out = h5py.File(hd5_output_name, 'w')
         for i,chan in enumerate(ephys_chans):
-            f_out.create_dataset("amp_" + str(i), data=np.hstack([x[chan] for x in tdms]))
+            f_out.create_dataset("amp_" + str(i), data=dsets["amp_" + str(i)])
         if load_time:
-            f_out.create_dataset("time", data=np.asarray(np.sum(times)))
+            f_out.create_dataset("time", data=np.asarray(dsets['time']))
         f_out.close()
 
     return dsets
 
+def ephys_lengths(files,resample=False):
+    """
+    Returns the number of samples each ephys file will give once loaded, from the file headers
+    """
+    chan = get_ephys_chans(read_tdms_metadata(files[0]))[0]
+    return file_lengths(files,chan,resample)
+
 
 
-def load_ephys(path,resample=False,load_time=True,index=0):
+def load_ephys(path,resample=False,load_time=True,index=0,compact=False,qc=False):
     """
     A function to load data from ephys files, and
     resample them to a lower rate if necessary
@@ -131,30 +317,44 @@ def load_ephys(path,resample=False,load_time=True,index=0):
             it will resample the data to roughly that sample rate (in Hz)
         -load_time: if True, loads the duration of the recording in seconds
         -index: useful for ordering after asynchronous multiprocessing
+        -compact: if True, loads raw integer samples (or float32) instead of
+            float64; see tdms_files.load_channel. The scaling of each channel
+            is returned in data['scaling'].
+        -qc: if True, the QC statistics of each channel (see qc_stats.tdms_qc), computed
+            at the full sample rate, are returned in data['qc']
     Returns:
         -data: dictionary with labeled data arrays
     """
     ##load the file
-    tdms_file = nptdms.TdmsFile(path)
+    with profiling.span('tdms_decode',path) as rec:
+        tdms_file = open_tdms(path)
+        rec['bytes_read'] = os.path.getsize(path)
     ##figure out which channels here are ephys channels
     ephys_chans = get_ephys_chans(tdms_file)
     data = {}
+    scalings = {}
+    channel_objects = []
     for chan in ephys_chans:
         try:
             channel_object = tdms_file.object('Group Name',chan)
         except KeyError:
             ##case where the group name is different
             channel_object = tdms_file.object("ephys",chan)
-        if resample:
-            chan_data = downsample(channel_object,resample)
-        else:
-            chan_data = channel_object.data
-        data[chan] = chan_data
+        channel_objects.append(channel_object)
+    ##resample the channels in parallel
+    for chan,(y,scaling) in zip(ephys_chans,load_channels(channel_objects,resample,compact)):
+        data[chan],scalings[chan] = y,scaling
+    if qc:
+        with profiling.span('qc_stats',path):
+            data['qc'] = qc_stats.tdms_qc(channel_objects,ephys_chans,'ephys',
+                get_duration_seconds(channel_object))
+    if compact:
+        data['scaling'] = scalings
     if load_time:
         data['time'] = get_duration_seconds(channel_object)
     return data, index
 
-def load_ephys_mp(paths,resample=False,load_time=True):
+def load_ephys_mp(paths,resample=False,load_time=True,compact=False,qc=False):
     """
     Function to distribute the loading of multiple files
     across multiple cores.
@@ -162,16 +362,21 @@ def load_ephys_mp(paths,resample=False,load_time=True):
         -paths: ordered list of file paths where data is stored
         -resample: if a number, resamples the data to 'resample' Hz
         -load_time: if True, includes the duration of the recording in seconds
+        -compact: if True, loads raw integer samples (or float32); see load_ephys
+        -qc: if True, includes the full-rate QC statistics; see load_ephys
     Returns:
         -dsets: ordered list of data dictionaries containing the files
     """
     ##create the argument lists for each version of the function
     args = []
     for i,p in enumerate(paths):
-        args.append((p,resample,load_time,i))
+        args.append((p,resample,load_time,i,compact,qc))
     ##now apply the pool to the function
-    with mp.Pool(3) as p:
-        result = p.starmap(load_ephys,args)
+    with profiling.span('load_pool') as rec:
+        with mp.Pool(tdms_files.n_procs) as p:
+            result = p.starmap(load_ephys,args)
+        ##the size of the data that had to be pickled back from the workers
+        rec['bytes_transferred'],rec['samples'] = profiling.nbytes([y for x in result for y in x[0].values()])
     ##make sure results are all in the same order that they were passed
     ##to the pool
     index = [x[1] for x in result]
@@ -179,6 +384,19 @@ def load_ephys_mp(paths,resample=False,load_time=True):
     data = [result[i][0] for i in sort_idx]
     return data
 
+def iter_ephys_mp(paths,resample=False,load_time=True,compact=False):
+    """
+    Like load_ephys_mp, but yields each file's data dictionary (in order) as soon as
+    it's loaded, so files can be copied into the output one at a time.
+    """
+    args = [(p,resample,load_time,i,compact) for i,p in enumerate(paths)]
+    with mp.Pool(tdms_files.n_procs) as p:
+        for data,index in p.imap(_load_ephys,args):
+            yield data
+
+def _load_ephys(args):
+    return load_ephys(*args)
+
 def load_ephys2(paths):
     """
     TODO: create a function to load these files that doesn't take up so much memory.
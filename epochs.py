@@ -0,0 +1,179 @@
+##epochs.py
+
+##functions to cut stimulus-locked epochs out of continuous data. In-memory
+##arrays (including memmaps) are windowed with strided views, so no data is
+##copied until epochs are picked out; HDF5/zarr datasets are read in batches,
+##with nearby epochs coalesced into one contiguous read. Averages and variances
+##can be accumulated a batch at a time, so experiments with many thousands of
+##pulses can be averaged without holding every epoch in memory.
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from tdms_files import apply_scaling
+
+##default number of epochs to process at once
+batch_size = 1024
+
+def onset_samples(times,fs):
+    """
+    Converts event times (ie the stim start times from stim_files.process_stim) to sample indices.
+    Args:
+        -times: array of event times in seconds
+        -fs: sample rate of the data the epochs will be taken from
+    Returns:
+        -onsets: array of sample indices
+    """
+    return np.round(np.asarray(times)*fs).astype(np.int64)
+
+def window_sizes(fs,pre,post):
+    """
+    Converts epoch window times in ms to numbers of samples
+    Returns:
+        -n_pre,n_post: samples before and after each onset
+    """
+    return int(np.round(pre*fs/1000.0)),int(np.round(post*fs/1000.0))
+
+def get_epochs(signals,onsets,n_pre,n_post,dtype=np.float64):
+    """
+    Cuts epochs around a set of onsets out of one or more channels of data.
+    Args:
+        -signals: 1-D array, 2-D (channels x samples) array, or list of 1-D arrays or
+            h5py/zarr datasets. Datasets with 'scale' and 'offset' attributes are scaled.
+        -onsets: array of onset sample indices
+        -n_pre: number of samples before each onset to include
+        -n_post: number of samples after each onset to include
+        -dtype: data type of the result
+    Returns:
+        -epochs: events x channels x samples array. Onsets without a full window of data
+            are dropped, and the epochs are in time order.
+        -onsets: the onsets of the returned epochs
+    """
+    onsets = valid_onsets(signals,onsets,n_pre,n_post)
+    channels = _as_channels(signals)
+    epochs = np.zeros((onsets.size,len(channels),n_pre+n_post),dtype=dtype)
+    for i in range(0,onsets.size,batch_size):
+        epochs[i:i+batch_size] = _read_batch(channels,onsets[i:i+batch_size],n_pre,n_post,dtype)
+    return epochs, onsets
+
+def iter_epochs(signals,onsets,n_pre,n_post,batch=batch_size,dtype=np.float64):
+    """
+    Like get_epochs, but yields the epochs a batch at a time.
+    Yields:
+        -epochs: events x channels x samples array for one batch
+        -onsets: the onsets of the epochs in this batch
+    """
+    onsets = valid_onsets(signals,onsets,n_pre,n_post)
+    channels = _as_channels(signals)
+    for i in range(0,onsets.size,batch):
+        yield _read_batch(channels,onsets[i:i+batch],n_pre,n_post,dtype), onsets[i:i+batch]
+
+def epoch_stats(signals,onsets,n_pre,n_post,batch=batch_size):
+    """
+    Computes the mean and variance of the epochs around a set of onsets,
+    without loading all of the epochs at once.
+    Args:
+        -signals,onsets,n_pre,n_post: see get_epochs
+        -batch: number of epochs to load at once
+    Returns:
+        -stats: dictionary with the number of epochs ('n'), and the
+            channels x samples 'mean' and 'var' of the epochs
+    """
+    stats = new_stats()
+    for epochs,b in iter_epochs(signals,onsets,n_pre,n_post,batch):
+        update_stats(stats,epochs)
+    return finish_stats(stats)
+
+def new_stats():
+    """
+    Returns an empty running statistics accumulator (see update_stats)
+    """
+    return {'n':0,'mean':0.0,'m2':0.0}
+
+def update_stats(stats,x):
+    """
+    Adds a batch of values to a running mean/variance accumulator, using the
+    parallel form of Welford's algorithm (so batches can be any size, and
+    accumulators from different batches can be merged with merge_stats).
+    Args:
+        -stats: accumulator from new_stats
+        -x: array of values, with the first axis being the one that is averaged over
+    """
+    if x.shape[0] == 0:
+        return
+    mean = x.mean(axis=0)
+    m2 = ((x-mean)**2).sum(axis=0)
+    merge_stats(stats,{'n':x.shape[0],'mean':mean,'m2':m2})
+
+def merge_stats(stats,other):
+    """
+    Merges the accumulator 'other' into 'stats'
+    """
+    n = stats['n']+other['n']
+    if n == 0:
+        return
+    delta = other['mean']-stats['mean']
+    stats['mean'] = stats['mean']+delta*(other['n']/float(n))
+    stats['m2'] = stats['m2']+other['m2']+delta**2*(stats['n']*other['n']/float(n))
+    stats['n'] = n
+
+def finish_stats(stats):
+    """
+    Returns the mean and (sample) variance from a running accumulator
+    Returns:
+        -result: dictionary with 'n', 'mean' and 'var'
+    """
+    if stats['n'] > 1:
+        var = stats['m2']/(stats['n']-1)
+    else:
+        var = stats['m2']*np.nan
+    return {'n':stats['n'],'mean':stats['mean'],'var':var}
+
+def valid_onsets(signals,onsets,n_pre,n_post):
+    """
+    Returns the sorted onsets that have a full window of data around them
+    """
+    n_samples = min([len(x) for x in _as_channels(signals)])
+    onsets = np.sort(np.asarray(onsets,dtype=np.int64))
+    return onsets[(onsets>=n_pre)&(onsets+n_post<=n_samples)]
+
+def _as_channels(signals):
+    """
+    Returns signals as a list of 1-D channels
+    """
+    if isinstance(signals,np.ndarray):
+        if signals.ndim == 1:
+            return [signals]
+        return list(signals)
+    return list(signals)
+
+def _windows(x,n):
+    """
+    Returns a read-only (samples-n+1) x n view of a 1-D array, where row i
+    holds samples i to i+n. No data is copied.
+    """
+    return as_strided(x,shape=(x.size-n+1,n),strides=(x.strides[0],x.strides[0]),writeable=False)
+
+def _read_batch(channels,onsets,n_pre,n_post,dtype):
+    """
+    Cuts the epochs for a batch of (sorted, valid) onsets out of each channel.
+    Arrays are indexed through a strided view; for datasets, onsets that are
+    close together are read as one contiguous block.
+    """
+    n = n_pre+n_post
+    epochs = np.zeros((onsets.size,len(channels),n),dtype=dtype)
+    if onsets.size == 0:
+        return epochs
+    ##split the batch into runs of onsets that are no more than a few windows apart
+    breaks = np.where(np.diff(onsets)>4*n)[0]+1
+    runs = np.split(np.arange(onsets.size),breaks)
+    for c,chan in enumerate(channels):
+        if isinstance(chan,np.ndarray):
+            epochs[:,c] = _windows(chan,n)[onsets-n_pre]
+            continue
+        attrs = getattr(chan,'attrs',{})
+        scaling = (attrs['scale'],attrs['offset']) if 'scale' in attrs else None
+        for run in runs:
+            lo = onsets[run[0]]-n_pre
+            block = apply_scaling(chan[lo:onsets[run[-1]]+n_post],scaling,dtype)
+            epochs[run,c] = _windows(block,n)[onsets[run]-n_pre-lo]
+    return epochs
@@ -0,0 +1,180 @@
+##experiment.py
+
+##read-back API for converted experiments (the *_data files written by save_data.save_exp).
+##open_experiment returns a dictionary of lazy Signal objects, one per channel, that
+##only read the samples that are sliced out of them. Uncompressed, contiguous hdf5
+##datasets are memory mapped; everything else is read through h5py/zarr a slice at a
+##time. The dictionary has the same layout as the ones returned by the process_*
+##functions (including the 'time' value), so it can be passed straight to the
+##analysis functions (ie analysis.get_stim_window).
+
+import numpy as np
+import os
+import output_backends
+from tdms_files import apply_scaling
+
+##converted data files that hold continuous signals
+signal_files = ['ephys_data','bp_data','physio_data']
+
+##datasets in the data files that aren't signals
+tables = ['time','qc','beats','start','stop','intervals']
+
+class Signal(object):
+    """
+    A lazy, sliceable view of one converted channel. Slicing reads only the requested
+    samples, and applies the 'scale'/'offset' attributes of raw (compact) channels.
+    Attributes:
+        -name: channel name
+        -fs: sample rate in Hz (None if the recording duration wasn't saved)
+        -duration: length of the recording in seconds
+        -size: number of samples
+        -dtype: dtype of the values returned by slicing
+    """
+    def __init__(self,dset,name,duration=None,mmap=True):
+        self.name = name
+        self.dset = dset
+        self.size = dset.shape[0]
+        self.shape = dset.shape
+        attrs = dset.attrs
+        self.scaling = (attrs['scale'],attrs['offset']) if 'scale' in attrs else None
+        self.dtype = np.dtype(np.float64) if self.scaling != None else dset.dtype
+        self.duration = duration
+        self.fs = self.size/float(duration) if duration else None
+        self._data = _memmap(dset) if mmap else None
+        if self._data is None:
+            self._data = dset
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self,key):
+        data = np.array(self._data[key])
+        if self.scaling != None:
+            data = apply_scaling(data,self.scaling,np.float64)
+        return data
+
+    def __array__(self,dtype=None):
+        data = self[:]
+        return data if dtype == None else data.astype(dtype)
+
+    def __repr__(self):
+        return "<Signal {}: {} samples, {} Hz>".format(self.name,self.size,self.fs)
+
+    def index(self,t):
+        """
+        Returns the sample index at time t (in seconds from the start of the recording)
+        """
+        return int(np.clip(np.round(t*self.fs),0,self.size))
+
+    def time_slice(self,t0,t1):
+        """
+        Returns the samples between times t0 and t1 (in seconds from the start of the recording)
+        """
+        return self[self.index(t0):self.index(t1)]
+
+class Experiment(dict):
+    """
+    A dictionary of name:Signal pairs for one converted experiment, plus the recording
+    duration under 'time' (as returned by the process_* functions). Use as a context
+    manager, or call close(), to close the data files.
+    Attributes:
+        -path: experiment folder
+        -stim: stim data dictionary (as returned by stim_files.process_stim), or None
+            if the stim data hasn't been converted
+        -beats: beat table (see bp_files.save_beats), or None
+    """
+    def __init__(self,path):
+        dict.__init__(self)
+        self.path = path
+        self.stim = None
+        self.beats = None
+        self.handles = []
+
+    def subset(self,names):
+        """
+        Returns a new Experiment (sharing the same open files) with only the given signals
+        """
+        sub = Experiment(self.path)
+        sub.stim = self.stim
+        sub.beats = self.beats
+        for name in names:
+            sub[name] = self[name]
+        if 'time' in self:
+            sub['time'] = self['time']
+        return sub
+
+    def signals(self):
+        """
+        Returns the list of signal names
+        """
+        return [x for x in self if x != 'time']
+
+    def close(self):
+        for f in self.handles:
+            output_backends.close(f)
+        self.handles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+def open_experiment(path,mmap=True):
+    """
+    Opens the converted data in an experiment folder.
+    Args:
+        -path: experiment folder
+        -mmap: if True, memory maps the datasets that can be (uncompressed, contiguous
+            hdf5 datasets); otherwise all reads go through h5py/zarr
+    Returns:
+        -exp: Experiment dictionary of lazy signals
+    """
+    exp = Experiment(path)
+    for name in signal_files:
+        fname = _find(path,name)
+        if fname == None:
+            continue
+        f = output_backends.open_data(fname)
+        exp.handles.append(f)
+        duration = float(f['time'][()]) if 'time' in f else None
+        if duration != None and not 'time' in exp:
+            exp['time'] = duration
+        for chan in f:
+            if chan in tables or len(f[chan].shape) != 1:
+                continue
+            exp[chan] = Signal(f[chan],chan,duration,mmap)
+        if 'beats' in f:
+            exp.beats = f['beats'][:]
+    fname = _find(path,'stim_data')
+    if fname != None:
+        f = output_backends.open_data(fname)
+        exp.stim = {'start':f['start'][:],'stop':f['stop'][:],'intervals':f['intervals'][:],
+            'fs':f['intervals'].attrs['fs'],'n_samples':f['intervals'].attrs['n_samples']}
+        output_backends.close(f)
+    return exp
+
+def _find(path,name):
+    """
+    Returns the path of a converted data file in either backend, or None if it doesn't exist
+    """
+    for backend in output_backends.backends:
+        fname = output_backends.output_path(path,name,backend)
+        if os.path.exists(fname):
+            return fname
+    return None
+
+def _memmap(dset):
+    """
+    Returns a read-only memory map of an hdf5 dataset, or None if it can't be mapped
+    (zarr arrays, and chunked, compressed or empty datasets)
+    """
+    if output_backends._is_zarr(dset) or dset.chunks != None or dset.compression != None:
+        return None
+    try:
+        offset = dset.id.get_offset()
+    except Exception:
+        return None
+    if offset == None:
+        return None
+    return np.memmap(dset.file.filename,dtype=dset.dtype,mode='r',offset=offset,shape=dset.shape)
@@ -31,13 +31,6 @@ def bandpass_filter(data,lowcut=300,highcut=5000,fs=24414.0625,order=5):
 	if len(data.shape) > 1:
 		raise ValueError("Needs 1-D array!")
 	##define filter functions
-	def butter_bandpass(lowcut, highcut, fs, order=5):
-		nyq = 0.5 * fs
-		low = lowcut / nyq
-		high = highcut / nyq
-		b, a = butter(order, [low, high], btype='band')
-		return b, a
-
 	def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
 		b, a = butter_bandpass(lowcut, highcut, fs, order=order)
 		y = lfilter(b, a, data)
@@ -47,6 +40,51 @@ def bandpass_filter(data,lowcut=300,highcut=5000,fs=24414.0625,order=5):
 
 	return filtered
 
+def butter_bandpass(lowcut, highcut, fs, order=5):
+	"""
+	Returns the (b,a) coefficients of a Butterworth bandpass filter.
+
+	Args:
+
+		-lowcut: the low frequency corner (Hz)
+		-highcut: the high freq corner
+		-fs: the sample rate of the data
+		-order: the order of the butterworth filter
+
+	returns:
+		-b,a: filter coefficients
+	"""
+	nyq = 0.5 * fs
+	low = lowcut / nyq
+	high = highcut / nyq
+	b, a = butter(order, [low, high], btype='band')
+	return b, a
+
+def bandpass_filter_chunk(data,b,a,zi=None):
+	"""
+	Filters one chunk of a longer recording with the coefficients from 
+	butter_bandpass, carrying the filter state over from the previous chunk
+	so that there are no transients at the chunk boundaries. Filtering a
+	recording chunk-by-chunk gives the same result as one lfilter call over
+	all of it starting from the same state (the first sample), which differs
+	from bandpass_filter (zero initial state) near the start of the recording.
+
+	Args:
+
+		-data: 1-D numpy array holding the next chunk of data
+		-b,a: filter coefficients from butter_bandpass
+		-zi: filter state returned by the previous call. If None (first chunk), 
+			the state is initialized from the first sample to avoid a startup transient.
+
+	returns:
+		-filtered: 1-D numpy array of filtered data
+		-zf: filter state to pass in with the next chunk
+	"""
+	if zi is None:
+		zi = signal.lfilter_zi(b,a)*data[0]
+	filtered, zf = lfilter(b,a,data,zi=zi)
+	return filtered, zf
+
 def gauss_convolve(array, sigma, fs):
 	"""
 	takes in an array with dimenstions samples x trials.
@@ -58,9 +96,11 @@ def gauss_convolve(array, sigma, fs):
 		-sigma: width of the gaussian kernel in MS!!
 	"""
 	##remove singleton dimesions and make sure values are floats
-	array = array.squeeze().astype(float)
+	##(float32 data stays float32)
+	array = array.squeeze()
+	array = array.astype(np.result_type(array.dtype,np.float32),copy=False)
 	##allocate memory for result
-	result = np.zeros(array.shape)
+	result = np.zeros(array.shape,dtype=array.dtype)
 	##determine the width of the kernel in samples
 	sigma = sigma*(fs/1000.0)
 	##if the array is 2-D, handle each trial separately
@@ -0,0 +1,196 @@
+##meta_index.py
+
+##a persistent SQLite index of the XML metadata files, so that searching
+##through thousands of experiments doesn't mean re-parsing every XML file
+##for every query. Values are stored with their type (numbers as REAL, the
+##original string as TEXT) and comma-separated lists are split into one row
+##per element, so range/list/equality queries can use the indexes.
+
+import os
+import sqlite3
+import metadata
+
+##default location of the index database
+default_db = os.path.join(os.path.expanduser('~'),'.data_checkout','meta_index.sqlite')
+
+schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    experiment_id TEXT
+);
+CREATE TABLE IF NOT EXISTS attrs (
+    path TEXT,
+    key TEXT,
+    num REAL,
+    text TEXT,
+    is_list INTEGER
+);
+CREATE INDEX IF NOT EXISTS attrs_num ON attrs (key, num);
+CREATE INDEX IF NOT EXISTS attrs_text ON attrs (key, text);
+CREATE INDEX IF NOT EXISTS attrs_path ON attrs (path);
+CREATE INDEX IF NOT EXISTS files_id ON files (experiment_id);
+"""
+
+def connect(db_path=None):
+    """
+    Opens (and creates, if needed) the index database.
+    Args:
+        -db_path: path to the database file (default is ~/.data_checkout/meta_index.sqlite)
+    Returns:
+        -conn: sqlite3 connection
+    """
+    if db_path == None:
+        db_path = default_db
+    folder = os.path.dirname(db_path)
+    if folder != '' and not os.path.exists(folder):
+        os.makedirs(folder)
+    conn = sqlite3.connect(db_path)
+    conn.executescript(schema)
+    return conn
+
+def refresh_index(files,db_path=None):
+    """
+    Brings the index up to date for a list of metadata files. Only files that
+    are new or have changed (by mtime) since they were last indexed get parsed,
+    and entries for files that no longer exist are dropped.
+    Args:
+        -files: list of full file paths to XML metadata files
+        -db_path: path to the database file
+    Returns:
+        -n_updated: the number of files that were (re-)parsed
+    """
+    conn = connect(db_path)
+    try:
+        indexed = dict(conn.execute("SELECT path, mtime FROM files").fetchall())
+        stale = [x for x in indexed if not os.path.exists(x)]
+        to_parse = []
+        for f in files:
+            f = os.path.abspath(f)
+            mtime = os.path.getmtime(f)
+            if indexed.get(f) != mtime:
+                to_parse.append((f,mtime))
+        with conn:
+            for f in stale+[x[0] for x in to_parse]:
+                conn.execute("DELETE FROM files WHERE path = ?",(f,))
+                conn.execute("DELETE FROM attrs WHERE path = ?",(f,))
+            mdata = metadata.parse_meta_mp([x[0] for x in to_parse])
+            for (f,mtime),m in zip(to_parse,mdata):
+                conn.execute("INSERT INTO files VALUES (?,?,?)",(f,mtime,m.get('Experiment ID')))
+                conn.executemany("INSERT INTO attrs VALUES (?,?,?,?,?)",_attr_rows(f,m))
+    finally:
+        conn.close()
+    return len(to_parse)
+
+def query_index(criteria,files=None,db_path=None):
+    """
+    Finds the metadata files matching a set of criteria. Criteria follow the same
+    rules as search_attrib.search:
+        -a two-element tuple is a range (exclusive at both ends)
+        -a list is a set of allowed values
+        -anything else has to match exactly
+    For list-valued attributes (ie blood sample times), a file matches if any
+    element of the list matches. Files are matched the same way as by match_criteria,
+    which is used when searching without the index.
+    Args:
+        -criteria: dictionary of key:value pairs
+        -files: optional list of files to restrict the search to
+        -db_path: path to the database file
+    Returns:
+        -matches: list of matching file paths (in the order of 'files', if given)
+    """
+    sql = "SELECT path FROM files"
+    params = []
+    clauses = []
+    for key,val in criteria.items():
+        where,p = _criterion(val)
+        clauses.append("path IN (SELECT path FROM attrs WHERE key = ? AND ("+where+"))")
+        params += [key]+p
+    if len(clauses) > 0:
+        sql += " WHERE "+" AND ".join(clauses)
+    conn = connect(db_path)
+    try:
+        found = set([x[0] for x in conn.execute(sql,params).fetchall()])
+    finally:
+        conn.close()
+    if files == None:
+        return sorted(found)
+    return [f for f in files if os.path.abspath(f) in found]
+
+def match_criteria(m,criteria):
+    """
+    Checks a parsed metadata dictionary against a set of criteria, without the index.
+    The attribute values are split into the same rows that are stored in the index,
+    and each row is tested with the same conditions as the SQL query, so both ways
+    of searching give the same matches.
+    Args:
+        -m: metadata dictionary (see metadata.parse_meta_xml)
+        -criteria: dictionary of key:value pairs (see query_index)
+    Returns:
+        -match: True if the metadata matches every criterion
+    """
+    for key,val in criteria.items():
+        if m.get(key) == None:
+            return False
+        rows = _attr_rows(None,{key:m[key]})
+        if not any([_row_matches(r[2],r[3],val) for r in rows]):
+            return False
+    return True
+
+def _row_matches(num,text,val):
+    """
+    Tests one attrs row (its num and text values) against a search value; this is
+    the Python version of the condition built by _criterion
+    """
+    if type(val) == tuple:
+        return num != None and num > float(val[0]) and num < float(val[1])
+    elif type(val) == list:
+        return any([_row_matches(num,text,v) for v in val])
+    elif type(val) == bool:
+        return num == int(val) or (text != None and text.lower() == str(val).lower())
+    elif isinstance(val,(int,float)):
+        return num == float(val)
+    return text == val
+
+def _criterion(val):
+    """
+    Returns the SQL condition (on the attrs table) and parameters for one search value
+    (see _row_matches)
+    """
+    if type(val) == tuple:
+        return "num > ? AND num < ?",[float(val[0]),float(val[1])]
+    elif type(val) == list:
+        conds = []
+        params = []
+        for v in val:
+            c,p = _criterion(v)
+            conds.append("("+c+")")
+            params += p
+        return " OR ".join(conds),params
+    elif type(val) == bool:
+        return "num = ? OR lower(text) = ?",[int(val),str(val).lower()]
+    elif isinstance(val,(int,float)):
+        return "num = ?",[float(val)]
+    return "text = ?",[val]
+
+def _attr_rows(f,m):
+    """
+    Converts a metadata dictionary into rows for the attrs table
+    """
+    rows = []
+    for key,text in m.items():
+        val = metadata.convert_value(text)
+        if type(val) == list:
+            ##keep the full string, so exact matches still work, plus one row per element
+            rows.append((f,key,None,text,0))
+            tokens = [x.strip() for x in text.split(',') if x.strip() != '']
+            for v,t in zip(val,tokens):
+                if type(v) == float:
+                    rows.append((f,key,v,t,1))
+                else:
+                    rows.append((f,key,None,t,1))
+        elif type(val) == float:
+            rows.append((f,key,val,text.strip(),0))
+        else:
+            rows.append((f,key,None,text,0))
+    return rows
@@ -6,8 +6,17 @@
 ##by Ryan Neely 6/10/19
 
 import os
+import json
+import multiprocessing as mp
 import xml.etree.ElementTree as ET
 
+##caches of parsed experiment IDs and data folder listings. Entries are
+##invalidated by the mtime of the XML file/data folder, and can be saved
+##to disk with save_cache so they persist between sessions.
+_id_cache = {} ##xml path: [mtime, experiment ID]
+_folder_cache = {} ##data root: [mtime, {folder name: folder path}]
+default_cache = os.path.join(os.path.expanduser('~'),'.data_checkout','experiment_map.json')
+
 def get_fname(d):
     """
     a function to look for a metadata file, and then grab the 
@@ -18,7 +27,8 @@ def get_fname(d):
         fname(str): filename
     """
     ##first check to see if there is any XML files in the folder
-    xml_files = [x for x in os.listdir(d) if x.endswith('.xml')]
+    with os.scandir(d) as entries:
+        xml_files = [x.name for x in entries if x.name.endswith('.xml')]
     if len(xml_files) == 0:
         ##case where there is no XML file
         print("No metadata found for "+d+", default filename used")
@@ -29,16 +39,16 @@ def get_fname(d):
         ID = 'processed_data'
     elif len(xml_files) == 1:
         ##now go into the file and look for the experiment 
-        mdata = parse_meta_xml(os.path.join(d,xml_files[0]))
-        ID = mdata['Experiment ID']
+        ID = get_experiment_id(os.path.join(d,xml_files[0]))
     return ID
 
-def parse_meta_xml(f):
+def parse_meta_xml(f,typed=False):
     """
     A function to parse an XML metadata  (from labview) into a easier to handle
     Python dictionary.
     Inputs:
         -f: full path to the XML file in question
+        -typed: if True, values are converted from strings (see convert_value)
     Returns:
         -mdata: metadata dictionary with key:value pairs
     """
@@ -47,11 +57,43 @@ def parse_meta_xml(f):
     for child in root:
         if 'String' in child.tag:
             mdata[child[0].text] = child[1].text
+            if typed:
+                mdata[child[0].text] = convert_value(child[1].text)
     for child in root:
         if 'Boolean' in child.tag:
             mdata[child[0].text] = child[1].text
+            if typed:
+                mdata[child[0].text] = convert_value(child[1].text,boolean=True)
     return mdata
 
+def convert_value(text,boolean=False):
+    """
+    Converts a metadata string to the type it represents. Numbers become floats,
+    comma separated lists (ie 'Blood sample times (min from start)': '13,90,135')
+    become lists (of floats if possible), and everything else stays a string.
+    Inputs:
+        -text: the string value from the XML file
+        -boolean: if True, the value came from a Boolean element
+    Returns:
+        -value: the converted value (None if the entry was empty)
+    """
+    if text == None:
+        return None
+    text = text.strip()
+    if boolean:
+        return text.lower() in ['1','true']
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    if ',' in text:
+        items = [x.strip() for x in text.split(',') if x.strip() != '']
+        try:
+            return [float(x) for x in items]
+        except ValueError:
+            return items
+    return text
+
 
 def match_folder(m,d):
     """
@@ -63,15 +105,119 @@ def match_folder(m,d):
     returns:
         -f: path to the folder match for the metadata, or None if none is found
     """
-    m = parse_meta_xml(m)
-    experiment_id = m['Experiment ID']
-    folders = os.listdir(d)
-    try:
-        folder_idx = folders.index(experiment_id)
-        folder_path = os.path.join(d,folders[folder_idx])
-    except ValueError:
+    experiment_id = get_experiment_id(m)
+    folder_path = list_folders(d).get(experiment_id)
+    if folder_path == None:
         print("Can't find a folder match for {}".format(experiment_id))
-        folder_path = None
     return folder_path
 
+def match_folders(meta_files,d,cache_file=default_cache,n_procs=3):
+    """
+    Bulk version of match_folder. The data directory is only scanned once,
+    the XML files are parsed in parallel, and the experiment IDs and folder
+    listing are cached (and saved to cache_file) so that only new or
+    changed files/folders are looked at next time.
+    Args:
+        -meta_files: list of metadata files to match
+        -d: directory to look in for matched folders
+        -cache_file: file to load/save the cache from. If None, only the
+            in-memory cache is used.
+        -n_procs: number of processes to use for parsing XML files
+    Returns:
+        -matches: dictionary of metadata file: folder path (or None if no match is found)
+    """
+    if cache_file != None:
+        load_cache(cache_file)
+    ids = get_experiment_ids(meta_files,n_procs)
+    folders = list_folders(d)
+    matches = {}
+    for m in meta_files:
+        matches[m] = folders.get(ids[m])
+        if matches[m] == None:
+            print("Can't find a folder match for {}".format(ids[m]))
+    if cache_file != None:
+        save_cache(cache_file)
+    return matches
+
+def get_experiment_id(f):
+    """
+    Returns the experiment ID from a metadata file, using the cached
+    value if the file hasn't changed since it was last parsed.
+    Args:
+        -f: full path to the XML file
+    Returns:
+        -ID: the experiment ID (None if the file doesn't have one)
+    """
+    return get_experiment_ids([f],n_procs=1)[f]
+
+def get_experiment_ids(files,n_procs=3):
+    """
+    Returns the experiment IDs for a list of metadata files. Files that aren't
+    in the cache (or have changed) are parsed in parallel.
+    Args:
+        -files: list of full paths to XML files
+        -n_procs: number of processes to use for parsing
+    Returns:
+        -ids: dictionary of file: experiment ID
+    """
+    mtimes = dict([(f,os.path.getmtime(f)) for f in files])
+    stale = [f for f in files if not (f in _id_cache and _id_cache[f][0] == mtimes[f])]
+    for f,mdata in zip(stale,parse_meta_mp(stale,n_procs)):
+        _id_cache[f] = [mtimes[f],mdata.get('Experiment ID')]
+    return dict([(f,_id_cache[f][1]) for f in files])
+
+def parse_meta_mp(files,n_procs=3):
+    """
+    Parses a list of metadata files across multiple processes.
+    Args:
+        -files: list of full paths to XML files
+        -n_procs: number of processes to use
+    Returns:
+        -mdata: list of metadata dictionaries, in the same order as files
+    """
+    ##not worth starting a pool for a handful of files
+    if n_procs <= 1 or len(files) < 50:
+        return [parse_meta_xml(f) for f in files]
+    with mp.Pool(n_procs) as p:
+        mdata = p.map(parse_meta_xml,files,chunksize=max(1,len(files)//(4*n_procs)))
+    return mdata
+
+def list_folders(d):
+    """
+    Returns the folders in a data directory, using the cached listing
+    if the directory hasn't changed (folders added, removed or renamed)
+    since it was last scanned.
+    Args:
+        -d: directory to scan
+    Returns:
+        -folders: dictionary of folder name: full folder path
+    """
+    mtime = os.path.getmtime(d)
+    if d in _folder_cache and _folder_cache[d][0] == mtime:
+        return _folder_cache[d][1]
+    with os.scandir(d) as entries:
+        folders = dict([(x.name,x.path) for x in entries if x.is_dir()])
+    _folder_cache[d] = [mtime,folders]
+    return folders
+
+def load_cache(cache_file=default_cache):
+    """
+    Loads saved experiment IDs and folder listings into the in-memory cache
+    """
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+        _id_cache.update(cache['ids'])
+        _folder_cache.update(cache['folders'])
+
+def save_cache(cache_file=default_cache):
+    """
+    Saves the in-memory experiment ID and folder listing cache to disk
+    """
+    folder = os.path.dirname(cache_file)
+    if folder != '' and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(cache_file,'w') as f:
+        json.dump({'ids':_id_cache,'folders':_folder_cache},f)
+
 
@@ -0,0 +1,132 @@
+##output_backends.py
+
+##functions to write converted data to different storage formats.
+##HDF5 (the default) goes through a single h5py file handle in the parent
+##process. Zarr (local directory store) keeps each array as a folder of
+##compressed chunks, so pool workers can write their own region of each
+##array directly and in parallel.
+
+import numpy as np
+import os
+import shutil
+
+backends = ['hdf5','zarr']
+
+##zarr chunk size, in samples (~8MB of float64 per chunk)
+zarr_chunks = 2**20
+
+def output_path(folder,name,backend='hdf5'):
+    """
+    Returns the full path of an output data file for a given backend.
+    Args:
+        -folder: folder to save to
+        -name: name of the data file without extension (ie 'ephys_data')
+        -backend: 'hdf5' or 'zarr'
+    Returns:
+        -path: full path to the data file (ie folder/ephys_data.hdf5)
+    """
+    assert backend in backends, "Unknown backend: "+str(backend)
+    return os.path.join(folder,name+'.'+backend)
+
+def open_output(path,backend='hdf5',mode='w'):
+    """
+    Opens an output data file for writing.
+    Args:
+        -path: full path to the data file
+        -backend: 'hdf5' or 'zarr'
+        -mode: file mode
+    Returns:
+        -f_out: h5py File or zarr Group. Both support create_dataset and
+            item access in the same way.
+    """
+    if backend == 'zarr':
+        import zarr
+        return zarr.open_group(path,mode=mode)
+    import h5py
+    return h5py.File(path,mode)
+
+def open_data(path,mode='r'):
+    """
+    Opens a converted data file, picking the backend from the file extension.
+    Args:
+        -path: full path to the data file (.hdf5 or .zarr)
+    Returns:
+        -f: h5py File or zarr Group
+    """
+    if path.endswith('.zarr'):
+        return open_output(path,'zarr',mode)
+    return open_output(path,'hdf5',mode)
+
+def close(f):
+    """
+    Closes a data file from open_output/open_data (zarr groups don't need closing)
+    """
+    if hasattr(f,'close'):
+        f.close()
+
+def create_channel(f_out,name,n_samples,dtype='float64'):
+    """
+    Creates an empty array for one channel, sized for the full recording.
+    Args:
+        -f_out: file from open_output
+        -name: channel name
+        -n_samples: total number of samples in the channel
+        -dtype: data type
+    Returns:
+        -dset: the new dataset/array
+    """
+    if _is_zarr(f_out):
+        from numcodecs import Blosc
+        return f_out.create_dataset(name,shape=(n_samples,),dtype=dtype,
+            chunks=(min(zarr_chunks,max(n_samples,1)),),
+            compressor=Blosc(cname='zstd',clevel=3,shuffle=Blosc.SHUFFLE))
+    return f_out.create_dataset(name,shape=(n_samples,),dtype=dtype)
+
+def append_channel(f_out,name,data):
+    """
+    Appends data to the end of a channel, creating it (as a resizable
+    dataset) if it doesn't exist yet.
+    Args:
+        -f_out: file from open_output
+        -name: channel name
+        -data: 1-D data array to append
+    """
+    if not name in f_out:
+        if _is_zarr(f_out):
+            ##not create_channel, which would size the chunks to the (empty) array
+            from numcodecs import Blosc
+            dset = f_out.create_dataset(name,shape=(0,),dtype=data.dtype,chunks=(zarr_chunks,),
+                compressor=Blosc(cname='zstd',clevel=3,shuffle=Blosc.SHUFFLE))
+        else:
+            dset = f_out.create_dataset(name,shape=(0,),maxshape=(None,),dtype=data.dtype,
+                chunks=(min(zarr_chunks,max(data.size,1)),))
+    else:
+        dset = f_out[name]
+    n = dset.shape[0]
+    dset.resize((n+data.size,))
+    dset[n:] = data
+
+def write_region(path,regions,offset):
+    """
+    Writes one file's worth of data into existing zarr arrays. Meant to be called
+    from pool workers, each writing a different region; a process synchronizer
+    locks any chunks that are shared between two regions.
+    Args:
+        -path: full path to the zarr data file
+        -regions: dictionary of array name:data array pairs to write
+        -offset: the sample index where the data starts
+    """
+    import zarr
+    sync = zarr.ProcessSynchronizer(path+'.sync')
+    group = zarr.open_group(path,mode='r+',synchronizer=sync)
+    for name,data in regions.items():
+        group[name][offset:offset+data.size] = data
+
+def remove_sync(path):
+    """
+    Removes the lock files left behind by write_region
+    """
+    shutil.rmtree(path+'.sync',ignore_errors=True)
+
+def _is_zarr(f):
+    return type(f).__module__.startswith('zarr')
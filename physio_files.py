@@ -8,9 +8,12 @@
 
 import numpy as np
 import h5py
-import nptdms
 import os
 from tdms_files import downsample, get_duration_seconds, order_files
+from tdms_files import open_tdms, prefetch, load_channel, stack_channel, set_scaling_attrs, file_lengths, concat_files
+import profiling
+import cache
+import qc_stats
 
 ##a lookup table for channel names in serial data
 serial_chans = {
@@ -23,7 +26,7 @@ serial_chans = {
 }
 
 
-def save_physio(files,path_out=None,resample=False,load_time=True):
+def save_physio(files,path_out=None,resample=False,load_time=True,compact=False):
     """
     Function to create hdf5 file from physiological monitor data.
     Args:
@@ -32,6 +35,8 @@ def save_physio(files,path_out=None,resample=False,load_time=True):
             not specified, file is saved in same location as input files.
         -resample: if a number, will resample at "resample" hz
         -load_time: if True, loads duration of the recording in seconds
+        -compact: if True, saves the raw integer samples with 'scale' and 'offset'
+            attributes where the files have them, and float32 otherwise
     Returns:
         None; data saved in specified location
     """
@@ -44,18 +49,27 @@ def save_physio(files,path_out=None,resample=False,load_time=True):
     path_out = os.path.join(path_out,'physio_data.hdf5')
     f_out = h5py.File(path_out,'w')
     dsets = []
-    for f in files:
+    for f in prefetch(files):
         print("loading "+f)
-        data = load_physio(f,resample,load_time)
+        data = load_physio(f,resample,load_time,compact,qc=True)
         dsets.append(data)
+    qc = [x.pop('qc') for x in dsets]
     for chan in serial_chans.values():
-        f_out.create_dataset(chan,data=np.hstack([x[chan] for x in dsets]))
+        with profiling.span('hstack') as rec:
+            chan_data,scaling = stack_channel(dsets,chan)
+            rec['samples'] = chan_data.size
+        with profiling.span('hdf5_write',path_out) as rec:
+            dset = f_out.create_dataset(chan,data=chan_data)
+            set_scaling_attrs(dset,scaling)
+            rec['bytes_written'] = chan_data.nbytes
     if load_time:
         times = [x['time'] for x in dsets]
         f_out.create_dataset("time",data=np.asarray(np.sum(times)))
+    qc_stats.write_qc(f_out,qc,files)
     f_out.close()
 
-def process_physio(files,resample=False,load_time=True):
+@cache.cached
+def process_physio(files,resample=False,load_time=True,compact=False,mmap=None):
     """
     A function to load the contents of all physio monitor
     files from one experiment folder into memory
@@ -63,25 +77,36 @@ def process_physio(files,resample=False,load_time=True):
         -files: list of files to load/concatinate
         -resample: if a number, will resample at "resample" hz
         -load_time: if True, loads the duration of the recording in seconds
+        -compact: if True, keeps raw integer samples where the files have them
+            (and float32 otherwise). The (scale,offset) of each raw channel is
+            returned in dsets['scaling'].
+        -mmap: optional folder; if given, the data arrays are np.memmap files in it
     Returns:
         -dsets: full concatinated data sets
     """
     global serial_chans
     ##order the files
     files = order_files(files)
-    tdms = []
-    dsets = {}
-    for f in files:
-        print("loading "+f)
-        data = load_physio(f,resample,load_time)
-        tdms.append(data)
-    for chan in serial_chans.values():
-        dsets[chan] = np.hstack([x[chan] for x in tdms])
+    ##size the output from the file headers, and fill it as each file is loaded
+    lengths = file_lengths(files,list(serial_chans)[0],resample)
+    with profiling.span('fill') as rec:
+        tdms,scalings = concat_files(iter_physio(files,resample,load_time,compact),lengths,mmap)
+        rec['samples'] = profiling.nbytes(tdms)[1]
+    dsets = dict([(chan,tdms[chan]) for chan in serial_chans.values()])
+    if compact:
+        dsets['scaling'] = dict([(chan,scalings[chan]) for chan in serial_chans.values()])
     if load_time:
-        times = [x['time'] for x in tdms]
-        dsets['time'] = np.sum(times)
+        dsets['time'] = tdms['time']
     return dsets
 
+def iter_physio(files,resample=False,load_time=True,compact=False):
+    """
+    Yields the data dictionary of each file in turn (see load_physio)
+    """
+    for f in files:
+        print("loading "+f)
+        yield load_physio(f,resample,load_time,compact)
+
 def process_physio2(files, resample=False, load_time=True, hd5_output_name=None):
     """
     A function to load the contents of all physio monitor
@@ -121,7 +146,7 @@ def process_physio2(files, resample=False, load_time=True, hd5_output_name=None)
     return dsets
 
 
-def load_physio(path,resample=False,load_time=True):
+def load_physio(path,resample=False,load_time=True,compact=False,qc=False):
     """
     A function to load a TDMS dataset aquired from the SomnoSuite
     serial pipe.
@@ -129,21 +154,33 @@ def load_physio(path,resample=False,load_time=True):
         -path: full path to the datafile
         -resample: if a number, resamples the data to 'resample' Hz
         -load_time: if True, includes the duration of the recording in seconds
+        -compact: if True, loads raw integer samples (or float32) instead of
+            float64; see tdms_files.load_channel. The scaling of each channel
+            is returned in data['scaling'].
+        -qc: if True, the QC statistics of each channel (see qc_stats.tdms_qc), computed
+            at the full sample rate, are returned in data['qc']
     Returns:
         -data: dictionary of data arrays arranged by channel names
     """
     global serial_chans
     ##load our file
-    tdms_file = nptdms.TdmsFile(path)
+    with profiling.span('tdms_decode',path) as rec:
+        tdms_file = open_tdms(path)
+        rec['bytes_read'] = os.path.getsize(path)
     ##load the data into arrays and put into a dictionary
     data = {}
+    scalings = {}
+    channel_objects = []
     for chan in list(serial_chans.keys()):
         channel_object = tdms_file.object('Untitled',chan)
-        if resample:
-            chan_data = downsample(channel_object,resample)
-        else:
-            chan_data = channel_object.data
-        data[serial_chans[chan]] = chan_data
+        channel_objects.append(channel_object)
+        data[serial_chans[chan]],scalings[serial_chans[chan]] = load_channel(channel_object,resample,compact)
+    duration = get_duration_seconds(channel_object)/10.0 ##not sure why I need to use this scale factor here, but LabView seems to be saving the wf increment at the wrong value (1 instead of 10?)
+    if qc:
+        with profiling.span('qc_stats',path):
+            data['qc'] = qc_stats.tdms_qc(channel_objects,list(serial_chans.values()),'physio',duration)
+    if compact:
+        data['scaling'] = scalings
     if load_time:
-        data['time'] = get_duration_seconds(channel_object)/10.0 ##not sure why I need to use this scale factor here, but LabView seems to be saving the wf increment at the wrong value (1 instead of 10?)
+        data['time'] = duration
     return data
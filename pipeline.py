@@ -0,0 +1,130 @@
+##pipeline.py
+
+##a pipelined conversion engine: reader processes decode TDMS files,
+##compute processes resample/detect, and the parent process writes the
+##results in file order. The stages are connected by bounded queues, so
+##disk reads, CPU work and disk writes overlap, while the number of files
+##held in memory at once is capped.
+
+import multiprocessing as mp
+import traceback
+from queue import Empty
+import profiling
+
+def run_pipeline(files,read_fn,compute_fn,write_fn,compute_args=(),n_readers=2,
+    n_workers=2,depth=2):
+    """
+    Runs each file through read_fn -> compute_fn -> write_fn, with the stages
+    running concurrently.
+    Args:
+        -files: ordered list of file paths
+        -read_fn: function taking a path and returning the decoded data (runs in
+            a reader process; must be a module-level function)
+        -compute_fn: function taking the output of read_fn (plus compute_args) and
+            returning the result to write (runs in a worker process; must be a
+            module-level function)
+        -write_fn: function taking (index, result), called in the parent process
+            in file order
+        -compute_args: tuple of extra arguments for compute_fn
+        -n_readers: number of reader processes
+        -n_workers: number of compute processes
+        -depth: maximum number of items waiting in each queue
+    Returns:
+        None
+    """
+    ##files (read, being processed or waiting to be written) that can be in memory at once
+    max_inflight = n_readers+n_workers+2*depth
+    tokens = mp.Semaphore(max_inflight)
+    path_q = mp.Queue()
+    read_q = mp.Queue(depth)
+    out_q = mp.Queue(depth)
+    for i,f in enumerate(files):
+        path_q.put((i,f))
+    for i in range(n_readers):
+        path_q.put(None)
+    readers = [mp.Process(target=_reader,args=(read_fn,path_q,read_q,out_q,tokens)) for i in range(n_readers)]
+    workers = [mp.Process(target=_worker,args=(compute_fn,compute_args,read_q,out_q)) for i in range(n_workers)]
+    for p in readers+workers:
+        p.daemon = True
+        p.start()
+    try:
+        waiting = {} ##results that arrived out of order
+        next_idx = 0
+        while next_idx < len(files):
+            item = _get_result(out_q,readers+workers)
+            if item[0] == 'error':
+                raise RuntimeError("Pipeline stage failed:\n"+item[1])
+            waiting[item[0]] = item[1]
+            while next_idx in waiting:
+                with profiling.span('write',files[next_idx]):
+                    write_fn(next_idx,waiting.pop(next_idx))
+                tokens.release()
+                next_idx += 1
+        for i in range(n_workers):
+            read_q.put(None)
+        for p in readers+workers:
+            p.join()
+    finally:
+        for p in readers+workers:
+            if p.is_alive():
+                p.terminate()
+
+def _get_result(out_q,procs):
+    """
+    Takes the next item off out_q, checking that the stage processes are still
+    running while it waits. Raises a RuntimeError if one of them dies without
+    reporting an error (ie it was killed for running out of memory), or if they
+    have all exited and nothing more can arrive.
+    """
+    while True:
+        try:
+            return out_q.get(timeout=1.0)
+        except Empty:
+            pass
+        dead = [p for p in procs if p.exitcode != None and p.exitcode != 0]
+        if len(dead) > 0:
+            raise RuntimeError("Pipeline stage {} exited with code {}".format(dead[0].name,dead[0].exitcode))
+        if not any([p.is_alive() for p in procs]):
+            ##one last look, in case the result arrived as the last process exited
+            try:
+                return out_q.get(timeout=1.0)
+            except Empty:
+                raise RuntimeError("Pipeline stages exited before all files were processed")
+
+def _reader(read_fn,path_q,read_q,out_q,tokens):
+    """
+    Reader process: takes file paths off path_q and puts the decoded data on read_q.
+    A token is taken before claiming each file, and given back by the parent once
+    that file is written, which caps the number of files in memory.
+    """
+    while True:
+        tokens.acquire()
+        item = path_q.get()
+        if item == None:
+            tokens.release()
+            break
+        i,path = item
+        try:
+            with profiling.span('read',path):
+                data = read_fn(path)
+        except Exception:
+            out_q.put(('error',traceback.format_exc()))
+            break
+        read_q.put((i,data))
+
+def _worker(compute_fn,compute_args,read_q,out_q):
+    """
+    Compute process: takes decoded data off read_q and puts the results on out_q.
+    """
+    while True:
+        item = read_q.get()
+        if item == None:
+            break
+        i,data = item
+        try:
+            with profiling.span('compute'):
+                result = compute_fn(data,*compute_args)
+        except Exception:
+            out_q.put(('error',traceback.format_exc()))
+            break
+        out_q.put((i,result))
@@ -0,0 +1,182 @@
+##profiling.py
+
+##opt-in instrumentation for the conversion functions. When profiling is
+##enabled, each instrumented stage records a "span" with its wall time, bytes
+##read/written, number of samples processed and the peak memory of the process.
+##Spans are spooled to disk (one file per process), so stages that run in a
+##multiprocessing pool are captured along with the ones in the parent process.
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import glob
+import tempfile
+import resource
+from contextlib import contextmanager
+
+##environment variable holding the spool folder; it is inherited by pool workers
+profile_env = 'DATA_CHECKOUT_PROFILE'
+
+##functions called with each finished span (in the process that recorded it)
+hooks = []
+
+def enable(spool_dir=None):
+    """
+    Turns on profiling for this process and any processes it starts.
+    Args:
+        -spool_dir: folder to write spans to. If None, a temporary folder is created.
+    Returns:
+        -spool_dir: the spool folder
+    """
+    if spool_dir == None:
+        spool_dir = tempfile.mkdtemp(prefix='profile_')
+    if not os.path.exists(spool_dir):
+        os.makedirs(spool_dir)
+    os.environ[profile_env] = spool_dir
+    return spool_dir
+
+def disable():
+    """
+    Turns off profiling (spans already recorded are kept in the spool folder)
+    """
+    os.environ.pop(profile_env,None)
+
+def is_enabled():
+    return profile_env in os.environ
+
+def add_hook(fn):
+    """
+    Registers a function to be called with each span dictionary as it finishes,
+    ie to forward spans to other tooling. Hooks are called in the process that recorded
+    the span, so register them before any worker pools are started.
+    """
+    hooks.append(fn)
+
+def remove_hook(fn):
+    hooks.remove(fn)
+
+@contextmanager
+def span(stage,path=None,**fields):
+    """
+    Context manager to time one stage of processing. The yielded dictionary can be
+    updated with 'bytes_read', 'bytes_written' and 'samples' (or any other values)
+    from inside the block. Does nothing if profiling is not enabled.
+    Args:
+        -stage: name of the stage (ie 'tdms_decode', 'decimate', 'hdf5_write')
+        -path: the file being processed, if any
+        -**fields: any other values to record
+    """
+    if not is_enabled():
+        yield {}
+        return
+    record = {'stage':stage,'file':path,'pid':os.getpid(),
+        'bytes_read':0,'bytes_written':0,'samples':0}
+    record.update(fields)
+    record['start'] = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = time.perf_counter()-t0
+        record['peak_rss_mb'] = _maxrss_mb()
+        _emit(record)
+
+def nbytes(data):
+    """
+    Returns the total number of bytes and samples in an array, or a dictionary/list of arrays
+    """
+    if isinstance(data,dict):
+        data = list(data.values())
+    elif not isinstance(data,(list,tuple)):
+        data = [data]
+    arrays = [x for x in data if isinstance(x,np.ndarray)]
+    return sum([x.nbytes for x in arrays]),sum([x.size for x in arrays])
+
+def collect(spool_dir=None):
+    """
+    Reads back all the spans recorded in the spool folder.
+    Args:
+        -spool_dir: spool folder (defaults to the current one)
+    Returns:
+        -spans: list of span dictionaries, in order of start time
+    """
+    if spool_dir == None:
+        spool_dir = os.environ[profile_env]
+    spans = []
+    for fname in glob.glob(os.path.join(spool_dir,'*.jsonl')):
+        with open(fname) as f:
+            spans += [json.loads(x) for x in f if x.strip()]
+    spans.sort(key=lambda x:x['start'])
+    return spans
+
+def report(path=None,spool_dir=None,show=True):
+    """
+    Summarizes the recorded spans by stage and by file, optionally saving the
+    report as JSON and printing a summary table.
+    Args:
+        -path: if given, the JSON report is written here
+        -spool_dir: spool folder (defaults to the current one)
+        -show: if True, prints the summary table
+    Returns:
+        -result: dictionary with 'stages', 'files' and the raw 'spans'
+    """
+    spans = collect(spool_dir)
+    result = {'stages':_summarize(spans,'stage'),
+        'files':_summarize([x for x in spans if x['file'] != None],'file'),
+        'spans':spans}
+    if path != None:
+        with open(path,'w') as f:
+            json.dump(result,f,indent=2)
+    if show:
+        print_table(result['stages'])
+    return result
+
+def print_table(stages):
+    """
+    Prints the per-stage summary from report()
+    """
+    print("{:<20}{:>7}{:>11}{:>12}{:>12}{:>14}{:>10}".format(
+        'stage','calls','wall (s)','read (MB)','write (MB)','samples','peak MB'))
+    for name,s in sorted(stages.items(),key=lambda x:-x[1]['wall_s']):
+        print("{:<20}{:>7}{:>11.2f}{:>12.1f}{:>12.1f}{:>14}{:>10.0f}".format(
+            name,s['count'],s['wall_s'],s['bytes_read']/1e6,s['bytes_written']/1e6,
+            s['samples'],s['peak_rss_mb']))
+
+def _summarize(spans,key):
+    """
+    Totals the spans grouped by one of their fields
+    """
+    result = {}
+    for s in spans:
+        if not s[key] in result:
+            result[s[key]] = {'count':0,'wall_s':0.0,'bytes_read':0,
+                'bytes_written':0,'samples':0,'peak_rss_mb':0.0}
+        r = result[s[key]]
+        r['count'] += 1
+        r['wall_s'] += s['wall_s']
+        r['bytes_read'] += s['bytes_read']
+        r['bytes_written'] += s['bytes_written']
+        r['samples'] += s['samples']
+        r['peak_rss_mb'] = max(r['peak_rss_mb'],s['peak_rss_mb'])
+    return result
+
+def _emit(record):
+    """
+    Writes a finished span to this process's spool file and calls any hooks
+    """
+    fname = os.path.join(os.environ[profile_env],'{}.jsonl'.format(os.getpid()))
+    with open(fname,'a') as f:
+        f.write(json.dumps(record,default=float)+'\n')
+    for fn in hooks:
+        fn(record)
+
+def _maxrss_mb():
+    """
+    Peak resident memory of this process, in MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss/1e6
+    return rss/1e3
@@ -0,0 +1,241 @@
+##qc_report.py
+
+##headless version of the checkout_data plots, for checking a batch of
+##experiments at once (ie overnight). Each experiment's BP, physio and ephys
+##quick-look figures are rendered to PNG with the Agg backend, along with an
+##HTML page to view them, and experiments are processed in parallel on a pool.
+##Instead of resampling the full recordings, each file is reduced to a
+##min/max/mean envelope as it is read, so only one file's data is in memory
+##at a time and short events (spikes, dropouts) still show up in the plots.
+
+import numpy as np
+import os
+import multiprocessing as mp
+from tdms_files import sort_tdms, order_files, open_tdms, file_ids
+
+##width of each envelope bin, in seconds
+bin_seconds = {'bp':1.0,'physio':10.0,'ephys':1.0}
+
+##maximum number of ephys channels to plot
+max_ephys_chans = 8
+
+##groups that the data channels can be saved under
+groups = ['Group Name','ephys','Untitled']
+
+def envelope(y,n):
+    """
+    Reduces a data array to the min, max and mean of each block of n samples.
+    Args:
+        -y: 1-D data array
+        -n: number of samples per block (a partial last block is included)
+    Returns:
+        -lo,hi,mean: arrays with one value per block
+    """
+    n = max(int(n),1)
+    n_blocks = int(np.ceil(y.size/float(n)))
+    pad = n_blocks*n-y.size
+    y = np.hstack([y.astype(np.float64),np.full(pad,np.nan)]).reshape(n_blocks,n)
+    return np.nanmin(y,axis=1),np.nanmax(y,axis=1),np.nanmean(y,axis=1)
+
+def get_channel(tdms_file,chan):
+    """
+    Returns a channel object from whichever group it's saved under
+    """
+    for g in groups:
+        try:
+            return tdms_file.object(g,chan)
+        except KeyError:
+            pass
+    raise KeyError(chan)
+
+def file_envelopes(files,chans,bin_s,scale=1.0,dt_scale=1.0):
+    """
+    Computes the envelope of a set of channels across an ordered list of files,
+    one file at a time.
+    Args:
+        -files: list of TDMS file paths
+        -chans: list of channel names
+        -bin_s: width of each envelope bin, in seconds
+        -scale: factor to multiply the data by (ie to convert units)
+        -dt_scale: correction to the wf_increment (see alignment.increment_correction)
+    Returns:
+        -env: dictionary with 'time' (bin start times in minutes) and a (lo,hi,mean)
+            tuple of arrays for each channel
+    """
+    result = dict([(c,[]) for c in chans])
+    times = []
+    t0 = 0.0
+    for path in order_files(files):
+        tdms_file = open_tdms(path)
+        for c in chans:
+            channel_object = get_channel(tdms_file,c)
+            dt = channel_object.properties['wf_increment']*dt_scale
+            n = int(np.round(bin_s/dt))
+            result[c].append(envelope(channel_object.data*scale,n))
+        times.append(t0+np.arange(result[c][-1][0].size)*n*dt)
+        t0 += channel_object.data.size*dt
+    env = {'time':np.hstack(times)/60.0}
+    for c in chans:
+        env[c] = tuple([np.hstack([x[i] for x in result[c]]) for i in range(3)])
+    return env
+
+def plot_envelope(ax,time,env,color):
+    """
+    Plots an envelope from file_envelopes as a shaded min/max band with the mean on top
+    """
+    lo,hi,mean = env
+    ax.fill_between(time,lo,hi,color=color,alpha=0.4,linewidth=0)
+    ax.plot(time,mean,color=color,linewidth=0.5)
+
+def render_bp(file_dict,out_dir):
+    """
+    Saves the BP quick-look figure (pulse waveform, in mmHg) to out_dir/bp.png
+    Returns:
+        -fname: name of the saved figure, or None if there is no BP data
+    """
+    import matplotlib.pyplot as plt
+    if len(file_dict['lowspeed']) > 0:
+        files = file_dict['lowspeed']
+    else:
+        files = file_dict['highspeed']
+    if len(files) == 0:
+        return None
+    env = file_envelopes(files,['pulse_wf'],bin_seconds['bp'],scale=100.0)
+    fig,ax = plt.subplots(1,figsize=(10,3))
+    plot_envelope(ax,env['time'],env['pulse_wf'],'r')
+    fig.suptitle("Blood pressure waveform",fontsize=12)
+    ax.set_xlabel("Time, mins",fontsize=12)
+    ax.set_ylabel("Pressure, mmHg",fontsize=12)
+    fig.savefig(os.path.join(out_dir,'bp.png'),dpi=100)
+    plt.close(fig)
+    return 'bp.png'
+
+def render_physio(file_dict,out_dir):
+    """
+    Saves the physio quick-look figure (sp02, heart rate, core temperature) to out_dir/physio.png
+    Returns:
+        -fname: name of the saved figure, or None if there is no physio data
+    """
+    import matplotlib.pyplot as plt
+    from alignment import increment_correction
+    from physio_files import serial_chans
+    files = file_dict['physio']
+    if len(files) == 0:
+        return None
+    ##channel names in the TDMS files
+    names = dict([(v,k) for k,v in serial_chans.items()])
+    chans = [(names['sp02'],"Oxygen saturation","Percent saturated",'blue'),
+        (names['heart_rate2'],"Heart rate","BPM",'black'),
+        (names['core_temp'],"Core temperature","Degrees Celcius",'green')]
+    env = file_envelopes(files,[x[0] for x in chans],bin_seconds['physio'],
+        dt_scale=increment_correction['physio'])
+    fig,axes = plt.subplots(nrows=3,ncols=1,sharex=True,figsize=(10,7))
+    for ax,(chan,title,label,color) in zip(axes,chans):
+        plot_envelope(ax,env['time'],env[chan],color)
+        ax.set_title(title,fontsize=12)
+        ax.set_ylabel(label,fontsize=12)
+    axes[-1].set_xlabel("Time, mins",fontsize=12)
+    fig.tight_layout()
+    fig.savefig(os.path.join(out_dir,'physio.png'),dpi=100)
+    plt.close(fig)
+    return 'physio.png'
+
+def render_ephys(file_dict,out_dir):
+    """
+    Saves the ephys quick-look figure (envelope of each ephys channel, in uV) to out_dir/ephys.png
+    Returns:
+        -fname: name of the saved figure, or None if there is no ephys data
+    """
+    import matplotlib.pyplot as plt
+    files = order_files(file_dict['highspeed'])
+    if len(files) == 0:
+        return None
+    ids = file_ids(open_tdms(files[0]))
+    chans = [c for g in ids for c in ids[g] if 'amp' in c][:max_ephys_chans]
+    if len(chans) == 0:
+        return None
+    env = file_envelopes(files,chans,bin_seconds['ephys'],scale=1e6)
+    fig,axes = plt.subplots(nrows=len(chans),ncols=1,sharex=True,squeeze=False,
+        figsize=(10,1.5*len(chans)+1))
+    for ax,chan in zip(axes[:,0],chans):
+        plot_envelope(ax,env['time'],env[chan],'orange')
+        ax.set_ylabel(chan+", uV",fontsize=10)
+    axes[-1,0].set_xlabel("Time, mins",fontsize=12)
+    fig.tight_layout()
+    fig.savefig(os.path.join(out_dir,'ephys.png'),dpi=100)
+    plt.close(fig)
+    return 'ephys.png'
+
+def render_experiment(path,out_dir=None):
+    """
+    Renders the quick-look figures for one experiment folder, plus an index.html to view them.
+    Errors in one figure are noted on the page instead of stopping the others.
+    Args:
+        -path: experiment folder
+        -out_dir: folder to save the report to (default is path/qc)
+    Returns:
+        -result: dictionary with the experiment 'path', the report folder ('out_dir'),
+            the saved 'figures' and any 'errors'
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    if out_dir == None:
+        out_dir = os.path.join(path,'qc')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    file_dict = sort_tdms(path)
+    result = {'path':path,'out_dir':out_dir,'figures':[],'errors':[]}
+    for name,fn in [('physio',render_physio),('bp',render_bp),('ephys',render_ephys)]:
+        try:
+            fname = fn(file_dict,out_dir)
+            if fname != None:
+                result['figures'].append(fname)
+        except Exception as e:
+            result['errors'].append("{}: {}".format(name,repr(e)))
+    with open(os.path.join(out_dir,'index.html'),'w') as f:
+        f.write(_page(path,[(x,x) for x in result['figures']],result['errors']))
+    return result
+
+def batch_report(folders,out_dir=None,n_procs=3):
+    """
+    Renders the quick-look figures for a list of experiment folders in parallel.
+    Args:
+        -folders: list of experiment folders
+        -out_dir: if given, each experiment's report is saved in a subfolder of out_dir
+            (named after the experiment folder), along with a summary.html linking them all.
+            Otherwise reports are saved in each experiment's qc folder.
+        -n_procs: number of worker processes
+    Returns:
+        -results: list of results from render_experiment, in the order of folders
+    """
+    args = []
+    for path in folders:
+        if out_dir != None:
+            args.append((path,os.path.join(out_dir,os.path.basename(os.path.normpath(path)))))
+        else:
+            args.append((path,None))
+    with mp.Pool(n_procs) as p:
+        results = p.starmap(render_experiment,args)
+    if out_dir != None:
+        figures = []
+        errors = []
+        for r in results:
+            rel = os.path.relpath(r['out_dir'],out_dir)
+            figures += [(os.path.join(rel,x),r['path']+': '+x) for x in r['figures']]
+            errors += [r['path']+': '+x for x in r['errors']]
+        with open(os.path.join(out_dir,'summary.html'),'w') as f:
+            f.write(_page("QC summary",figures,errors))
+    for r in results:
+        print("{}: {} figure(s), {} error(s)".format(r['path'],len(r['figures']),len(r['errors'])))
+    return results
+
+def _page(title,figures,errors):
+    """
+    Returns a simple HTML page showing a list of (image path,caption) figures and any errors
+    """
+    html = "<html><head><title>{0}</title></head><body><h2>{0}</h2>\n".format(title)
+    for e in errors:
+        html += "<p style='color:red'>{}</p>\n".format(e)
+    for src,caption in figures:
+        html += "<p>{}</p><img src='{}' style='max-width:100%'>\n".format(caption,src)
+    return html+"</body></html>\n"
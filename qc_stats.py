@@ -0,0 +1,204 @@
+##qc_stats.py
+
+##per-channel quality control statistics, computed by the save_* converters
+##while they write the data (so nothing has to be read back afterwards). Each
+##file is summarized as it goes past, and the per-file summaries are merged
+##into totals for the whole recording. Totals are stored as 'qc_*' attributes
+##on each channel's dataset, and the per-file breakdown as a table in the 'qc'
+##group, so a bad file can be found without loading any samples.
+
+import numpy as np
+import os
+import epochs
+import output_backends
+from tdms_files import apply_scaling, data_chans, get_raw_scaling
+
+##how long a channel has to hold exactly the same value to count as flatlined, in seconds
+flat_seconds = {'ephys':0.01,'bp':5.0,'physio':60.0}
+
+##minimum flat run length (in samples) if the sample rate isn't known
+default_flat_run = 100
+
+##statistics saved for each channel, in the order of the per-file table
+fields = ['n','nan','min','max','mean','std','flat_runs','flat_samples',
+    'longest_flat','clipped','dropout_rate']
+
+def new_qc():
+    """
+    Returns an empty statistics accumulator for one channel
+    """
+    return {'n':0,'nan':0,'min':np.inf,'max':-np.inf,'moments':epochs.new_stats(),
+        'flat_runs':0,'flat_samples':0,'longest_flat':0,'flat_values':{}}
+
+def update_qc(acc,y,min_run=default_flat_run):
+    """
+    Adds a block of samples to a channel's statistics accumulator. Flat runs are
+    counted within each block, so a run that spans two blocks is counted as two.
+    Args:
+        -acc: accumulator from new_qc
+        -y: 1-D data array
+        -min_run: number of identical samples in a row that counts as a flatline
+    """
+    y = np.asarray(y,dtype=np.float64)
+    if y.size == 0:
+        return
+    nan = np.isnan(y)
+    valid = y[~nan]
+    acc['n'] += y.size
+    acc['nan'] += int(nan.sum())
+    if valid.size > 0:
+        acc['min'] = min(acc['min'],valid.min())
+        acc['max'] = max(acc['max'],valid.max())
+        epochs.update_stats(acc['moments'],valid)
+    ##find the runs of identical values (NaNs never match, so each is a run of one)
+    starts = np.hstack([[0],np.flatnonzero(y[1:]!=y[:-1])+1])
+    lengths = np.diff(np.hstack([starts,[y.size]]))
+    values = y[starts]
+    flat = (lengths>=min_run)&~np.isnan(values)
+    acc['flat_runs'] += int(flat.sum())
+    acc['flat_samples'] += int(lengths[flat].sum())
+    acc['longest_flat'] = max(acc['longest_flat'],int(lengths[~np.isnan(values)].max(initial=0)))
+    ##keep the number of flat samples at each value, to count the clipped ones at the end
+    for v,l in zip(values[flat],lengths[flat]):
+        acc['flat_values'][float(v)] = acc['flat_values'].get(float(v),0)+int(l)
+
+def merge_qc(acc,other):
+    """
+    Merges the accumulator 'other' into 'acc' (ie to add one file's statistics to the totals)
+    """
+    acc['n'] += other['n']
+    acc['nan'] += other['nan']
+    acc['min'] = min(acc['min'],other['min'])
+    acc['max'] = max(acc['max'],other['max'])
+    epochs.merge_stats(acc['moments'],other['moments'])
+    acc['flat_runs'] += other['flat_runs']
+    acc['flat_samples'] += other['flat_samples']
+    acc['longest_flat'] = max(acc['longest_flat'],other['longest_flat'])
+    for v,l in other['flat_values'].items():
+        acc['flat_values'][v] = acc['flat_values'].get(v,0)+l
+
+def finish_qc(acc):
+    """
+    Returns the final statistics from an accumulator.
+    Returns:
+        -stats: dictionary with:
+            -n: number of samples
+            -nan: number of NaN samples
+            -min,max,mean,std: of the non-NaN samples
+            -flat_runs: number of flatlined stretches
+            -flat_samples: total number of samples in flatlined stretches
+            -longest_flat: longest run of identical values, in samples
+            -clipped: number of samples in flatlined stretches at the min or max value
+            -dropout_rate: fraction of samples that are NaN or flatlined
+    """
+    moments = epochs.finish_stats(acc['moments'])
+    found = acc['n']-acc['nan'] > 0
+    stats = {'n':acc['n'],'nan':acc['nan'],
+        'min':acc['min'] if found else np.nan,
+        'max':acc['max'] if found else np.nan,
+        'mean':float(moments['mean']) if found else np.nan,
+        'std':float(np.sqrt(moments['var'])) if found else np.nan,
+        'flat_runs':acc['flat_runs'],'flat_samples':acc['flat_samples'],
+        'longest_flat':acc['longest_flat']}
+    stats['clipped'] = sum([l for v,l in acc['flat_values'].items() if v in [acc['min'],acc['max']]])
+    stats['dropout_rate'] = (acc['nan']+acc['flat_samples'])/float(max(acc['n'],1))
+    return stats
+
+def file_qc(data,kind):
+    """
+    Computes the statistics for each channel in one file's data dictionary
+    (from one of the load functions). Raw samples are scaled first.
+    Args:
+        -data: data dictionary; if it has a 'time' entry, it's used to work out the sample
+            rate (and so the flat run length)
+        -kind: 'ephys', 'bp' or 'physio' (see flat_seconds)
+    Returns:
+        -result: dictionary of channel name:accumulator pairs
+    """
+    scalings = data.get('scaling',{})
+    result = {}
+    for chan in data_chans(data):
+        y = data[chan]
+        if data.get('time',0) > 0:
+            min_run = max(int(np.round(flat_seconds[kind]*y.size/float(data['time']))),2)
+        else:
+            min_run = default_flat_run
+        if scalings.get(chan) != None:
+            y = apply_scaling(y,scalings[chan],np.float64)
+        result[chan] = new_qc()
+        update_qc(result[chan],y,min_run)
+    return result
+
+def tdms_qc(channel_objects,names,kind,duration=0):
+    """
+    Computes the statistics for channels straight from a TDMS file, so that they
+    describe the samples as recorded (ie before any resampling, which would smooth
+    over dropouts and flatlines).
+    Args:
+        -channel_objects: list of nptdms channel objects
+        -names: list of the channel name to use for each channel object
+        -kind: 'ephys', 'bp' or 'physio' (see flat_seconds)
+        -duration: length of the file in seconds, used to work out the sample rate
+            (if 0, default_flat_run is used)
+    Returns:
+        -result: dictionary of channel name:accumulator pairs
+    """
+    data = {'time':duration,'scaling':{}}
+    for name,channel_object in zip(names,channel_objects):
+        scaling = get_raw_scaling(channel_object)
+        data[name] = channel_object.raw_data if scaling != None else channel_object.data
+        data['scaling'][name] = scaling
+    return file_qc(data,kind)
+
+def write_qc(f_out,per_file,files,names=None):
+    """
+    Saves the statistics for a converted data file. The totals for each channel are
+    saved as 'qc_<field>' attributes on its dataset, and the per-file values
+    as a table (one row per file) in qc/<channel>.
+    Args:
+        -f_out: output file (h5py File or zarr Group) holding the channel datasets
+        -per_file: list (in file order) of results from file_qc
+        -files: list of the source file paths, in the same order
+        -names: optional dictionary mapping channel names in per_file to dataset names
+    """
+    if len(per_file) == 0:
+        return
+    if names == None:
+        names = {}
+    dtype = [(x,'f8') for x in fields]
+    group = f_out.require_group('qc')
+    if output_backends._is_zarr(f_out):
+        group.attrs['files'] = [os.path.basename(x) for x in files]
+    else:
+        group.attrs['files'] = [os.path.basename(x).encode() for x in files]
+    for chan in per_file[0]:
+        name = names.get(chan,chan)
+        total = new_qc()
+        table = np.zeros(len(per_file),dtype=dtype)
+        for i,result in enumerate(per_file):
+            merge_qc(total,result[chan])
+            stats = finish_qc(result[chan])
+            table[i] = tuple([stats[x] for x in fields])
+        stats = finish_qc(total)
+        for x in fields:
+            f_out[name].attrs['qc_'+x] = float(stats[x])
+        group.create_dataset(name,data=table)
+
+def read_qc(f):
+    """
+    Reads back the statistics saved by write_qc.
+    Args:
+        -f: open data file (see output_backends.open_data)
+    Returns:
+        -totals: dictionary of channel name:statistics dictionary pairs
+        -per_file: dictionary of channel name:per-file table pairs (structured
+            arrays with one row per file, in the order of f['qc'].attrs['files'])
+    """
+    totals = {}
+    per_file = {}
+    if not 'qc' in f:
+        return totals, per_file
+    for name in f['qc']:
+        totals[name] = dict([(x,f[name].attrs['qc_'+x]) for x in fields])
+        per_file[name] = f['qc'][name][:]
+    return totals, per_file
@@ -0,0 +1,195 @@
+##rc_files.py
+
+##functions for processing recruitment curve (RC) data. Each RC file holds a
+##recording of stim pulses at one amplitude (given in the file name, ie
+##'rc_250uA.tdms'), along with the ephys channels. For each file, the evoked
+##response to the pulses is averaged on each channel, and the summary metrics
+##are collected into one amplitude x channel table.
+
+import numpy as np
+import os
+import re
+import h5py
+import multiprocessing as mp
+from tdms_files import open_tdms
+from ephys_files import get_ephys_chans
+from stim_files import get_stim_channel, find_pulses
+import epochs
+import profiling
+
+##multipliers to convert the amplitude in a file name to uA
+amp_units = {'uA':1.0,'mA':1000.0}
+
+def parse_amplitude(path):
+    """
+    Gets the stim amplitude from the name of an RC file.
+    Args:
+        -path: path to the file (ie '/data/rc_250uA.tdms' or '/data/rc_1.5mA_0001.tdms')
+    Returns:
+        -amplitude: stim amplitude in uA, or None if there's no amplitude in the name
+    """
+    match = re.search(r'(\d+(?:\.\d+)?)\s*(uA|mA)',os.path.basename(path))
+    if match == None:
+        return None
+    return float(match.group(1))*amp_units[match.group(2)]
+
+def load_rc(path,pre=5.0,post=50.0,blank=1.0,index=0):
+    """
+    Loads one RC file and computes the stimulus-locked response on each ephys channel.
+    Args:
+        -path: full path to the datafile
+        -pre: time before each pulse to include, in ms (used as the baseline)
+        -post: time after each pulse to include, in ms
+        -blank: time after each pulse to ignore when measuring the response,
+            in ms (to skip the stim artifact)
+        -index: useful for ordering after asynchronous multiprocessing
+    Returns:
+        -data: dictionary with:
+            -amplitude: stim amplitude in uA
+            -fs: sample rate
+            -channels: list of ephys channel names
+            -n_pulses: number of pulses that were averaged
+            -responses: channels x samples array of baseline-subtracted mean responses
+            -p2p: peak-to-peak amplitude of the mean response on each channel
+            -latency: time of the largest deflection after the pulse on each channel, in ms
+        -index: the index that was passed in
+    """
+    with profiling.span('tdms_decode',path) as rec:
+        tdms_file = open_tdms(path)
+        rec['bytes_read'] = os.path.getsize(path)
+    stim_object = get_stim_channel(tdms_file)
+    fs = 1.0/stim_object.properties['wf_increment']
+    n_pre,n_post = epochs.window_sizes(fs,pre,post)
+    n_blank = int(np.round(blank*fs/1000.0))
+    onsets = find_pulses(stim_object.data,0.1,n_post)
+    chans = get_ephys_chans(tdms_file)
+    signals = []
+    for chan in chans:
+        try:
+            signals.append(tdms_file.object('Group Name',chan).data)
+        except KeyError:
+            signals.append(tdms_file.object('ephys',chan).data)
+    with profiling.span('rc_average',path) as rec:
+        ##pulses without a full window of data around them are dropped
+        stats = epochs.epoch_stats(signals,onsets,n_pre,n_post)
+        rec['samples'] = stats['n']*len(chans)*(n_pre+n_post)
+    data = {'amplitude':parse_amplitude(path),'fs':fs,'channels':chans,
+        'n_pulses':stats['n']}
+    responses = np.zeros((len(chans),n_pre+n_post))
+    if stats['n'] > 0:
+        responses[:] = stats['mean']
+    ##subtract the pre-pulse baseline
+    responses -= responses[:,:n_pre].mean(axis=1)[:,None]
+    data['responses'] = responses
+    data['p2p'],data['latency'] = response_metrics(responses,fs,n_pre,n_blank)
+    return data, index
+
+def response_metrics(responses,fs,n_pre,n_blank):
+    """
+    Measures the mean response on each channel after the blanking period.
+    Args:
+        -responses: channels x samples array of baseline-subtracted mean responses
+        -fs: sample rate
+        -n_pre: number of samples before the pulse in each response
+        -n_blank: number of samples after the pulse to ignore
+    Returns:
+        -p2p: peak-to-peak amplitude of the response on each channel
+        -latency: time of the largest deflection after the pulse on each channel, in ms
+    """
+    window = responses[:,n_pre+n_blank:]
+    p2p = window.max(axis=1)-window.min(axis=1)
+    latency = (np.argmax(np.abs(window),axis=1)+n_blank)*1000.0/fs
+    return p2p, latency
+
+def combine_amplitude(results,fs,n_pre,n_blank):
+    """
+    Combines the results from load_rc for files recorded at the same amplitude (ie a
+    recording that was split across several files). The mean responses are weighted
+    by the number of pulses in each file, and the metrics are measured again from
+    the combined response.
+    """
+    if len(results) == 1:
+        return results[0]
+    n = np.array([x['n_pulses'] for x in results],dtype=np.float64)
+    responses = np.stack([x['responses'] for x in results])
+    if n.sum() > 0:
+        responses = (responses*n[:,None,None]).sum(axis=0)/n.sum()
+    else:
+        responses = responses[0]
+    data = dict(results[0])
+    data['n_pulses'] = int(n.sum())
+    data['responses'] = responses
+    data['p2p'],data['latency'] = response_metrics(responses,fs,n_pre,n_blank)
+    return data
+
+def process_rc(files,pre=5.0,post=50.0,blank=1.0):
+    """
+    Function to process a set of RC files (one per stim amplitude) in parallel.
+    Args:
+        -files: iterable of RC file paths from one experiment
+        -pre,post,blank: see load_rc
+    Returns:
+        -data: dictionary with (one row per amplitude; files with the same amplitude
+            are combined, see combine_amplitude):
+            -amplitude: stim amplitudes in uA, in ascending order
+            -channels: list of ephys channel names
+            -n_pulses: number of pulses averaged at each amplitude
+            -p2p: amplitude x channel array of response peak-to-peak values
+            -latency: amplitude x channel array of response latencies, in ms
+            -responses: amplitude x channel x samples array of mean responses
+            -time: timebase of the responses, in ms relative to the pulse onset
+    """
+    files = [f for f in files if parse_amplitude(f) != None]
+    if len(files) == 0:
+        return {'amplitude':np.zeros(0),'channels':[],'n_pulses':np.zeros(0,dtype=np.int64),
+            'p2p':np.zeros((0,0)),'latency':np.zeros((0,0)),'responses':np.zeros((0,0,0)),
+            'time':np.zeros(0)}
+    args = [(f,pre,post,blank,i) for i,f in enumerate(files)]
+    with profiling.span('load_pool') as rec:
+        with mp.Pool(3) as p:
+            result = p.starmap(load_rc,args)
+    result = [x[0] for x in result]
+    fs = set([x['fs'] for x in result])
+    assert len(fs)==1, "Different sample rates detected in RC files"
+    fs = fs.pop()
+    n_pre = epochs.window_sizes(fs,pre,post)[0]
+    n_blank = int(np.round(blank*fs/1000.0))
+    ##one row per stim amplitude, in ascending order
+    amplitudes = sorted(set([x['amplitude'] for x in result]))
+    result = [combine_amplitude([x for x in result if x['amplitude'] == a],fs,n_pre,n_blank)
+        for a in amplitudes]
+    data = {'amplitude':np.array(amplitudes),
+        'channels':result[0]['channels'],
+        'n_pulses':np.array([x['n_pulses'] for x in result])}
+    for key in ['p2p','latency','responses']:
+        data[key] = np.stack([x[key] for x in result])
+    data['time'] = (np.arange(data['responses'].shape[2])-n_pre)*1000.0/fs
+    return data
+
+def save_rc(files,path_out=None,pre=5.0,post=50.0,blank=1.0):
+    """
+    Function to create an hdf5 file with the recruitment curve summary
+    for an experiment (see process_rc).
+    Args:
+        -files: iterable of RC file paths from one experiment
+        -path_out: optional alternative path to save the data file. If
+            not specified, file is saved in same location as input files.
+        -pre,post,blank: see load_rc
+    Returns:
+        None; data saved in specified location
+    """
+    files = list(files)
+    if len(files) == 0:
+        print("No RC files to save")
+        return
+    if path_out == None:
+        path_out = os.path.dirname(files[0])
+    path_out = os.path.join(path_out,'rc_data.hdf5')
+    data = process_rc(files,pre,post,blank)
+    f_out = h5py.File(path_out,'w')
+    with profiling.span('hdf5_write',path_out) as rec:
+        for key in ['amplitude','n_pulses','p2p','latency','responses','time']:
+            f_out.create_dataset(key,data=data[key])
+        f_out.attrs['channels'] = [x.encode() for x in data['channels']]
+        rec['bytes_written'] = profiling.nbytes(data)[0]
+    f_out.close()
@@ -8,12 +8,18 @@ import tdms_files
 import ephys_files
 import physio_files
 import stim_files
+import artifact
 import bp_files
 import metadata
+import spike_files
+import rc_files
+import profiling
+import output_backends
 import multiprocessing as mp
 import os
 
-def save_exp(f,check_meta=False,**kwargs):
+def save_exp(f,check_meta=False,spikes=False,rc=False,beats=False,blank_artifacts=False,profile=False,backend='hdf5',pipelined=False,
+    compact=False,**kwargs):
     """
     A function to save all of the data contained in a single experiment directory.
     Args:
@@ -21,65 +27,121 @@ def save_exp(f,check_meta=False,**kwargs):
         -check_meta: if True, requires the directory to contain a metadata
             file, and then only processes signals that were marked "good"
             for this data file.
+        -spikes: if True, runs spike detection on the converted ephys data
+            and saves the spike times/waveforms in spike_data.hdf5
+        -blank_artifacts: if True, blanks the stim artifacts in the converted ephys data
+            and saves the cleaned channels in ephys_clean (see artifact.save_clean); spike
+            detection is then run on the cleaned data
+        -rc: if True, processes any recruitment curve files in the directory
+            and saves the summary in rc_data.hdf5 (see rc_files)
+        -beats: if True, runs beat-by-beat detection on the full-rate BP waveform and
+            saves the beat table in the bp data file (see bp_files.save_beats)
+        -profile: if True, records timing/memory/io for each processing stage and
+            saves a report to profile_report.json in the experiment folder (and prints
+            a summary). Can also be a path to save the report to.
+        -backend: output format for the ephys and bp data; 'hdf5' or 'zarr'
+            (see output_backends)
+        -pipelined: if True, uses the pipelined conversion engine, which overlaps
+            reading, processing and writing (see pipeline)
+        -compact: if True, ephys/bp/physio channels are stored as raw integer samples
+            with 'scale' and 'offset' attributes instead of float64 (hdf5 backend only;
+            zarr and pipelined output is stored as scaled float32)
         -**kwargs: used to specify if any signals should be resampled. Possible kwargs
             include resample_ephys, resample_bp, resample_physio. If you do include these
             kwargs, the paired value should be the desired resample rate in Hz.
     """
-    ##get a list of the data files
-    file_dict = tdms_files.search_files(f)
-    ##parse kwargs
-    if 'resample_ephys' in kwargs:
-        resample_ephys = kwargs['resample_ephys']
-    else:
-        resample_ephys = False
-    if 'resample_bp' in kwargs:
-        resample_bp = kwargs['resample_bp']
-    else:
-        resample_bp = False
-    if 'resample_physio' in kwargs:
-        resample_physio = kwargs['resample_physio']
-    else:
-        resample_physio = False
-    ##check metadata, if requested
-    ephys_ok = True
-    physio_ok = True
-    bp_ok = True
-    if check_meta:
-        if metadata.get_fname == 'processed_data':
-            ##if no meta file is found, this function returns 'processed_data'
-            ephys_ok = False
-            bp_ok = False
-            physio_ok = False
-            print("No metadata found for {}; skipping".format(f))
+    if profile:
+        spool_dir = profiling.enable()
+    try:
+        ##get a list of the data files
+        file_dict = tdms_files.search_files(f)
+        ##parse kwargs
+        if 'resample_ephys' in kwargs:
+            resample_ephys = kwargs['resample_ephys']
         else:
-            metafile = [x for x in os.listdir(f) if x.endswith('.xml')][0]
-            info = metadata.parse_meta_xml(os.path.join(f,metafile))
-            if not info['Ephys good']:
+            resample_ephys = False
+        if 'resample_bp' in kwargs:
+            resample_bp = kwargs['resample_bp']
+        else:
+            resample_bp = False
+        if 'resample_physio' in kwargs:
+            resample_physio = kwargs['resample_physio']
+        else:
+            resample_physio = False
+        ##check metadata, if requested
+        ephys_ok = True
+        physio_ok = True
+        bp_ok = True
+        if check_meta:
+            if metadata.get_fname == 'processed_data':
+                ##if no meta file is found, this function returns 'processed_data'
                 ephys_ok = False
-            if not info['Physio good']:
-                physio_ok = False
-            if not info['BP good']:
                 bp_ok = False
-    ##now with all the checks performed, we can save the data:
-    if ephys_ok:
-        print("Saving ephys data...")
-        ephys_files.save_ephys(file_dict['highspeed'],path_out=None,
-            resample=resample_ephys,load_time=True)
-        print("...done!")
-    if bp_ok:
-        print("Saving bp data...")
-        if len(file_dict['lowspeed']) > 0:
-            files = file_dict['lowspeed']
-        else:
-            files = file_dict['highspeed']
-        bp_files.save_bp(files,path_out=None,
-            resample=resample_bp,load_time=True)
-        print("...done!")
-    if physio_ok:
-        print("Saving physio data...")
-        physio_files.save_physio(file_dict['physio'],path_out=None,
-            resample=resample_physio,load_time=True)
-        print("...done!")
+                physio_ok = False
+                print("No metadata found for {}; skipping".format(f))
+            else:
+                metafile = [x for x in os.listdir(f) if x.endswith('.xml')][0]
+                info = metadata.parse_meta_xml(os.path.join(f,metafile))
+                if not info['Ephys good']:
+                    ephys_ok = False
+                if not info['Physio good']:
+                    physio_ok = False
+                if not info['BP good']:
+                    bp_ok = False
+        ##now with all the checks performed, we can save the data:
+        if ephys_ok:
+            print("Saving ephys data...")
+            with profiling.span('save_ephys',f):
+                ephys_files.save_ephys(file_dict['highspeed'],path_out=None,
+                    resample=resample_ephys,load_time=True,backend=backend,pipelined=pipelined,
+                    compact=compact)
+            print("...done!")
+            ephys_path = output_backends.output_path(f,'ephys_data',backend)
+            if blank_artifacts:
+                print("Blanking stim artifacts...")
+                with profiling.span('save_clean',f):
+                    ephys_path = artifact.save_clean(ephys_path)
+                print("...done!")
+            if spikes:
+                print("Detecting spikes...")
+                with profiling.span('save_spikes',f):
+                    spike_files.save_spikes(ephys_path)
+                print("...done!")
+        if bp_ok:
+            print("Saving bp data...")
+            if len(file_dict['lowspeed']) > 0:
+                files = file_dict['lowspeed']
+            else:
+                files = file_dict['highspeed']
+            with profiling.span('save_bp',f):
+                bp_files.save_bp(files,path_out=None,
+                    resample=resample_bp,load_time=True,backend=backend,pipelined=pipelined,
+                    compact=compact)
+            print("...done!")
+            if beats:
+                print("Detecting beats...")
+                with profiling.span('save_beats',f):
+                    bp_files.save_beats(files,path_out=None,backend=backend)
+                print("...done!")
+        if physio_ok:
+            print("Saving physio data...")
+            with profiling.span('save_physio',f):
+                physio_files.save_physio(file_dict['physio'],path_out=None,
+                    resample=resample_physio,load_time=True,compact=compact)
+            print("...done!")
+        if rc and len(file_dict['RC']) > 0:
+            print("Saving recruitment curve data...")
+            with profiling.span('save_rc',f):
+                rc_files.save_rc(file_dict['RC'],path_out=None)
+            print("...done!")
+        if profile:
+            if profile == True:
+                profile = os.path.join(f,'profile_report.json')
+            profiling.report(profile,spool_dir)
+    finally:
+        ##always turn profiling back off, so a failed conversion doesn't leave it on
+        if profile:
+            profiling.disable()
 
     
     
@@ -6,8 +6,9 @@
 # by Ryan Neely 9/18/19
 
 import metadata
+import meta_index
 
-def search(files,kwargs):
+def search(files,kwargs,index=False):
     """
     This function takes a list of metadata files and looks through them
     for files that have matching attribues to what is passed in through
@@ -19,44 +20,21 @@ def search(files,kwargs):
             not included here won't be checked. Values here are allowed to be ranges or lists. 
             **The function will interpret any two-element, integer tuple
                 as a range, while any list will be interpreted as containing 
-                inclusive values.***
+                inclusive values.*** For list-valued attributes (ie blood sample
+                times), a file matches if any element of the list matches.
+        -index: if True (or a path to an index database), the search runs against the
+            metadata index (see meta_index), which is refreshed for any files that
+            have changed. This is much faster when searching many files repeatedly.
     """
-    ##TODO: decide if all inputs should be str to match metadata, and then converted as needed...?
+    if index:
+        db_path = None if index == True else index
+        meta_index.refresh_index(files,db_path)
+        return meta_index.query_index(kwargs,files,db_path)
     matches = [] #eventual output of matching files
     for f in files:
-        ###start by assuming an inclusion:
-        include = True
-        i = 0
         ##load the data dictionary
         m = metadata.parse_meta_xml(f)
-        while include == True and i < len(kwargs):
-            for key,val in kwargs.items():
-                ##TODO: make this work for odd string inputs in the metadata. 
-                # Ex: 'Blood sample times (min from start)': '13,90,135,180,225'
-                ##first decide if we are talking about a range or list here
-                mval = m[key]
-                if type(val) == tuple: ##case where input is a range
-                    ##if range, assume we need to convert to float
-                    try:
-                        mval = float(mval)
-                        if not mval > val[0] and mval < val[1]:
-                            include = False
-                    except TypeError:
-                        print("No {} entry for {}".format(key,f))
-                        include = False
-                    except ValueError:
-                        print("Invalid entry ({}) for {} in {}".format(mval,key,f))
-                        include = False
-                elif type(val) == list:
-                    if not mval in val:
-                        include = False
-                else:
-                    if not mval == val:
-                        include = False
-                i+=1
-            if include:
-                matches.append(f)
+        ##values are matched the same way as in the index (see meta_index.match_criteria)
+        if meta_index.match_criteria(m,kwargs):
+            matches.append(f)
     return matches
-
-                    
-
@@ -0,0 +1,208 @@
+##spectral.py
+
+##spectral analysis of converted data (ephys, bp or physio). The recording is
+##cut into short windows, and the Welch PSD of every window is computed for all
+##channels at once, giving a spectrogram, and from that a band power time series
+##for each frequency band. Chunks of windows are processed in parallel by pool
+##workers that read their own part of the data file, so the full recording never
+##has to be loaded. Results are saved as float32 to <name>_spectra.hdf5, and the
+##pre-stim, stim and post-stim periods can then be compared (see compare_periods).
+
+import numpy as np
+import h5py
+import os
+import multiprocessing as mp
+import output_backends
+import tdms_files
+from tdms_files import apply_scaling
+
+##frequency bands, as (name,low,high) in Hz
+bands = [
+    ('delta',1.0,4.0),
+    ('theta',4.0,8.0),
+    ('alpha',8.0,13.0),
+    ('beta',13.0,30.0),
+    ('gamma',30.0,100.0)
+]
+
+##datasets in the data files that aren't signals
+tables = ['time','qc','beats','blanked']
+
+def window_psd(x,fs,nwin,nperseg,fmax=None):
+    """
+    Computes the Welch PSD of consecutive windows of data, for all channels at once.
+    Args:
+        -x: channels x samples array (a partial window at the end is dropped)
+        -fs: sample rate in Hz
+        -nwin: number of samples per window
+        -nperseg: number of samples per Welch segment (segments overlap by half)
+        -fmax: highest frequency to keep (default is all of them)
+    Returns:
+        -freqs: array of frequencies
+        -psd: channels x windows x frequencies array
+    """
+    from scipy.signal import welch
+    n_windows = x.shape[1]//nwin
+    x = x[:,:n_windows*nwin].reshape(x.shape[0],n_windows,nwin)
+    freqs,psd = welch(x,fs=fs,nperseg=min(nperseg,nwin),axis=-1)
+    if fmax != None:
+        keep = freqs <= fmax
+        freqs,psd = freqs[keep],psd[...,keep]
+    return freqs,psd
+
+def band_power(freqs,psd,band_list=None):
+    """
+    Integrates a PSD over each frequency band.
+    Args:
+        -freqs: array of frequencies
+        -psd: array of PSDs, with frequency on the last axis
+        -band_list: list of (name,low,high) bands (default is bands)
+    Returns:
+        -power: array like psd, but with one value per band on the last axis
+    """
+    if band_list == None:
+        band_list = bands
+    df = freqs[1]-freqs[0] if freqs.size > 1 else 1.0
+    power = np.zeros(psd.shape[:-1]+(len(band_list),),dtype=psd.dtype)
+    for i,(name,lo,hi) in enumerate(band_list):
+        mask = (freqs>=lo)&(freqs<hi)
+        power[...,i] = psd[...,mask].sum(axis=-1)*df
+    return power
+
+def chunk_spectra(path,chans,c0,c1,fs,nwin,nperseg,fmax,band_list):
+    """
+    Pool worker for save_spectra: reads samples c0 to c1 of each channel and computes
+    the spectrogram and band power of each window.
+    Returns:
+        -psd: channels x windows x frequencies float32 array
+        -power: channels x windows x bands float32 array
+    """
+    f = output_backends.open_data(path)
+    x = []
+    for c in chans:
+        attrs = f[c].attrs
+        scaling = (attrs['scale'],attrs['offset']) if 'scale' in attrs else None
+        x.append(apply_scaling(f[c][c0:c1],scaling,np.float64))
+    output_backends.close(f)
+    freqs,psd = window_psd(np.vstack(x),fs,nwin,nperseg,fmax)
+    return psd.astype(np.float32),band_power(freqs,psd,band_list).astype(np.float32)
+
+def save_spectra(data_path,path_out=None,chans=None,window=2.0,segment=0.5,fmax=200.0,
+    band_list=None,chunk_size=20.0,n_procs=None):
+    """
+    Computes the spectrogram and band power time series of a converted data file, and
+    saves them to <name>_spectra.hdf5 (ie ephys_spectra.hdf5 for ephys_data.hdf5), with:
+        -time: center of each window, in seconds from the start of the recording
+        -freqs: frequencies of the spectrogram
+        -<chan>/spectrogram: windows x frequencies PSD
+        -<chan>/bandpower: windows x bands power, with the band names and limits in the
+            'bands' and 'band_limits' attributes of the file
+    Args:
+        -data_path: full path to the data file (ie ephys_data.hdf5 or bp_data.zarr)
+        -path_out: optional alternative folder to save the results to
+        -chans: list of channels to include (default is the amp_N channels for ephys data,
+            and every signal otherwise)
+        -window: length of each window, in seconds
+        -segment: length of the Welch segments within each window, in seconds
+        -fmax: highest frequency to keep, in Hz (None to keep all of them)
+        -band_list: list of (name,low,high) bands (default is bands)
+        -chunk_size: amount of data each worker processes at once, in seconds
+        -n_procs: number of worker processes (default is tdms_files.n_procs)
+    Returns:
+        -path_out: full path of the saved file
+    """
+    if band_list == None:
+        band_list = bands
+    if n_procs == None:
+        n_procs = tdms_files.n_procs
+    name = os.path.basename(data_path).split('.')[0]
+    if path_out == None:
+        path_out = os.path.dirname(data_path)
+    path_out = os.path.join(path_out,name.replace('_data','')+'_spectra.hdf5')
+    f_in = output_backends.open_data(data_path)
+    if chans == None:
+        chans = [x for x in list(f_in) if x.startswith('amp_')]
+        if len(chans) == 0:
+            chans = [x for x in list(f_in) if not x in tables and len(f_in[x].shape) == 1]
+    n = f_in[chans[0]].shape[0]
+    fs = n/float(f_in['time'][()])
+    output_backends.close(f_in)
+    nwin = int(np.round(window*fs))
+    nperseg = max(int(np.round(segment*fs)),1)
+    n_windows = n//nwin
+    ##each chunk is a whole number of windows
+    step = max(int(chunk_size//window),1)*nwin
+    args = [(data_path,chans,c0,min(c0+step,n_windows*nwin),fs,nwin,nperseg,fmax,band_list)
+        for c0 in range(0,n_windows*nwin,step)]
+    freqs = window_psd(np.zeros((1,nwin)),fs,nwin,nperseg,fmax)[0]
+    f_out = h5py.File(path_out,'w')
+    f_out.create_dataset('time',data=(np.arange(n_windows)+0.5)*nwin/fs)
+    f_out.create_dataset('freqs',data=freqs)
+    f_out.attrs['fs'] = fs
+    f_out.attrs['window'] = window
+    f_out.attrs['segment'] = segment
+    f_out.attrs['bands'] = [x[0].encode() for x in band_list]
+    f_out.attrs['band_limits'] = np.array([x[1:] for x in band_list])
+    if n_windows == 0:
+        ##recording shorter than one window; h5py can't chunk an empty dataset
+        print("{} is shorter than one {} s window; saving empty spectra".format(data_path,window))
+        for c in chans:
+            f_out.create_dataset(c+'/spectrogram',shape=(0,freqs.size),dtype='float32')
+            f_out.create_dataset(c+'/bandpower',shape=(0,len(band_list)),dtype='float32')
+        f_out.close()
+        return path_out
+    rows = min(n_windows,256)
+    for c in chans:
+        f_out.create_dataset(c+'/spectrogram',shape=(n_windows,freqs.size),dtype='float32',
+            chunks=(rows,freqs.size),compression='gzip')
+        f_out.create_dataset(c+'/bandpower',shape=(n_windows,len(band_list)),dtype='float32',
+            chunks=(rows,len(band_list)),compression='gzip')
+    ##results come back in order, and are written as they arrive
+    w0 = 0
+    with mp.Pool(n_procs) as p:
+        for psd,power in p.imap(_chunk_spectra,args):
+            w1 = w0+psd.shape[1]
+            for i,c in enumerate(chans):
+                f_out[c]['spectrogram'][w0:w1] = psd[i]
+                f_out[c]['bandpower'][w0:w1] = power[i]
+            w0 = w1
+    f_out.close()
+    return path_out
+
+def compare_periods(spectra_path,start,stop,pad_min=10.0):
+    """
+    Averages the spectra and band powers over the pre-stim, stim and post-stim periods.
+    Args:
+        -spectra_path: full path to a file from save_spectra
+        -start: start time, in ms, of the stim block (see analysis.get_tstim)
+        -stop: stop time, in ms, of the stim block
+        -pad_min: length of the pre- and post-stim periods, in min
+    Returns:
+        -result: dictionary with 'freqs', 'bands' and 'periods' ((start,stop) of each period,
+            in seconds), plus a dictionary for each channel with, for each period
+            ('pre','stim','post'), the mean PSD ('<period>_psd') and band power ('<period>_power')
+    """
+    pad = pad_min*60.0
+    start,stop = start/1000.0,stop/1000.0
+    periods = [('pre',start-pad,start),('stim',start,stop),('post',stop,stop+pad)]
+    f = h5py.File(spectra_path,'r')
+    time = f['time'][:]
+    result = {'freqs':f['freqs'][:],'bands':[x.decode() for x in f.attrs['bands']],
+        'periods':dict([(x[0],x[1:]) for x in periods])}
+    for c in f:
+        if c in ['time','freqs']:
+            continue
+        result[c] = {}
+        for name,t0,t1 in periods:
+            ##only the windows inside the period are read
+            i0,i1 = np.searchsorted(time,[t0,t1])
+            for key,dset in [('_psd','spectrogram'),('_power','bandpower')]:
+                if i1 > i0:
+                    result[c][name+key] = f[c][dset][i0:i1].mean(axis=0)
+                else:
+                    result[c][name+key] = np.full(f[c][dset].shape[1],np.nan)
+    f.close()
+    return result
+
+def _chunk_spectra(args):
+    return chunk_spectra(*args)
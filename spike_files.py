@@ -0,0 +1,132 @@
+##spike_files.py
+
+##functions to detect spikes in converted ephys data, and save
+##the spike times and waveform snippets to hdf5. The ephys data is
+##filtered and thresholded chunk by chunk, so a full 25kHz channel
+##never needs to be held in memory.
+
+import numpy as np
+import h5py
+import os
+import filtering as filt
+import output_backends
+from tdms_files import apply_scaling
+
+##highest allowed filter corner, as a fraction of the sample rate (just under Nyquist)
+nyquist_frac = 0.45
+
+def save_spikes(ephys_path,path_out=None,fs=None,chunk_size=30.0,lowcut=300,highcut=5000,
+    thresh_mult=4.5,pre=0.5,post=1.0,dead_time=1.0):
+    """
+    Function to create an hdf5 file of spike times and waveforms from
+    an ephys data file created by ephys_files.save_ephys.
+    Args:
+        -ephys_path: full path to the ephys_data.hdf5 (or .zarr) file
+        -path_out: optional alternative path to save the data file. If
+            not specified, file is saved in same location as the ephys file.
+        -fs: sample rate of the ephys data. If None, it is calculated from the
+            'time' value saved with the ephys data.
+        -chunk_size: amount of data to filter and threshold at once, in seconds
+        -lowcut, highcut: corners of the spike band filter (Hz). highcut is lowered to
+            nyquist_frac*fs if the data was resampled too low for it, and spike detection
+            is skipped if that leaves no band.
+        -thresh_mult: detection threshold, in multiples of the robust (MAD) noise estimate
+        -pre: time, in ms, before each threshold crossing to include in the waveform snippet
+        -post: time, in ms, after each threshold crossing to include in the waveform snippet
+        -dead_time: time, in ms, after a spike during which no other spike can be detected
+    Returns:
+        None; data saved in specified location
+    """
+    if path_out == None:
+        path_out = os.path.dirname(ephys_path)
+    path_out = os.path.join(path_out,'spike_data.hdf5')
+    f_in = output_backends.open_data(ephys_path)
+    ephys_chans = [x for x in list(f_in) if x.startswith('amp_')]
+    if fs == None:
+        fs = f_in[ephys_chans[0]].size/float(f_in['time'][()])
+    ##the spike band has to fit below the Nyquist frequency of (possibly resampled) data
+    if highcut >= nyquist_frac*fs:
+        print("highcut {} Hz is too high for data at {} Hz; using {} Hz".format(highcut,fs,nyquist_frac*fs))
+        highcut = nyquist_frac*fs
+    if lowcut >= highcut:
+        print("Sample rate ({} Hz) is too low for spike detection; skipping".format(fs))
+        output_backends.close(f_in)
+        return
+    f_out = h5py.File(path_out,'w')
+    for chan in ephys_chans:
+        print("detecting spikes on "+chan)
+        group = f_out.create_group(chan)
+        detect_spikes(f_in[chan],group,fs,chunk_size=chunk_size,lowcut=lowcut,
+            highcut=highcut,thresh_mult=thresh_mult,pre=pre,post=post,dead_time=dead_time)
+    f_out.attrs['fs'] = fs
+    f_out.attrs['lowcut'] = lowcut
+    f_out.attrs['highcut'] = highcut
+    f_out.attrs['thresh_mult'] = thresh_mult
+    f_out.attrs['pre'] = pre
+    f_out.attrs['post'] = post
+    f_out.close()
+    output_backends.close(f_in)
+
+def detect_spikes(data,group,fs,chunk_size=30.0,lowcut=300,highcut=5000,
+    thresh_mult=4.5,pre=0.5,post=1.0,dead_time=1.0):
+    """
+    A function to detect spikes on one channel, chunk by chunk. The filter state
+    is carried from one chunk to the next, and the tail end of each filtered chunk
+    is kept around so that spikes (and their snippets) that straddle a chunk
+    boundary are detected exactly once.
+    Args:
+        -data: 1-D array-like of raw ephys data (numpy array or h5py dataset). If the
+            dataset has 'scale' and 'offset' attributes (compact mode), the samples are
+            scaled as they are read.
+        -group: h5py group to write the 'times' and 'waveforms' datasets to
+        -fs: sample rate of the data
+        -(remaining args as in save_spikes)
+    Returns:
+        -n_spikes: the number of spikes detected
+    """
+    n_pre = int(np.round(pre*fs/1000.0))
+    n_post = int(np.round(post*fs/1000.0))
+    n_dead = int(np.round(dead_time*fs/1000.0))
+    n_chunk = int(chunk_size*fs)
+    b,a = filt.butter_bandpass(lowcut,highcut,fs)
+    times = group.create_dataset('times',shape=(0,),maxshape=(None,),
+        dtype='float64',chunks=True)
+    waveforms = group.create_dataset('waveforms',shape=(0,n_pre+n_post),
+        maxshape=(None,n_pre+n_post),dtype='float32',chunks=True)
+    snip = np.arange(-n_pre,n_post)
+    attrs = getattr(data,'attrs',{})
+    scaling = (attrs['scale'],attrs['offset']) if 'scale' in attrs else None
+    zi = None
+    carry = np.zeros(0)
+    next_idx = 0 ##first (absolute) sample index that hasn't been checked for crossings
+    last_spike = -n_dead-1 ##absolute index of the last detected spike
+    for start in range(0,data.size,n_chunk):
+        chunk = apply_scaling(data[start:start+n_chunk],scaling,np.float64)
+        filtered,zi = filt.bandpass_filter_chunk(chunk,b,a,zi)
+        ##robust estimate of the noise std for this chunk
+        thresh = -thresh_mult*np.median(np.abs(filtered))/0.6745
+        buf = np.concatenate([carry,filtered])
+        buf_start = start-carry.size
+        ##downward threshold crossings
+        below = buf < thresh
+        cross = np.where(below[1:] & ~below[:-1])[0]+1
+        ##skip crossings handled in a previous chunk, and ones without a full snippet.
+        ##crossings too close to the end of the buffer are left for the next chunk
+        cross = cross[(cross+buf_start>=next_idx)&(cross-n_pre>=0)&(cross+n_post<=buf.size)]
+        ##enforce the dead time
+        keep = []
+        for c in cross:
+            if c+buf_start-last_spike > n_dead:
+                keep.append(c)
+                last_spike = c+buf_start
+        keep = np.asarray(keep,dtype=int)
+        if keep.size > 0:
+            n = times.shape[0]
+            times.resize((n+keep.size,))
+            times[n:] = (keep+buf_start)/fs
+            waveforms.resize((n+keep.size,n_pre+n_post))
+            waveforms[n:,:] = buf[keep[:,None]+snip]
+        next_idx = buf_start+buf.size-n_post+1
+        carry = buf[-(n_pre+n_post+1):]
+    group.attrs['n_spikes'] = times.shape[0]
+    return times.shape[0]
@@ -5,11 +5,13 @@
 ##by Ryan Neely 6/11/19
 
 import numpy as np
-import nptdms
 import os
 import h5py
-from tdms_files import order_files
+from tdms_files import order_files, open_tdms, prefetch
 from scipy.signal import find_peaks
+import profiling
+import pipeline
+import cache
 
 stim_chan = 'stim_mon'
 
@@ -19,6 +21,7 @@ def get_stim_times(stim,thresh1,thresh2,minimal_dist):
     from the raw recorded waveform. 
     Args:
         -stim: stim data array containing the continuously recorded stim output
+            (not modified)
         -minimal_dist: the minimum distance two waveforms need to be apart from 
             each other in order to be considered a separate train (in samples)
         -thresh1: the threshold ABOVE which to consider an active stim pulse. Note 
@@ -27,40 +30,120 @@ def get_stim_times(stim,thresh1,thresh2,minimal_dist):
     Returns:
         start_idx: timestamps (scaled in ms) at the start of a stim train
         stop_idx: timestamps (scaled in ms) at the end of a stim train
-        z: a waveform showing when the stim train is occurring
-    """
-    ##get rid of any NaN values from the data; replace with 0's
-    to_replace = np.where(np.isnan(stim))[0]
-    stim[to_replace] = 0.0
-    ##find out where stim is NOT occurring based on the threshold values,
-    ##and set these time points to 0
-    off = np.where((stim<thresh1)&(stim>thresh2))[0]
-    stim[off] = 0
+        intervals: n x 2 array of (first, one past last) sample of each period
+            when the stim train is occurring (see densify)
+    """
+    ##find out where stim IS occurring based on the threshold values
+    ##(NaN values count as no stim)
+    active = ((stim>=thresh1)|(stim<=thresh2))&(stim!=0)
     #now we perform some tricks to figure out where a stim train is taking place
-    ##first make a padded version of y
-    stim_pad = np.hstack([np.zeros(minimal_dist),stim,np.zeros(minimal_dist)]) 
-    ##allocate some memory here
-    z = np.zeros(stim.shape)
+    ##first make a padded version, and take a running count of active samples
+    ##so the number of active samples in any range is a difference of two counts
+    active_pad = np.hstack([np.zeros(minimal_dist,dtype=np.int8),active.astype(np.int8),
+        np.zeros(minimal_dist,dtype=np.int8)])
+    count = np.concatenate([[0],np.cumsum(active_pad,dtype=np.int64)])
     ##now we ask: does point n have samples before AND after it in the
-    ##minimalDist range that are non-zero? If yes, then it counts as part
+    ##minimalDist range that are active? If yes, then it counts as part
     ##of the stim train
-    for i in range(z.size):
-        if np.any(stim_pad[i:i+minimal_dist+1]) and np.any(stim_pad[i-1+minimal_dist:i+2*minimal_dist]):
-            z[i] = 1.0
+    ##(the counts never decrease, so a range has active samples if the count at its end is
+    ##bigger than at its start; the ranges are slices of the counts, so nothing is copied)
+    n,md = stim.size,minimal_dist
+    if md > 0:
+        after_start = count[md-1:md-1+n]
+    else:
+        after_start = np.hstack([count[:1],count[:n-1]])
+    z = (count[md+1:md+1+n]>count[:n])&(count[2*md:2*md+n]>after_start)
     ##now, we take the difference between any two points, and the locations where this ==1
     ##is the rising edge, and the locations where this == -1 are the falling edge
     ##TODO: see if this holds in all cases, especially different sample rates
-    start_idx = np.where(np.diff(z)==1)[0]
-    stop_idx = np.where(np.diff(z)==-1)[0]
-    return start_idx, stop_idx, z
+    dz = np.diff(z.astype(np.int8))
+    start_idx = np.where(dz==1)[0]
+    stop_idx = np.where(dz==-1)[0]
+    return start_idx, stop_idx, get_intervals(z)
+
+def get_intervals(z):
+    """
+    Converts a binary on/off array into a table of "on" intervals.
+    Args:
+        -z: binary (or boolean) array
+    Returns:
+        -intervals: n x 2 int64 array with the first sample and one past the last
+            sample of each run of non-zero values
+    """
+    edges = np.diff(np.hstack([[0],np.asarray(z)!=0,[0]]).astype(np.int8))
+    return np.stack([np.where(edges==1)[0],np.where(edges==-1)[0]],axis=1).astype(np.int64)
+
+def densify(intervals,start=0,stop=None,dtype=np.uint8):
+    """
+    Creates the binary stim on/off array for a window of samples from an interval table.
+    Args:
+        -intervals: n x 2 array of (first, one past last) samples, ie from process_stim
+        -start: first sample of the window
+        -stop: one past the last sample of the window (default is the end of the last interval;
+            use the 'n_samples' value saved with the intervals for the full recording)
+        -dtype: data type of the result
+    Returns:
+        -z: array that is 1 where stim is on and 0 elsewhere, for samples start to stop
+    """
+    intervals = np.asarray(intervals).reshape(-1,2)
+    if stop == None:
+        stop = intervals[:,1].max() if len(intervals) > 0 else start
+    z = np.zeros(max(stop-start,0),dtype=dtype)
+    for on,off in intervals:
+        on = max(on,start)-start
+        off = min(off,stop)-start
+        if off > on:
+            z[on:off] = 1
+    return z
+
+def in_intervals(intervals,idx):
+    """
+    Checks whether each of a set of sample indices falls inside a stim interval.
+    Args:
+        -intervals: n x 2 array of (first, one past last) samples, in order
+        -idx: array of sample indices
+    Returns:
+        -on: boolean array, True where the sample is inside an interval
+    """
+    intervals = np.asarray(intervals).reshape(-1,2)
+    i = np.searchsorted(intervals[:,0],idx,side='right')-1
+    on = i >= 0
+    on[on] = idx[on] < intervals[i[on],1]
+    return on
 
-def save_stim(files,path_out=None):
+def find_pulses(stim,thresh=0.1,min_dist=25):
     """
-    Function to create hdf5 file from ephys data.
+    A function to find the onset of each individual stim pulse (rather than
+    each stim train, as in get_stim_times).
+    Args:
+        -stim: stim data array containing the continuously recorded stim output
+        -thresh: the absolute value above which to consider an active stim pulse
+        -min_dist: minimum distance between two pulses, in samples. Threshold
+            crossings closer than this to the previous crossing (ie the second phase
+            of a biphasic pulse) are not counted as new pulses.
+    Returns:
+        -onsets: sample indices of the pulse onsets
+    """
+    above = np.abs(np.nan_to_num(stim)) > thresh
+    crossings = np.where(np.diff(above.astype(np.int8))==1)[0]+1
+    if above.size > 0 and above[0]:
+        crossings = np.hstack([[0],crossings])
+    if crossings.size == 0:
+        return crossings
+    keep = np.hstack([[True],np.diff(crossings)>=min_dist])
+    return crossings[keep]
+
+def save_stim(files,path_out=None,pipelined=False):
+    """
+    Function to create hdf5 file from ephys data. The stim on/off record is saved
+    as a table of intervals (see densify), with the sample rate and the total number
+    of samples saved as attributes.
     Args:
         -files: iterable of ephys/stim file paths from one experiment (TDMS files)
         -path_out: optional alternative path to save the data file. If
             not specified, file is saved in same location as input files.
+        -pipelined: if True, reading, stim detection and writing are overlapped
+            (see save_stim_pipelined)
     Returns:
         None; data saved in specified location
     """
@@ -70,56 +153,145 @@ def save_stim(files,path_out=None):
     if path_out == None:
         path_out = os.path.dirname(files[0])
     path_out = os.path.join(path_out,'stim_data.hdf5')
-    f_out = h5py.File(path_out,'w')
-    starts = []
-    stops = []
-    zs = []
-    offset = 0
-    for f in files:
-        print("loading "+f)
-        start,stop,z,fs = load_stim(f,offset)
-        starts.append(start)
-        stops.append(stop)
-        zs.append(z)
-        offset+=z.size
+    if pipelined:
+        save_stim_pipelined(files,path_out)
+        return
+    data = process_stim(files)
     ##now add to the data file
-    f_out.create_dataset("start",data=np.hstack(starts)/fs)
-    f_out.create_dataset("stop",data=np.hstack(stops)/fs)
-    f_out.create_dataset("z",data=np.hstack(zs))
-    f_out.close()
+    write_stim(path_out,data)
+
+def write_stim(path_out,data):
+    """
+    Saves a stim data dictionary from process_stim to an hdf5 file
+    """
+    f_out = h5py.File(path_out,'w')
+    try:
+        with profiling.span('hdf5_write',path_out) as rec:
+            f_out.create_dataset("start",data=data['start'])
+            f_out.create_dataset("stop",data=data['stop'])
+            dset = f_out.create_dataset("intervals",data=data['intervals'])
+            dset.attrs['fs'] = data['fs']
+            dset.attrs['n_samples'] = data['n_samples']
+            rec['bytes_written'] = profiling.nbytes(data)[0]
+    finally:
+        f_out.close()
+
+def save_stim_pipelined(files,path_out):
+    """
+    Function to save stim data using the pipelined engine: files are decoded by
+    reader processes, stim times are detected by worker processes (several files
+    at once), and the results are written in order by this process.
+    Args:
+        -files: ordered list of ephys/stim file paths
+        -path_out: full path of the output data file
+    Returns:
+        None; data saved in specified location
+    """
+    results = []
+    def write(index,result):
+        results.append(result)
+    pipeline.run_pipeline(files,read_stim,compute_stim,write)
+    write_stim(path_out,combine_stim(results))
+
+def read_stim(path):
+    """
+    Reader stage for save_stim_pipelined: decodes the stim channel in a file.
+    Args:
+        -path: full path to the datafile
+    Returns:
+        -raw: raw stim monitor data
+        -fs: sample rate of the data
+    """
+    channel_object = get_stim_channel(open_tdms(path))
+    return channel_object.data, 1/channel_object.properties['wf_increment']
 
+def compute_stim(item):
+    """
+    Compute stage for save_stim_pipelined: finds the stim times in data from read_stim.
+    Args:
+        -item: (raw,fs) tuple from read_stim
+    Returns:
+        -start,stop,intervals: see get_stim_times (not offset)
+        -fs: sample rate of the data
+        -n_samples: number of samples in the data
+    """
+    raw,fs = item
+    start,stop,intervals = get_stim_times(raw,0.1,-0.1,25)
+    return start,stop,intervals,fs,raw.size
 
+def get_stim_channel(tdms_file):
+    """
+    Returns the stim monitor channel object from a tdms file, which can be
+    saved under a few different group names.
+    Args:
+        -tdms_file: nptdms file object
+    Returns:
+        -channel_object: nptdms channel object
+    """
+    global stim_chan
+    try:
+        channel_object = tdms_file.object('Group Name',stim_chan)
+    except KeyError:
+        try:
+            channel_object = tdms_file.object('ephys',stim_chan)
+        except KeyError:
+            channel_object = tdms_file.object('Untitled',stim_chan)
+    return channel_object
+
+@cache.cached
 def process_stim(files):
     """
     Function to create a data dictionary from stim data.
     Args:
         -files: iterable of ephys/stim file paths from one experiment (TDMS files)
-        -path_out: optional alternative path to save the data file. If
-            not specified, file is saved in same location as input files.
     Returns:
-        data: dictionary with data from stim file, processed accordingly
+        data: dictionary with data from stim file, processed accordingly:
+            -start: stim train onset times, in seconds
+            -stop: stim train offset times, in seconds
+            -intervals: n x 2 array of (first, one past last) samples of each
+                stim train; use densify to get the binary on/off array
+            -fs: sample rate of the stim data
+            -n_samples: total number of samples in the recording
     """
     ##order the files
     files = order_files(files)
-    data = {}
+    results = []
+    ##the next file is read in the background while the stim times are found in this one
+    for f in prefetch(files):
+        print("loading "+f)
+        results.append(load_stim(f))
+    return combine_stim(results)
+
+def combine_stim(results):
+    """
+    Joins the per-file results from load_stim (in file order) into one
+    data dictionary (see process_stim).
+    """
     starts = []
     stops = []
-    zs = []
+    intervals = []
     offset = 0
-    for f in files:
-        print("loading "+f)
-        start,stop,z,fs = load_stim(f,offset)
-        starts.append(start)
-        stops.append(stop)
-        zs.append(z)
-        offset+=z.size
-    ##now add to the data dict
+    for start,stop,ivals,fs,n in results:
+        starts.append(start+offset)
+        stops.append(stop+offset)
+        intervals.append(ivals+offset)
+        offset += n
+    intervals = np.vstack(intervals)
+    ##merge trains that run across the boundary between two files
+    if len(intervals) > 1:
+        keep = np.hstack([[True],intervals[1:,0]>intervals[:-1,1]])
+        group = np.cumsum(keep)-1
+        ends = np.zeros(keep.sum(),dtype=np.int64)
+        np.maximum.at(ends,group,intervals[:,1])
+        intervals = np.stack([intervals[keep,0],ends],axis=1)
+    data = {}
     data['start']=np.hstack(starts)/fs
     data['stop']=np.hstack(stops)/fs
-    data['z']=np.hstack(zs)
+    data['intervals']=intervals
+    data['fs']=fs
+    data['n_samples']=offset
     return data
 
-
 def load_stim(path,offset=0):
     """
     A function to load a stim channel from a TDMS file, and extract the times when stimulation is "on"
@@ -129,26 +301,23 @@ def load_stim(path,offset=0):
     Returns:
         -start: start times of stim wf
         -stop: end times of stim wf
-        -z: binary stim on/off array for full sample rate
+        -intervals: n x 2 array of (first, one past last) samples of each stim train
         -fs: sample rate for this dataset
+        -n_samples: number of samples in the file
     """
     global stim_chan
     ##load the file
-    tdms_file = nptdms.TdmsFile(path)
-    try:
-        channel_object = tdms_file.object('Group Name',stim_chan)
-    except KeyError:
-        try:
-            channel_object = tdms_file.object('ephys',stim_chan)
-        except KeyError:
-            channel_object = tdms_file.object('Untitled',stim_chan)
+    with profiling.span('tdms_decode',path) as rec:
+        tdms_file = open_tdms(path)
+        rec['bytes_read'] = os.path.getsize(path)
+    channel_object = get_stim_channel(tdms_file)
     raw = channel_object.data
     fs = 1/channel_object.properties['wf_increment']
     ##process the stim output (guessing on parameters here)
-    start,stop,z = get_stim_times(raw,0.1,-0.1,25)
-    start = start+offset
-    stop = stop+offset
-    return start,stop,z,fs
+    with profiling.span('stim_detect',path) as rec:
+        start,stop,intervals = get_stim_times(raw,0.1,-0.1,25)
+        rec['samples'] = raw.size
+    return start+offset,stop+offset,intervals+offset,fs,raw.size
 
     ##TODO: figure out a better way to find the stim onset/offset block time.
     ##loading the full stim start/stop/z data is resource intensive and takes a long
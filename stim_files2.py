@@ -6,16 +6,10 @@ Author: Ryan Neely and Marius Guerard
 import os
 
 import numpy as np
-import nptdms
 import h5py
 from scipy.signal import find_peaks
-from sklearn.mixture import GaussianMixture as GMM
-import matplotlib
-# matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-matplotlib.interactive(False)
 
-from tdms_files import order_files
+from tdms_files import order_files, open_tdms, prefetch
 
 
 stim_chan = 'stim_mon'
@@ -39,7 +33,7 @@ def save_raw_stim(files, group_name='Group Name', path_out=None, record_raw='scr
     offset = 0
     raw_list = []
     fs_list = []
-    for f in files:
+    for f in prefetch(files):
         print("loading " + f)
         raw, fs = _load_raw_stim(f, group_name=group_name)
         raw_list.append(raw)
@@ -57,6 +51,10 @@ def save_raw_stim(files, group_name='Group Name', path_out=None, record_raw='scr
     if record_raw == 'full':
         f_out.create_dataset("raw", data=raw_stim)
     elif record_raw == 'screenshot':
+        import matplotlib
+        # matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        matplotlib.interactive(False)
         fig = plt.figure()
         plt.vlines([stim_start, stim_stop], 0, max(raw_stim), color='r')
         plt.plot(raw_stim, zorder=1)
@@ -83,7 +81,7 @@ def _load_raw_stim(path, group_name='Group Name'):
     """
     global stim_chan
     ##load the file
-    tdms_file = nptdms.TdmsFile(path)
+    tdms_file = open_tdms(path)
     # channel_object = tdms_file.object('Group Name', stim_chan)
     channel_object = tdms_file.object(group_name, stim_chan)
     raw = channel_object.data
@@ -109,6 +107,8 @@ def _get_stim_times(raw_stim, thresh=None, margin=2.5):
     However, GMM allows for multimodal gaussian fitting in the case we have
     multiple stimulations times.
     """
+    ## sklearn is slow to import, so only load it when it's needed.
+    from sklearn.mixture import GaussianMixture as GMM
     if thresh is None:
         thresh = max(raw_stim) / 10
     in_stim = np.where(raw_stim > thresh)[0]
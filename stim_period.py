@@ -6,9 +6,10 @@
 ##by Ryan Neely 1/6/2020
 
 import numpy as np
-import nptdms
 import multiprocessing as mp
-from tdms_files import order_files
+from tdms_files import order_files, open_tdms, prefetch
+import profiling
+import os
 
 stim_chan = 'stim_mon' ##this should be the name of the stim channel in all files
 
@@ -27,12 +28,15 @@ def get_period(files):
     files = order_files(files)
     start = None
     stop = None
-    files = iter(files)
+    ##read the next file in the background while this one is searched
+    files = prefetch(files)
     ##this will churn through the files until a start value is found
     while start == None:
         path = next(files)
         print("Loading {}".format(path))
-        tdms_file = nptdms.TdmsFile(path)
+        with profiling.span('tdms_decode',path) as rec:
+            tdms_file = open_tdms(path)
+            rec['bytes_read'] = os.path.getsize(path)
         ##here are a couple diffent possibilities for how things could be named
         try:
             channel_object = tdms_file.object('Group Name',stim_chan)
@@ -54,7 +58,9 @@ def get_period(files):
         stop = end
         path = next(files)
         print("Loading {}".format(path))
-        tdms_file = nptdms.TdmsFile(path)
+        with profiling.span('tdms_decode',path) as rec:
+            tdms_file = open_tdms(path)
+            rec['bytes_read'] = os.path.getsize(path)
         ##here are a couple diffent possibilities for how things could be named
         try:
             channel_object = tdms_file.object('Group Name',stim_chan)
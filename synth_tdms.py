@@ -0,0 +1,149 @@
+##synth_tdms.py
+
+##functions to write synthetic TDMS data sets that mimic the file layouts
+##produced by the different rigs/acquisition builds (see the docstring in tdms_files).
+##Used for benchmarking and for testing the processing code without real data.
+
+import numpy as np
+import os
+import datetime
+from nptdms import TdmsWriter, ChannelObject
+
+##sample rates used by the acquisition hardware
+ephys_fs = {'rig1':24414.0625,'rig2':25000.0}
+bp_fs = 1000.0 ##rate of the BP monitor DAQ on rig2
+physio_fs = 1.0 ##LabView saves the serial data with a wf_increment of 1 (see physio_files.load_physio)
+
+##serial port channel names (same on every build)
+serial_names = ['Untitled','Untitled 1','Untitled 2','Untitled 3','Untitled 4','Untitled 5']
+
+##file layouts for each rig/build. Each entry is a list of files types, given as
+##(file name prefix, group name, list of channel names, rig sample rate key)
+layouts = {
+    'rig1_2.1':[
+        ('DAQ','Group Name',['heart_rate1','pulse_wf','mean_bp','systolic_bp',
+            'diastolic_bp','stim_mon','amplifier'],'ephys'),
+        ('serial','Untitled',['Time']+serial_names,'physio')
+    ],
+    'rig1_3.0':[
+        ('DAQ','Group Name',['amp_1','amp_2','amp_3','amp_4','pulse_wf','mean_bp',
+            'systolic_bp','diastolic_bp','stim_mon'],'ephys'),
+        ('serial','Untitled',['Time']+serial_names,'physio')
+    ],
+    'rig2_3.0':[
+        ('ephys','ephys',['amp_'+str(i) for i in range(16)]+['stim_mon'],'ephys'),
+        ('physioMon','Untitled',['Time']+serial_names,'physio'),
+        ('bpMon','Group Name',['heart_rate1','mean_bp','systolic_bp','diastolic_bp','pulse_wf'],'bp')
+    ],
+    'rig2_2.0':[
+        ('DAQ','Group Name',['heart_rate1','mean_bp','systolic_bp','diastolic_bp',
+            'pulse_wf','amplifier'],'ephys'),
+        ('serial','Untitled',['Time']+serial_names,'physio')
+    ]
+}
+
+def make_dataset(layout,d,n_files=4,file_seconds=60.0,stim=(0.3,0.6),stim_hz=300.0,
+    segment_seconds=1.0,seed=0):
+    """
+    A function to write a synthetic experiment folder with the file layout of a
+    given rig/build. Recordings are split across n_files files, named the same way
+    LabView names them (the first file un-numbered, then _0001, _0002...).
+    Args:
+        -layout: key into the layouts dictionary (ie 'rig2_3.0')
+        -d: folder to write the data files to (created if it doesn't exist).
+            Avoid folder names containing the file type tags ('DAQ','ephys', 'mA'...)
+            since sort_tdms looks for them in the full path.
+        -n_files: number of files to split each recording across
+        -file_seconds: duration of each file, in seconds
+        -stim: (start,stop) of the stim block, as fractions of the total recording time.
+            The block should end before the last file (see stim_period.get_period).
+        -stim_hz: pulse rate within the stim train
+        -segment_seconds: amount of data written per TDMS segment
+        -seed: random seed
+    Returns:
+        -info: dictionary with the sample rates, durations and stim block times (in s)
+            of the data set
+    """
+    if not os.path.exists(d):
+        os.makedirs(d)
+    rng = np.random.RandomState(seed)
+    rig = layout.split('_')[0]
+    total = n_files*file_seconds
+    info = {'layout':layout,'n_files':n_files,'file_seconds':file_seconds,
+        'time':total,'stim_start':stim[0]*total,'stim_stop':stim[1]*total,
+        'fs':{},'files':[]}
+    start_time = datetime.datetime(2019,6,10,12,0,0)
+    for prefix,group,chans,rate in layouts[layout]:
+        if rate == 'ephys':
+            fs = ephys_fs[rig]
+        elif rate == 'bp':
+            fs = bp_fs
+        else:
+            fs = physio_fs
+        info['fs'][prefix] = fs
+        n_seg = int(np.round(segment_seconds*fs))
+        n_file = int(np.round(file_seconds*fs))
+        for i in range(n_files):
+            if i == 0:
+                fname = prefix+'.tdms'
+            else:
+                fname = prefix+'_{0:04d}.tdms'.format(i)
+            path = os.path.join(d,fname)
+            t0 = start_time+datetime.timedelta(seconds=i*file_seconds)
+            with TdmsWriter(path) as writer:
+                for s in range(0,n_file,n_seg):
+                    idx = np.arange(i*n_file+s,i*n_file+min(s+n_seg,n_file))
+                    objs = []
+                    for chan in chans:
+                        props = {'NI_ChannelName':chan,'wf_increment':1.0/fs,
+                            'wf_start_time':t0,'wf_start_offset':0.0}
+                        y = _synth_channel(chan,idx,fs,info,stim_hz,rng)
+                        objs.append(ChannelObject(group,chan,y,properties=props))
+                    writer.write_segment(objs)
+            info['files'].append(path)
+    return info
+
+def _synth_channel(chan,idx,fs,info,stim_hz,rng):
+    """
+    Generates data for one channel.
+    Args:
+        -chan: channel name
+        -idx: absolute sample indices (from the start of the recording) to generate
+        -fs: sample rate
+        -info: data set info from make_dataset
+        -stim_hz: stim pulse rate
+        -rng: numpy RandomState
+    Returns:
+        -y: data array
+    """
+    t = idx/fs
+    if 'amp' in chan:
+        ##background noise (volts) plus some spikes
+        y = rng.normal(0,10e-6,idx.size)
+        spikes = np.where(rng.rand(idx.size)<(5.0/fs))[0]
+        for k in range(8):
+            y[np.clip(spikes+k,0,idx.size-1)] -= 60e-6*np.exp(-k/2.0)
+    elif chan == 'stim_mon':
+        ##biphasic pulses during the stim block, a flat line otherwise
+        y = np.zeros(idx.size)
+        on = (t>=info['stim_start'])&(t<info['stim_stop'])
+        width = max(int(np.round(fs*0.0002)),1)
+        phase = np.mod(idx,int(np.round(fs/stim_hz)))
+        y[on&(phase<width)] = 0.5
+        y[on&(phase>=width)&(phase<2*width)] = -0.5
+    elif chan == 'pulse_wf':
+        ##pressure waveform at ~300bpm, in units of 100mmHg
+        y = (100+20*np.sin(2*np.pi*5.0*t)+rng.normal(0,1,idx.size))/100.0
+    elif chan in ['mean_bp','systolic_bp','diastolic_bp']:
+        base = {'mean_bp':100,'systolic_bp':120,'diastolic_bp':80}[chan]
+        y = (base+5*np.sin(2*np.pi*t/600.0))/100.0
+    elif chan == 'heart_rate1':
+        y = 300+10*np.sin(2*np.pi*t/600.0)
+    elif chan == 'Time':
+        y = t*10.0
+    else:
+        ##serial monitor channels
+        base = {'Untitled':2.0,'Untitled 1':37.0,'Untitled 2':37.0,
+            'Untitled 3':95.0,'Untitled 4':300.0,'Untitled 5':1.0}[chan]
+        y = base+0.01*base*rng.normal(0,1,idx.size)
+    return y
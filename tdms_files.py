@@ -69,9 +69,37 @@ Rig2, ephys 2.0:
 
 """
 import numpy as np
-import nptdms
 import os
-from scipy.signal import decimate
+import threading
+import multiprocessing as mp
+from collections import OrderedDict
+import profiling
+
+##budget, in bytes, for the decoded TDMS files kept open by open_tdms. Each file is
+##charged for its decoded arrays, which can be several times its size on disk (nptdms
+##keeps the scaled float64 data alongside the raw integer samples; see _decoded_bytes)
+tdms_cache_bytes = 4e9
+
+##maximum number of files whose metadata is kept by read_tdms_metadata
+meta_cache_size = 1024
+
+##default cap, in bytes, on the files read ahead by prefetch
+prefetch_bytes = 2e9
+
+##total number of cores to use for loading/resampling. This budget is shared between
+##the process pools that load files (n_procs processes) and the threads that resample
+##the channels of a file inside each process (see channel_threads)
+n_cores = os.cpu_count() or 1
+
+##number of processes in the file loading pools
+n_procs = 3
+
+##(path,mtime,size):(tdms_file,nbytes) pairs, oldest first
+_tdms_cache = OrderedDict()
+_meta_cache = OrderedDict()
+##files read ahead by prefetch that haven't been used yet
+_pinned = {}
+_tdms_lock = threading.Lock()
 
 def sort_tdms(d):
     """
@@ -121,6 +149,188 @@ def search_files(path):
     print("Discovered {0} recruitment curve file(s)".format(len(file_dict['RC'])))
     return file_dict
 
+def open_tdms(path):
+    """
+    Opens (and decodes) a TDMS file, reusing the decoded file if the same file
+    was opened before in this session and hasn't changed since. The least recently
+    used files are dropped once the files held come to more than tdms_cache_bytes.
+    Files opened in pool workers/pipeline processes aren't cached, since these
+    processes are short-lived and would each hold their own copy.
+    Args:
+        -path: full path to the tdms file
+    Returns:
+        -tdms_file: nptdms TdmsFile
+    """
+    import nptdms
+    key = _file_key(path)
+    with _tdms_lock:
+        if key in _pinned:
+            return _pinned[key]
+    if mp.current_process().daemon:
+        return nptdms.TdmsFile(path)
+    with _tdms_lock:
+        if key in _tdms_cache:
+            _tdms_cache.move_to_end(key)
+            return _tdms_cache[key][0]
+    ##decode outside the lock, so other threads can use the cache in the meantime
+    tdms_file = nptdms.TdmsFile(path)
+    with _tdms_lock:
+        _tdms_cache[key] = (tdms_file,_decoded_bytes(tdms_file,key[2]))
+        total = sum([x[1] for x in _tdms_cache.values()])
+        while total > tdms_cache_bytes and len(_tdms_cache) > 1:
+            old_key,(old_file,nbytes) = _tdms_cache.popitem(last=False)
+            total -= nbytes
+    return tdms_file
+
+def prefetch(files,lookahead=1,max_bytes=None):
+    """
+    Iterates over a list of TDMS files while a background thread opens the next
+    file(s) with open_tdms, so that reading and decoding the next file overlaps
+    with processing the current one. Opening a yielded path with open_tdms then
+    returns the already-decoded file.
+    Args:
+        -files: ordered list of file paths (ie from order_files)
+        -lookahead: number of files to read ahead of the current one
+        -max_bytes: cap on the total size of the current and read-ahead files (at least
+            one file is always read ahead, whatever its size). Default is prefetch_bytes.
+    Yields:
+        -path: each file path in turn
+    """
+    import queue
+    if max_bytes == None:
+        max_bytes = prefetch_bytes
+    files = list(files)
+    ready = queue.Queue()
+    cond = threading.Condition()
+    ##number and total size of the files that have been read but not finished with yet
+    state = {'count':0,'nbytes':0,'stop':False}
+    def reader():
+        for path in files:
+            try:
+                size = os.path.getsize(path)
+            except Exception as e:
+                ##pass the error on, so the consumer doesn't wait forever for this file
+                ready.put((path,None,0,e))
+                return
+            with cond:
+                while not state['stop'] and state['count'] > 0 and (
+                    state['count'] > lookahead or state['nbytes']+size > max_bytes):
+                    cond.wait()
+                if state['stop']:
+                    return
+                state['count'] += 1
+                state['nbytes'] += size
+            try:
+                key = _file_key(path)
+                tdms_file = open_tdms(path)
+            except Exception as e:
+                ready.put((path,None,size,e))
+                return
+            with cond:
+                if state['stop']:
+                    return
+                with _tdms_lock:
+                    _pinned[key] = tdms_file
+            ready.put((path,key,size,None))
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        for i in range(len(files)):
+            path,key,size,err = ready.get()
+            if err != None:
+                raise err
+            try:
+                yield path
+            finally:
+                with _tdms_lock:
+                    _pinned.pop(key,None)
+                with cond:
+                    state['count'] -= 1
+                    state['nbytes'] -= size
+                    cond.notify()
+    finally:
+        ##stop reading ahead (ie if the loop exits early) and unpin anything left over
+        with cond:
+            state['stop'] = True
+            cond.notify()
+        while not ready.empty():
+            key = ready.get()[1]
+            with _tdms_lock:
+                _pinned.pop(key,None)
+
+def read_tdms_metadata(path):
+    """
+    Reads just the metadata of a TDMS file (see open_tdms), reusing
+    the result if the file was read before and hasn't changed.
+    Args:
+        -path: full path to the tdms file
+    Returns:
+        -tdms_file: nptdms TdmsFile with no data loaded
+    """
+    import nptdms
+    key = _file_key(path)
+    with _tdms_lock:
+        if key in _meta_cache:
+            _meta_cache.move_to_end(key)
+            return _meta_cache[key]
+        if key in _tdms_cache:
+            return _tdms_cache[key][0]
+    tdms_file = nptdms.TdmsFile.read_metadata(path)
+    with _tdms_lock:
+        _meta_cache[key] = tdms_file
+        while len(_meta_cache) > meta_cache_size:
+            _meta_cache.popitem(last=False)
+    return tdms_file
+
+def is_cached(path):
+    """
+    Returns True if the decoded data for a file is held by open_tdms
+    """
+    key = _file_key(path)
+    with _tdms_lock:
+        return key in _tdms_cache
+
+def clear_tdms_cache():
+    """
+    Drops all the files held by open_tdms and read_tdms_metadata
+    (files being read ahead by prefetch are kept until they're used)
+    """
+    with _tdms_lock:
+        _tdms_cache.clear()
+        _meta_cache.clear()
+
+def _decoded_bytes(tdms_file,disk_size):
+    """
+    Estimates the memory a decoded TDMS file takes once its data is used, from the
+    channel metadata: the raw samples, plus a float64 copy of any channel that isn't
+    already float64 (which nptdms creates, and keeps, when the scaled data is read).
+    Args:
+        -tdms_file: decoded nptdms TdmsFile
+        -disk_size: size of the file on disk (the estimate is never less than this)
+    Returns:
+        -nbytes: estimated size in bytes
+    """
+    total = 0
+    for g in tdms_file.groups():
+        for c in tdms_file.group_channels(g):
+            try:
+                n = len(c)
+            except TypeError:
+                n = getattr(c,'number_values',0)
+            nptype = getattr(getattr(c,'data_type',None),'nptype',None)
+            if nptype == None or not n:
+                continue
+            dtype = np.dtype(nptype)
+            total += n*dtype.itemsize
+            if dtype != np.float64:
+                total += 8*n
+    return max(total,disk_size)
+
+def _file_key(path):
+    st = os.stat(path)
+    return (os.path.abspath(path),st.st_mtime,st.st_size)
+
 def file_ids(tdms_file):
     """
     Function to get the group and channel IDs for a tdms file
@@ -144,6 +354,43 @@ def file_ids(tdms_file):
     return ids
 
 
+def get_n_samples(path):
+    """
+    Function to get the number of samples in each channel of a tdms file,
+    reading only the file's metadata (not the data itself).
+    Args:
+        -path: full path to the tdms file
+    Returns:
+        -n_samples: dictionary with channel name:number of samples pairs
+        -fs: dictionary with channel name:sample rate pairs
+    """
+    tdms_file = read_tdms_metadata(path)
+    n_samples = {}
+    fs = {}
+    for g in tdms_file.groups():
+        for c in tdms_file.group_channels(g):
+            name = c.properties['NI_ChannelName']
+            n_samples[name] = len(c)
+            if 'wf_increment' in c.properties:
+                fs[name] = 1.0/c.properties['wf_increment']
+    return n_samples, fs
+
+def resampled_length(n_samples,old_fs,new_fs):
+    """
+    Returns the number of samples that downsample will return
+    for an array of n_samples.
+    Args:
+        -n_samples: number of samples in the original data
+        -old_fs: original sample rate
+        -new_fs: requested sample rate (or False for no resampling)
+    Returns:
+        -n: number of samples after resampling
+    """
+    if not new_fs:
+        return n_samples
+    factor = int(np.round(old_fs/new_fs))
+    return int(np.ceil(n_samples/float(factor)))
+
 def get_group_fs(tdms_file,tdms_group):
     """
     Function to get the sample rate of all channels in a group
@@ -175,6 +422,281 @@ def get_duration_seconds(channel_object):
     n_samples = channel_object.data.size
     return n_samples*wf_increment
 
+##DAQmx input source meaning "the raw samples" rather than another scale
+raw_input_source = 0xFFFFFFFF
+
+def get_raw_scaling(channel_object):
+    """
+    Looks for the DAQmx scaling information saved with a channel, which is
+    what LabView uses to convert the raw integer samples into real units.
+    A channel can chain several scales (each one taking its input from another,
+    or from the raw samples); the chain is followed from the last scale back
+    to the raw samples, as nptdms does. Only chains of linear scales (or
+    polynomial scales of order 1) are handled.
+    Args:
+        -channel_object: nptdms channel object
+    Returns:
+        -scaling: (scale,offset) tuple such that data = raw*scale+offset, or
+            None if the channel doesn't have raw data with a linear scale chain
+    """
+    props = channel_object.properties
+    if props.get('NI_Scaling_Status') != 'unscaled' or not 'NI_Number_Of_Scales' in props:
+        return None
+    n = props['NI_Number_Of_Scales']
+    scale,offset = 1.0,0.0
+    i = n-1
+    seen = set()
+    while i != raw_input_source:
+        if i in seen or i < 0 or i >= n:
+            ##the chain loops or points at a scale that isn't there
+            return None
+        seen.add(i)
+        step = _linear_step(props,i)
+        if step == None:
+            return None
+        scale,offset = scale*step[0],scale*step[1]+offset
+        i = step[2]
+    return (scale,offset)
+
+def _linear_step(props,i):
+    """
+    Returns (slope,intercept,input source) for one scale in a DAQmx scale chain,
+    or None if it isn't linear
+    """
+    scale_type = props.get('NI_Scale[{}]_Scale_Type'.format(i))
+    if scale_type == 'Linear':
+        return (props['NI_Scale[{}]_Linear_Slope'.format(i)],
+            props['NI_Scale[{}]_Linear_Y_Intercept'.format(i)],
+            props.get('NI_Scale[{}]_Linear_Input_Source'.format(i),raw_input_source))
+    elif scale_type == 'Polynomial':
+        coeffs = []
+        j = 0
+        while 'NI_Scale[{}]_Polynomial_Coefficients[{}]'.format(i,j) in props:
+            coeffs.append(props['NI_Scale[{}]_Polynomial_Coefficients[{}]'.format(i,j)])
+            j += 1
+        if len(coeffs) >= 2 and not any(coeffs[2:]):
+            return (coeffs[1],coeffs[0],
+                props.get('NI_Scale[{}]_Polynomial_Input_Source'.format(i),raw_input_source))
+    return None
+
+def channel_threads():
+    """
+    Returns the number of threads to use for per-channel work in this process:
+    an equal share of n_cores for each pool worker, or all of them otherwise.
+    """
+    if mp.current_process().daemon:
+        return max(n_cores//n_procs,1)
+    return max(n_cores,1)
+
+def map_channels(fn,items,n_threads=None):
+    """
+    Applies a function to each item (ie each channel of a file) on a thread pool.
+    The resampling/conversion functions release the GIL, so the channels are
+    processed in parallel.
+    Args:
+        -fn: function to apply
+        -items: list of items
+        -n_threads: number of threads (default is channel_threads())
+    Returns:
+        -results: list of results, in the same order as items
+    """
+    if n_threads == None:
+        n_threads = channel_threads()
+    if n_threads <= 1 or len(items) <= 1:
+        return [fn(x) for x in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(min(n_threads,len(items))) as ex:
+        return list(ex.map(fn,items))
+
+def load_channels(channel_objects,resample=False,compact=False,n_threads=None):
+    """
+    Loads several channels in parallel (see load_channel and map_channels).
+    Returns:
+        -results: list of (data,scaling) tuples, in the same order as channel_objects
+    """
+    return map_channels(lambda c: load_channel(c,resample,compact),channel_objects,n_threads)
+
+def load_channel(channel_object,resample=False,compact=False):
+    """
+    Loads the data from a channel, resampling it if requested.
+    Args:
+        -channel_object: nptdms channel object
+        -resample: if a number, resamples the data to 'resample' Hz
+        -compact: if True, keeps the raw integer samples (plus their scaling) where the
+            file has them, and otherwise returns float32 instead of float64
+    Returns:
+        -data: data array
+        -scaling: (scale,offset) if data holds raw samples, otherwise None
+    """
+    if compact and not resample:
+        scaling = get_raw_scaling(channel_object)
+        if scaling != None:
+            return channel_object.raw_data, scaling
+        return channel_object.data.astype(np.float32), None
+    if resample:
+        data = downsample(channel_object,resample)
+    else:
+        data = channel_object.data
+    if compact:
+        data = data.astype(np.float32)
+    return data, None
+
+def apply_scaling(data,scaling,dtype=np.float32):
+    """
+    Converts raw samples to real units.
+    Args:
+        -data: raw data array
+        -scaling: (scale,offset) tuple, or None if the data is already scaled
+        -dtype: data type of the result
+    Returns:
+        -data: scaled data
+    """
+    if scaling == None:
+        return data.astype(dtype,copy=False)
+    result = data.astype(dtype)
+    result *= scaling[0]
+    result += scaling[1]
+    return result
+
+def data_chans(data):
+    """
+    Returns the channel names in a data dictionary from one of the
+    load functions (ie everything except the 'time', 'scaling' and 'qc' entries)
+    """
+    return [x for x in list(data) if not x in ['time','scaling','qc']]
+
+def file_lengths(files,chan,resample=False):
+    """
+    Returns the number of samples a channel will have in each file once it is loaded
+    (and resampled), reading only the file headers.
+    Args:
+        -files: list of TDMS file paths
+        -chan: channel name (looked for in each of the groups the channels are saved under)
+        -resample: resample rate passed to the load function, or False
+    Returns:
+        -lengths: list of sample counts, one per file
+    """
+    lengths = []
+    for f in files:
+        tdms_file = read_tdms_metadata(f)
+        for g in ['Group Name','ephys','Untitled']:
+            try:
+                channel_object = tdms_file.object(g,chan)
+                break
+            except KeyError:
+                pass
+        else:
+            raise KeyError("No channel {} in {}".format(chan,f))
+        fs = 1.0/channel_object.properties['wf_increment']
+        lengths.append(resampled_length(len(channel_object),fs,resample))
+    return lengths
+
+def new_buffer(n,dtype,mmap=None,name='data'):
+    """
+    Allocates an output array for a concatenated channel.
+    Args:
+        -n: number of samples
+        -dtype: data type
+        -mmap: optional folder; if given, the array is an np.memmap backed by a file in it
+        -name: channel name (used for the memmap file name)
+    Returns:
+        -data: empty array
+    """
+    if mmap:
+        if not os.path.exists(mmap):
+            os.makedirs(mmap)
+        return np.memmap(os.path.join(mmap,name+'.dat'),dtype=dtype,mode='w+',shape=(n,))
+    return np.empty(n,dtype=dtype)
+
+def concat_files(results,lengths,mmap=None):
+    """
+    Concatenates per-file data dictionaries into one preallocated array per channel.
+    Each file's data is copied in as it arrives, so only the output (plus the files
+    in flight) is held in memory, rather than every file plus the output.
+    Raw (compact) samples are kept raw as long as every file has the same scaling;
+    otherwise they're converted to float32 (as in stack_channel).
+    Args:
+        -results: iterable of data dictionaries from one of the load functions, in
+            file order (ie from Pool.imap)
+        -lengths: number of samples each file contributes (see file_lengths)
+        -mmap: optional folder to back the arrays with np.memmap files (see new_buffer)
+    Returns:
+        -dsets: dictionary of concatenated arrays, plus the summed duration ('time')
+            if the files have it
+        -scalings: dictionary of the (scale,offset) of each raw channel (None for
+            channels that are already scaled)
+    """
+    offsets = np.hstack([[0],np.cumsum(lengths)]).astype(np.int64)
+    dsets = {}
+    scalings = {}
+    times = []
+    for i,data in enumerate(results):
+        file_scalings = data.get('scaling',{})
+        for chan in data_chans(data):
+            y = data[chan]
+            scaling = file_scalings.get(chan)
+            assert y.size == lengths[i], "File {} has {} samples of {}, expected {}".format(
+                i,y.size,chan,lengths[i])
+            if not chan in dsets:
+                dsets[chan] = new_buffer(offsets[-1],y.dtype,mmap,chan)
+                scalings[chan] = scaling
+            elif scaling != scalings[chan]:
+                ##different scaling from the earlier files; store everything scaled
+                if scalings[chan] != None:
+                    dsets[chan] = _scale_buffer(dsets[chan],scalings[chan],offsets[i],mmap,chan)
+                    scalings[chan] = None
+                y = apply_scaling(y,scaling)
+            dsets[chan][offsets[i]:offsets[i+1]] = y
+        if 'time' in data:
+            times.append(data['time'])
+    if len(times) > 0:
+        dsets['time'] = np.sum(times)
+    return dsets, scalings
+
+def _scale_buffer(raw,scaling,n_filled,mmap=None,name='data',chunk=2**22):
+    """
+    Converts a partly filled raw output array from concat_files to float32. The new
+    array is allocated with new_buffer (so it's a memmap if the old one was), and the
+    filled part is converted a chunk at a time, so there's never a full-size float64
+    (or unmapped float32) copy in memory. The old memmap file is removed where possible.
+    """
+    data = new_buffer(raw.size,np.float32,mmap,name+'_scaled')
+    for c in range(0,n_filled,chunk):
+        data[c:min(c+chunk,n_filled)] = apply_scaling(raw[c:min(c+chunk,n_filled)],scaling)
+    if isinstance(raw,np.memmap):
+        try:
+            os.remove(raw.filename)
+        except OSError:
+            ##(can't remove a file that is still mapped on Windows)
+            pass
+    return data
+
+def stack_channel(dsets,chan):
+    """
+    Concatenates one channel from a list of per-file data dictionaries.
+    Raw (compact) samples are kept raw as long as every file has the same scaling;
+    otherwise they're converted to float32.
+    Args:
+        -dsets: ordered list of data dictionaries from one of the load functions
+        -chan: channel name
+    Returns:
+        -data: concatenated data array
+        -scaling: (scale,offset) if data holds raw samples, otherwise None
+    """
+    scalings = [x.get('scaling',{}).get(chan) for x in dsets]
+    if len(set(scalings)) == 1:
+        return np.hstack([x[chan] for x in dsets]), scalings[0]
+    return np.hstack([apply_scaling(x[chan],s) for x,s in zip(dsets,scalings)]), None
+
+def set_scaling_attrs(dset,scaling):
+    """
+    Saves the scaling of a raw data set as 'scale' and 'offset' attributes,
+    so that data = raw*scale+offset
+    """
+    if scaling != None:
+        dset.attrs['scale'] = scaling[0]
+        dset.attrs['offset'] = scaling[1]
+
 def downsample(channel_object,new_fs):
     """
     A function to resample a data array at a new, lower sample
@@ -187,10 +709,26 @@ def downsample(channel_object,new_fs):
     """
     ##get the starting fs of the data
     old_fs = 1/channel_object.properties['wf_increment']
+    return downsample_array(channel_object.data,old_fs,new_fs)
+
+def downsample_array(data,old_fs,new_fs):
+    """
+    Same as downsample, but for a data array that has already been
+    loaded from the file.
+    Args:
+        -data: data array to resample
+        -old_fs: sample rate of the data, in Hz
+        -new_fs: desired sample rate, in hz (should be lower than original fs)
+    Returns: 
+        -data: resampled array of values
+    """
+    from scipy.signal import decimate ##imported here to keep startup fast
     ##make sure this is a request for downsampling
     assert new_fs < old_fs, "Error: requested sample rate is higher than original rate"
     factor = int(np.round(old_fs/new_fs))
-    resampled = decimate(channel_object.data,factor,ftype='fir')
+    with profiling.span('decimate') as rec:
+        resampled = decimate(data,factor,ftype='fir')
+        rec['samples'] = data.size
     return resampled
 
 def order_files(file_list):